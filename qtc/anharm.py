@@ -5,6 +5,7 @@ import numpy as np
 sys.path.insert(0, '/home/elliott/Packages/QTC/')
 from . import iotools as io
 from . import qctools as qc
+from . import patools as pa
 
 def gauss_xmat(filename, natoms):
     """
@@ -18,25 +19,9 @@ def gauss_xmat(filename, natoms):
     full = io.read_file(filename)
     nmodes = 3*natoms-6 
     lines = full.split('X matrix')[1].split('Resonance')[0]
-    lines = lines.split('\n')
-    del lines[0]
-    del lines[-1]
-    
-    xmat = np.zeros((nmodes, nmodes))
-    rangemod = 1
-    if nmodes%5 == 0:
-       rangemod = 0
-    marker = 0
-
-    for m in range(0, nmodes/5+rangemod):
-        length = nmodes - m * 5 
-        a= np.array( lines[marker+1:marker+length+1])
-        for i in range(length):
-            for j in range(0, len(a[i].split())-1):
-                xmat[m*5 + i, m*5 + j] = a[i].split()[j+1]
-                xmat[m*5 + j, m*5 + i] = a[i].split()[j+1]
-        marker += length+1
-
+    lines = lines.split('\n', 1)[1]
+    xmat = pa.read_lower_triangle(lines, nmodes)
+    xmat = xmat + np.tril(xmat, -1).T
     return xmat
 
 
@@ -266,7 +251,7 @@ def main(args, vibrots = None):
             anharmlog = args['anharmlog' ] + '.log'
             andire = io.db_sp_path(anlevel.split('/')[0], anlevel.split('/')[1], anlevel.split('/')[2], None, smiles,
                   optlevel[0], optlevel[1], optlevel[2])
-            if io.check_file(andire + '/' + smiles + '.xmat'):
+            if io.check_result(andire + '/' + smiles + '.xmat'):
                 xmat = io.db_get_sp_prop(smiles, 'xmat', andire).split('\n')
                 for i in range(len(xmat)):
                     xmat[i] = xmat[i].split(',')
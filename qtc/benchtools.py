@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the output parsers.
+
+Times the patools, scantools and qctools extractors and parse_output on the
+outputs in sample_logfiles, and on synthetic outputs scaled up from them by
+replicating optimization cycles and frequency blocks.
+Throughput (MB/s) and peak memory (MB, traced Python allocations) are
+written as json and compared with a stored baseline. Peak memory needs
+tracemalloc (Python 3.4 or later) and is None without it.
+
+Usage:
+   python -m qtc.benchtools                       # sample outputs only
+   python -m qtc.benchtools -s 10 100 1000        # also 10, 100 and 1000 MB outputs
+   python -m qtc.benchtools -o bench.json         # write the results
+   python -m qtc.benchtools --save                # replace the baseline
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import tempfile
+import time
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+from . import iotools as io
+from . import patools as pa
+from . import qctools as qc
+from . import scantools as st
+
+sampledir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sample_logfiles')
+baselinefile = os.path.join(sampledir, 'benchmark_baseline.json')
+
+"""
+Extractors timed for each package, as {package: [(name, function)]}.
+function(s, filename) is called with the output text s and its path.
+"""
+common_extractors = [
+    ('qc.get_output_package', lambda s, f: qc.get_output_package(s)),
+    ('qc.check_output(file)', lambda s, f: qc.check_output(f, filename=True)),
+    ('qc.get_output_status(file)', lambda s, f: qc.get_output_status(f, filename=True)),
+    ('st.scan_output', lambda s, f: st.scan_output(s)),
+    ('qc.parse_output', lambda s, f: qc.parse_output(s, 'bench')),
+]
+
+extractors = {
+    'gaussian': [
+        ('pa.gaussian_energy', lambda s, f: pa.gaussian_energy(s)),
+        ('pa.gaussian_zpve', lambda s, f: pa.gaussian_zpve(s)),
+        ('pa.read_last_value[gaussian_zpve]', lambda s, f: pa.read_last_value(pa.gaussian_zpve, f)),
+        ('pa.gaussian_xyz', lambda s, f: pa.gaussian_xyz(s)),
+        ('pa.gaussian_freqs', lambda s, f: pa.gaussian_freqs(s)),
+        ('pa.gaussian_hessian', lambda s, f: pa.gaussian_hessian(s)),
+        ('pa.read_hessian[gaussian]', lambda s, f: pa.read_hessian(pa.gaussian_hessian(s))),
+        ('pa.gaussian_rotconsts', lambda s, f: pa.gaussian_rotconsts(s)),
+    ] + common_extractors,
+    'molpro': [
+        ('pa.molpro_energy', lambda s, f: pa.molpro_energy(s)),
+        ('pa.molpro_zpve', lambda s, f: pa.molpro_zpve(s)),
+        ('pa.molpro_xyz', lambda s, f: pa.molpro_xyz(s)),
+        ('pa.molpro_hessian', lambda s, f: pa.molpro_hessian(s)),
+        ('pa.read_hessian[molpro]', lambda s, f: pa.read_hessian(pa.molpro_hessian(s))),
+        ('pa.molpro_rotconsts', lambda s, f: pa.molpro_rotconsts(s)),
+    ] + common_extractors,
+}
+
+"""
+Markers of the blocks replicated in synthetic outputs, as
+{package: (block marker, end marker)}. The text from the first to the last
+block marker (optimization cycles) is replicated, or from the block marker
+to the end marker (frequency block) if there is a single block.
+"""
+scale_markers = {
+    'gaussian': ('orientation:', ' Normal termination'),
+    'molpro'  : ('PROGRAM *', 'Variable memory released'),
+}
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmarks for the qc output parsers')
+    parser.add_argument('-s', '--sizes', type=float, nargs='*', default=[],
+                        help='Sizes in MB of synthetic outputs, e.g. 10 100 1000')
+    parser.add_argument('-n', '--nrepeat', type=int, default=3,
+                        help='Number of timings for each extractor, the fastest one is reported')
+    parser.add_argument('-o', '--output', type=str, default='',
+                        help='Json file for the results')
+    parser.add_argument('-b', '--baseline', type=str, default=baselinefile,
+                        help='Json file of the baseline results')
+    parser.add_argument('-t', '--tolerance', type=float, default=1.25,
+                        help='Time ratio to the baseline reported as a regression')
+    parser.add_argument('--save', action='store_true',
+                        help='Write the results to the baseline file')
+    parser.add_argument('--nomemory', action='store_true',
+                        help='Skip peak memory measurements')
+    parser.add_argument('--tmpdir', type=str, default=tempfile.gettempdir(),
+                        help='Directory for synthetic outputs')
+    return parser.parse_args()
+
+
+def get_scale_block(s, package):
+    """
+    Returns (start, end), the position of the block of the output text s
+    that is replicated in synthetic outputs, see scale_markers.
+    Returns None if there is no block to replicate.
+    """
+    if package not in scale_markers:
+        return None
+    marker, endmarker = scale_markers[package]
+    start = s.find(marker)
+    if start < 0:
+        return None
+    start = s.rfind('\n', 0, start) + 1
+    end = s.rfind(marker)
+    end = s.rfind('\n', 0, end) + 1
+    if end <= start:
+        end = s.rfind(endmarker)
+        end = s.rfind('\n', 0, end) + 1
+    if end <= start:
+        return None
+    return start, end
+
+
+def write_scaled_output(s, package, size, filename):
+    """
+    Writes a synthetic output of about size MB to filename by replicating a
+    block of the output text s, see get_scale_block.
+    Returns False if s has no block to replicate.
+    """
+    block = get_scale_block(s, package)
+    if block is None:
+        return False
+    start, end = block
+    nbytes = int(size * 1024 * 1024)
+    ncopy = max(1, (nbytes - len(s)) // (end - start) + 1)
+    with open(filename, 'w') as f:
+        f.write(s[:start])
+        for i in range(ncopy):
+            f.write(s[start:end])
+        f.write(s[start:])
+    return True
+
+
+def measure(function, nrepeat=3, memory=True):
+    """
+    Returns (time, peak), the fastest of nrepeat timings of function() in
+    seconds, and the peak memory in MB allocated by it during one extra call.
+    peak is None if memory is False or tracemalloc is not available.
+    """
+    times = []
+    for i in range(nrepeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    peak = None
+    if memory and tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            function()
+            peak = tracemalloc.get_traced_memory()[1] / 1024. / 1024.
+        finally:
+            tracemalloc.stop()
+    return min(times), peak
+
+
+def run_benchmark(filename, nrepeat=3, memory=True, label=None):
+    """
+    Returns a list of results for the extractors of the package of the output
+    in filename. Each result is a dictionary with file, package, size_mb,
+    extractor, time_s, mb_per_s and peak_mb keys, or an error key.
+    """
+    label = label or os.path.basename(filename)
+    s = io.read_file(filename, aslines=False)
+    size = os.path.getsize(filename) / 1024. / 1024.
+    package = qc.get_output_package(s)
+    results = []
+    for name, extractor in extractors.get(package, common_extractors):
+        result = {'file': label, 'package': package, 'size_mb': round(size, 3), 'extractor': name}
+        try:
+            t, peak = measure(lambda: extractor(s, filename), nrepeat, memory)
+            result['time_s'] = t
+            result['mb_per_s'] = size / t if t > 0 else float('inf')
+            result['peak_mb'] = peak
+        except Exception as e:
+            result['error'] = '{}: {}'.format(type(e).__name__, e)
+        results.append(result)
+        logging.info('{:40s} {:32s} {}'.format(label, name, result.get('time_s', result.get('error'))))
+    return results
+
+
+def compare_baseline(results, baseline, tolerance=1.25):
+    """
+    Returns a list of (file, extractor, time, baseline time, ratio) for the
+    results that are in the baseline, with the ratio of the times.
+    Prints the comparison and marks ratios larger than tolerance.
+    """
+    reference = {(r['file'], r['extractor']): r['time_s'] for r in baseline['results'] if 'time_s' in r}
+    comparison = []
+    for r in results:
+        key = (r['file'], r['extractor'])
+        if key in reference and 'time_s' in r and reference[key] > 0:
+            ratio = r['time_s'] / reference[key]
+            comparison.append((key[0], key[1], r['time_s'], reference[key], ratio))
+    print('{:40s} {:32s} {:>10s} {:>10s} {:>7s}'.format('File', 'Extractor', 'Time', 'Baseline', 'Ratio'))
+    for label, name, t, t0, ratio in comparison:
+        flag = '  REGRESSION' if ratio > tolerance else ''
+        print('{:40s} {:32s} {:10.5f} {:10.5f} {:7.2f}{}'.format(label, name, t, t0, ratio, flag))
+    return comparison
+
+
+def get_samples():
+    """
+    Returns the paths of the outputs in sample_logfiles.
+    """
+    return sorted(os.path.join(sampledir, f) for f in os.listdir(sampledir) if f.endswith('.out'))
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(format='%(message)s', level=logging.WARNING)
+    memory = not args.nomemory
+    if memory and tracemalloc is None:
+        logging.warning('tracemalloc is not available, peak memory is not measured')
+    results = []
+    for sample in get_samples():
+        results.extend(run_benchmark(sample, args.nrepeat, memory))
+        s = io.read_file(sample, aslines=False)
+        package = qc.get_output_package(s)
+        for size in args.sizes:
+            label = '{}MB_{}'.format(int(size), os.path.basename(sample))
+            filename = os.path.join(args.tmpdir, 'qtc_bench_' + label)
+            if not write_scaled_output(s, package, size, filename):
+                continue
+            try:
+                results.extend(run_benchmark(filename, args.nrepeat, memory, label))
+            finally:
+                os.remove(filename)
+    report = {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'python': platform.python_version(),
+              'machine': platform.platform(),
+              'processor': platform.processor(),
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    if io.check_file(args.baseline) and not args.save:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        compare_baseline(results, baseline, args.tolerance)
+    else:
+        for r in results:
+            print('{:40s} {:32s} {}'.format(r['file'], r['extractor'],
+                  '{:10.5f} s {:10.2f} MB/s'.format(r['time_s'], r['mb_per_s']) if 'time_s' in r else r['error']))
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=1)
+        print('Baseline written to {}'.format(args.baseline))
+    return
+
+
+if __name__ == "__main__":
+    main()
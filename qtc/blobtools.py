@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""
+Content-addressed blob store for qc inputs and outputs.
+
+A file is stored once as a gzip compressed blob named by the sha256 hash of
+its content, blobs/ab/abcdef....gz in the database directory, and replaced
+in its run directory by a relative symbolic link to the blob. Byte-identical
+outputs, e.g. reruns or the same species under different labels, share one
+blob. iotools.read_file and the head/tail readers decompress blobs
+transparently, and zcat or zless can read them.
+Blobs are read-only. iotools.write_file and qctools.run remove the link
+before a file is written again (see unlink_file), so that a rerun writes a
+new file and never the blob shared with other files.
+
+Usage:
+   python -m qtc.blobtools store database       # store outputs and inputs
+   python -m qtc.blobtools restore database     # replace links with files
+   python -m qtc.blobtools --test               # run the doctests
+"""
+import argparse
+import fnmatch
+import gzip
+import logging
+import os
+import shutil
+import sys
+from . import iotools as io
+
+# Files moved to the blob store
+blob_patterns = ['*.out', '*.log', '*.inp', '*.com', '*.fchk', '*.xml']
+
+blob_dirname = 'blobs'
+
+
+def get_blob_dir(database):
+    """
+    Returns the blob directory of a database directory.
+    """
+    return io.join_path(database, blob_dirname)
+
+
+def get_blob_path(blobdir, digest):
+    """
+    Returns the path of the blob for a sha256 hex digest.
+    >>> get_blob_path('blobs', 'abcdef')
+    'blobs/ab/abcdef.gz'
+    """
+    return io.join_path(blobdir, digest[:2], digest + '.gz')
+
+
+def is_blob_link(filename):
+    """
+    Returns True if filename is a link to a blob.
+    """
+    return os.path.islink(filename) and os.path.dirname(os.path.dirname(os.readlink(filename))).endswith(blob_dirname)
+
+
+def store_file(filename, blobdir, level=6):
+    """
+    Stores a file in the blob directory blobdir and replaces it with a
+    relative symbolic link to its blob.
+    Returns (size, compressed size, new), where new is False if the blob
+    already existed, or None if filename is already a link to a blob.
+    The blob is written to a temporary file first, so that a partial blob
+    is never used. Files already compressed (see io.compress_file) are
+    stored as they are, and read_file still decompresses them.
+    """
+    if is_blob_link(filename):
+        return None
+    digest = io.get_file_hash(filename, algorithm='sha256')
+    blob = get_blob_path(blobdir, digest)
+    size = os.path.getsize(filename)
+    new = not os.path.isfile(blob)
+    if new:
+        io.mkdir(os.path.dirname(blob))
+        tmpblob = '{}.{}.tmp'.format(blob, os.getpid())
+        if io.get_compression(filename):
+            shutil.copyfile(filename, tmpblob)
+        else:
+            with open(filename, 'rb') as fin, gzip.open(tmpblob, 'wb', compresslevel=level) as fout:
+                shutil.copyfileobj(fin, fout, 1048576)
+        os.chmod(tmpblob, 0o444)
+        os.rename(tmpblob, blob)
+    tmplink = '{}.{}.tmp'.format(filename, os.getpid())
+    os.symlink(os.path.relpath(blob, os.path.dirname(os.path.abspath(filename))), tmplink)
+    os.rename(tmplink, filename)
+    return size, os.path.getsize(blob), new
+
+
+def restore_file(filename):
+    """
+    Replaces a link to a blob with a decompressed copy of the blob.
+    """
+    if not is_blob_link(filename):
+        return
+    tmpfile = '{}.{}.tmp'.format(filename, os.getpid())
+    with io.open_file(filename, 'rb') as fin, open(tmpfile, 'wb') as fout:
+        shutil.copyfileobj(fin, fout, 1048576)
+    os.rename(tmpfile, filename)
+    return
+
+
+def unlink_file(filename, keep=False):
+    """
+    Removes filename if it is a link to a blob, so that writing it creates a
+    new file instead of writing into the blob. With keep=True the link is
+    replaced by a copy of the blob instead, e.g. before appending to it.
+    Returns True if filename was a link to a blob.
+    >>> import tempfile
+    >>> db = tempfile.mkdtemp()
+    >>> inpfiles = [io.join_path(db, 'C2H6', name, 'C2H6.inp') for name in ['CC_m1', 'CC_m1b']]
+    >>> for inpfile in inpfiles:
+    ...     io.mkdir(os.path.dirname(inpfile))
+    ...     io.write_file('input', inpfile)
+    >>> store_tree(db)['unique files']
+    1
+    >>> io.write_file('new input', inpfiles[0])
+    >>> io.read_file(inpfiles[0]), io.read_file(inpfiles[1]), is_blob_link(inpfiles[0])
+    ('new input', 'input', False)
+    >>> io.append_file(' appended', inpfiles[1])
+    >>> io.read_file(inpfiles[1]), len(os.listdir(io.join_path(db, blob_dirname)))
+    ('input appended', 1)
+    >>> io.rmrf(db)
+    """
+    if not is_blob_link(filename):
+        return False
+    if keep:
+        restore_file(filename)
+    else:
+        os.unlink(filename)
+    return True
+
+
+def yield_blob_files(database, patterns=blob_patterns):
+    """
+    Yields the files in a database directory matching patterns, skipping the
+    blob directory.
+    """
+    blobdir = os.path.abspath(get_blob_dir(database))
+    for dirpath, dirnames, filenames in os.walk(database):
+        if os.path.abspath(dirpath) == blobdir:
+            dirnames[:] = []
+            continue
+        for name in filenames:
+            if any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+                yield os.path.join(dirpath, name)
+
+
+def store_tree(database, patterns=blob_patterns, level=6):
+    """
+    Stores the files in a database directory matching patterns in its blob
+    directory, see store_file.
+    Returns a dictionary with the number of files, their total size, the
+    size of the new unique files and of their blobs, and the dedup ratio.
+    """
+    blobdir = get_blob_dir(database)
+    report = {'files': 0, 'bytes': 0, 'unique files': 0, 'unique bytes': 0, 'blob bytes': 0}
+    for filename in yield_blob_files(database, patterns):
+        result = store_file(filename, blobdir, level)
+        if result is None:
+            continue
+        size, blobsize, new = result
+        report['files'] += 1
+        report['bytes'] += size
+        if new:
+            report['unique files'] += 1
+            report['unique bytes'] += size
+            report['blob bytes'] += blobsize
+    if report['unique bytes']:
+        report['dedup ratio'] = float(report['bytes']) / report['unique bytes']
+        report['compression ratio'] = float(report['unique bytes']) / max(report['blob bytes'], 1)
+    report['saved bytes'] = report['bytes'] - report['blob bytes']
+    return report
+
+
+def restore_tree(database, patterns=blob_patterns):
+    """
+    Replaces the links to blobs in a database directory with files.
+    Blobs are not removed.
+    Returns the number of restored files.
+    """
+    n = 0
+    for filename in yield_blob_files(database, patterns):
+        if is_blob_link(filename):
+            restore_file(filename)
+            n += 1
+    return n
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Content-addressed blob store for a qtc database')
+    parser.add_argument('action', choices=['store', 'restore'],
+                        help='store: move files to blobs, restore: replace links with files')
+    parser.add_argument('database', type=str,
+                        help='Database directory')
+    parser.add_argument('-p', '--patterns', type=str, nargs='*', default=blob_patterns,
+                        help='File name patterns, default: {}'.format(' '.join(blob_patterns)))
+    parser.add_argument('-l', '--level', type=int, default=6,
+                        help='gzip compression level')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    if args.action == 'store':
+        report = store_tree(args.database, args.patterns, args.level)
+        for key, value in report.items():
+            print('{:20s} {}'.format(key, value))
+    else:
+        print('Restored {} files'.format(restore_tree(args.database, args.patterns)))
+    return
+
+
+if __name__ == "__main__":
+    if '--test' in sys.argv:
+        import doctest
+        doctest.testmod(verbose=True)
+    else:
+        main()
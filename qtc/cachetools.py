@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+"""
+Node-local read-through cache for result files of a shared database.
+
+Result files read with iotools.read_result (.ene, .zpve, .hofk, ... of the
+species and the reference species) are copied to a cache directory on
+node-local storage the first time they are read, and later reads are
+served from the copy. Writes with iotools.write_result go to the shared
+file and update the copy (write-through).
+A copy keeps the modification time of the shared file and is valid while
+the shared file has the same size and modification time. If only the
+modification time changed, the content hashes are compared before the copy
+is replaced. With ttl > 0 the shared file is checked at most once every ttl
+seconds by each process, so that repeated reads do not touch the shared
+file system at all.
+The cache is bounded to maxsize bytes; the least recently read copies are
+evicted first. The cache directory can be shared by the ranks on a node.
+
+Usage:
+   python -m qtc.cachetools info /tmp/qtc_cache
+   python -m qtc.cachetools clear /tmp/qtc_cache
+   python -m qtc.cachetools --test    # run the doctests
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+from . import iotools as io
+
+default_dir = io.join_path(tempfile.gettempdir(), 'qtc_cache')
+
+# The active cache, see set_cache
+cache = {'dir': None, 'maxsize': 0, 'ttl': 0, 'size': 0}
+
+# Time of the last check of each shared file, for ttl
+_checked = {}
+
+# Counts of reads served from the cache (hits), from the shared file system
+# (misses) and of evicted copies
+stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+def set_cache(cachedir=default_dir, maxsize=1024, ttl=0):
+    """
+    Sets the node-local cache directory cachedir with a size limit of
+    maxsize MB. Shared files are checked at most once every ttl seconds.
+    """
+    cachedir = os.path.abspath(cachedir)
+    io.mkdir(cachedir)
+    cache['dir'] = cachedir
+    cache['maxsize'] = int(maxsize * 1024 * 1024)
+    cache['ttl'] = ttl
+    cache['size'] = get_cache_size(cachedir)
+    logging.info('Cache: {} ({:.1f} of {} MB used)'.format(cachedir, cache['size'] / 1048576., maxsize))
+    return cachedir
+
+
+def unset_cache():
+    """
+    Stops using the cache. Copies are not removed.
+    """
+    cache['dir'] = None
+    _checked.clear()
+    return
+
+
+def get_cache_path(filename, cachedir=None):
+    """
+    Returns the path of the copy of a shared file in the cache directory.
+    >>> get_cache_path('/db/C2H6/CC_m1/C2H6.ene', '/tmp/cache')
+    '/tmp/cache/db/C2H6/CC_m1/C2H6.ene'
+    """
+    cachedir = cachedir or cache['dir']
+    return io.join_path(cachedir, os.path.abspath(filename).lstrip(os.sep))
+
+
+def get_cache_size(cachedir):
+    """
+    Returns the total size in bytes of the copies in cachedir.
+    """
+    return sum(size for path, size, atime in yield_copies(cachedir))
+
+
+def yield_copies(cachedir):
+    """
+    Yields (path, size, atime) for the copies in cachedir.
+    """
+    for dirpath, dirnames, filenames in os.walk(cachedir):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            yield path, stat.st_size, stat.st_atime
+
+
+def write_copy(filename, mtime):
+    """
+    Copies a shared file to the cache with the modification time mtime of
+    the shared file, evicting old copies if needed.
+    Returns the path of the copy.
+    """
+    import shutil
+    copy = get_cache_path(filename)
+    old = os.path.getsize(copy) if os.path.isfile(copy) else 0
+    io.mkdir(os.path.dirname(copy))
+    tmpfile = '{}.{}.tmp'.format(copy, os.getpid())
+    shutil.copyfile(filename, tmpfile)
+    os.utime(tmpfile, (time.time(), mtime))
+    os.rename(tmpfile, copy)
+    cache['size'] += os.path.getsize(copy) - old
+    if cache['size'] > cache['maxsize']:
+        evict()
+    return copy
+
+
+def evict(fraction=0.8):
+    """
+    Removes the least recently read copies until the cache is below
+    fraction of its size limit.
+    """
+    copies = sorted(yield_copies(cache['dir']), key=lambda copy: copy[2])
+    size = sum(copy[1] for copy in copies)
+    for path, nbytes, atime in copies:
+        if size <= fraction * cache['maxsize']:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        size -= nbytes
+        stats['evictions'] += 1
+    cache['size'] = size
+    return
+
+
+def read_through(filename):
+    """
+    Returns the content of a shared file from its copy in the cache, after
+    copying it there if the copy is missing or outdated.
+    Returns None if there is no cache or the shared file does not exist.
+    >>> import importlib
+    >>> ct = importlib.import_module('qtc.cachetools')
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> filename = io.join_path(tmpdir, 'db', 'C2H6.ene')
+    >>> io.mkdir(os.path.dirname(filename))
+    >>> io.write_file('-79.8', filename)
+    >>> cachedir = ct.set_cache(io.join_path(tmpdir, 'cache'))
+    >>> io.read_result(filename), os.path.isfile(ct.get_cache_path(filename))
+    ('-79.8', True)
+    >>> io.write_result('-79.9', filename)
+    >>> io.read_result(filename), io.read_file(ct.get_cache_path(filename))
+    ('-79.9', '-79.9')
+    >>> io.write_file('-79.85', filename)
+    >>> io.read_result(filename)
+    '-79.85'
+    >>> ct.unset_cache()
+    >>> io.rmrf(tmpdir)
+    """
+    if cache['dir'] is None:
+        return None
+    copy = get_cache_path(filename)
+    now = time.time()
+    key = os.path.abspath(filename)
+    if cache['ttl'] > 0 and now - _checked.get(key, 0) < cache['ttl'] and os.path.isfile(copy):
+        stats['hits'] += 1
+        os.utime(copy, (now, os.path.getmtime(copy)))
+        return io.read_file(copy)
+    try:
+        shared = os.stat(filename)
+    except OSError:
+        return None
+    _checked[key] = now
+    if os.path.isfile(copy):
+        local = os.stat(copy)
+        valid = local.st_size == shared.st_size
+        if valid and local.st_mtime != shared.st_mtime:
+            valid = io.get_file_hash(copy) == io.get_file_hash(filename)
+        if valid:
+            stats['hits'] += 1
+            os.utime(copy, (now, shared.st_mtime))
+            return io.read_file(copy)
+    stats['misses'] += 1
+    return io.read_file(write_copy(filename, shared.st_mtime))
+
+
+def write_through(filename):
+    """
+    Updates the copy of a shared file that was just written.
+    """
+    if cache['dir'] is None:
+        return
+    try:
+        mtime = os.path.getmtime(filename)
+    except OSError:
+        return
+    write_copy(filename, mtime)
+    _checked[os.path.abspath(filename)] = time.time()
+    return
+
+
+def invalidate(filename):
+    """
+    Removes the copy of a shared file.
+    """
+    if cache['dir'] is None:
+        return
+    io.rm(get_cache_path(filename))
+    _checked.pop(os.path.abspath(filename), None)
+    return
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Node-local read-through cache of a qtc database')
+    parser.add_argument('action', choices=['info', 'clear'],
+                        help='info: number and size of copies, clear: remove all copies')
+    parser.add_argument('cachedir', type=str, nargs='?', default=default_dir,
+                        help='Cache directory, default: {}'.format(default_dir))
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    copies = list(yield_copies(args.cachedir))
+    if args.action == 'info':
+        print('{} copies, {:.3f} MB'.format(len(copies), sum(copy[1] for copy in copies) / 1048576.))
+    else:
+        for path, size, atime in copies:
+            os.remove(path)
+        print('Removed {} copies'.format(len(copies)))
+    return
+
+
+if __name__ == "__main__":
+    if '--test' in sys.argv:
+        import doctest
+        doctest.testmod(verbose=True)
+    else:
+        main()
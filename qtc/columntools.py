@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+"""
+Columnar export of qtc results.
+
+The results of a run, {slabel: {qlabel: results}} as in
+parameters['all results'], a qtc json dump, or a json lines stream (see
+dbtools.load_results_stream), are written as columns with one row per
+slabel and qlabel:
+  slabel, qlabel       species and calculation labels
+  scalar columns       float values such as energy, zpve, deltaH0, deltaH298,
+                       string values such as path, as in the results
+  freqs, afreqs        ragged frequency arrays, stored as the flat values and
+                       the row offsets (name_values, name_offsets)
+  nasa_coeffs          NASA polynomial coefficients, shape (nrow, 2, 7), low
+                       and high temperature ranges, NaN for missing rows
+  nasa_temps           Tmin, Tmax of the two ranges, shape (nrow, 4)
+The columns are written to Parquet (pyarrow), HDF5 (h5py), or a compressed
+numpy .npz file, which needs no optional package. get_cp, get_h and get_s
+evaluate the NASA polynomials of all rows at once.
+
+Usage:
+   python -m qtc.columntools qtc_thermo.json -o results.parquet
+   python -m qtc.columntools 'qtc_results_*.jsonl' -o results.npz
+"""
+import argparse
+import importlib
+import json
+import logging
+import os
+import numpy as np
+from . import dbtools as db
+from . import unittools as ut
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+# Results stored as ragged array columns
+array_keys = ['freqs', 'afreqs']
+
+# Results that are not exported, large texts and nested data
+skip_keys = ['Hessian', 'xmat', 'chemkin', 'partition function', 'NASAPolynomial', 'xyz', 'geo', 'zmat',
+             'hindered potential', 'output', 'arrays', 'energies']
+
+formats = {'.parquet': 'parquet', '.h5': 'hdf5', '.hdf5': 'hdf5', '.npz': 'npz'}
+# optional packages by format
+packages = {'parquet': 'pyarrow', 'hdf5': 'h5py'}
+
+
+def get_nasa_arrays(rmgpoly):
+    """
+    Returns (coeffs, temps) arrays of shape (2, 7) and (4,) for a NASA
+    polynomial in RMG format, see tctools.get_rmg_polynomial.
+    """
+    coeffs = np.full((2, 7), np.nan)
+    temps = np.full(4, np.nan)
+    for i, poly in enumerate(rmgpoly['polynomials'][:2]):
+        coeffs[i, :len(poly['coeffs'][:7])] = poly['coeffs'][:7]
+        temps[2 * i] = poly['Tmin'][0]
+        temps[2 * i + 1] = poly['Tmax'][0]
+    return coeffs, temps
+
+
+def get_columns(allresults):
+    """
+    Returns a dictionary of numpy arrays with the columns of allresults,
+    {slabel: {qlabel: results}}, which can be a StreamedResults mapping.
+    Species are read one at a time.
+    >>> columns = get_columns({'CC': {'opt': {'energy': -79.8, 'path': u'db/C2H6', 'freqs': [300., 1000.]}}})
+    >>> columns['energy'].tolist(), columns['path'].tolist(), get_array(columns, 'freqs', 0).tolist()
+    ([-79.8], ['db/C2H6'], [300.0, 1000.0])
+    """
+    slabels, qlabels = [], []
+    scalars = {}
+    arrays = dict((key, ([], [0])) for key in array_keys)
+    coeffs, temps = [], []
+    for slabel in allresults:
+        for qlabel, results in allresults[slabel].items():
+            if not isinstance(results, dict):
+                continue
+            i = len(slabels)
+            slabels.append(slabel)
+            qlabels.append(qlabel)
+            for key, val in results.items():
+                if key in skip_keys or key in array_keys:
+                    continue
+                if isinstance(val, bool) or val is None:
+                    continue
+                if isinstance(val, (int, float, np.integer, np.floating)):
+                    scalars.setdefault(key, {})[i] = float(val)
+                elif isinstance(val, string_types) and len(val) < 256:
+                    scalars.setdefault(key, {})[i] = val
+            for key in array_keys:
+                values, offsets = arrays[key]
+                val = results.get(key)
+                if val is not None and len(val) > 0:
+                    values.extend(float(v) for v in val)
+                offsets.append(len(values))
+            rmgpoly = results.get('NASAPolynomial')
+            if isinstance(rmgpoly, dict) and rmgpoly.get('polynomials'):
+                c, t = get_nasa_arrays(rmgpoly)
+            else:
+                c, t = np.full((2, 7), np.nan), np.full(4, np.nan)
+            coeffs.append(c)
+            temps.append(t)
+    n = len(slabels)
+    columns = {'slabel': np.array(slabels, dtype=str), 'qlabel': np.array(qlabels, dtype=str)}
+    for key, values in scalars.items():
+        if all(isinstance(v, float) for v in values.values()):
+            column = np.full(n, np.nan)
+        else:
+            column = np.full(n, '', dtype=object)
+        for i, v in values.items():
+            column[i] = v
+        if column.dtype == object:
+            column = column.astype(str)
+        columns[key] = column
+    for key, (values, offsets) in arrays.items():
+        columns[key + '_values'] = np.array(values, dtype=float)
+        columns[key + '_offsets'] = np.array(offsets, dtype=np.int64)
+    columns['nasa_coeffs'] = np.array(coeffs).reshape(n, 2, 7)
+    columns['nasa_temps'] = np.array(temps).reshape(n, 4)
+    return columns
+
+
+def get_array(columns, key, i):
+    """
+    Returns the ragged array key, e.g. 'freqs', of row i.
+    """
+    offsets = columns[key + '_offsets']
+    return columns[key + '_values'][offsets[i]:offsets[i + 1]]
+
+
+def get_format(filename, fmt=None):
+    """
+    Returns the format for filename, 'parquet', 'hdf5' or 'npz', from fmt or
+    the extension. Falls back to 'npz' if the package for the format is not
+    installed.
+    """
+    fmt = fmt or formats.get(os.path.splitext(filename)[1], 'npz')
+    try:
+        if fmt in packages:
+            importlib.import_module(packages[fmt])
+    except ImportError:
+        logging.warning('{} is not available, using npz'.format(fmt))
+        fmt = 'npz'
+    return fmt
+
+
+def write_columns(columns, filename, fmt=None):
+    """
+    Writes columns to filename in fmt, see get_format.
+    Returns the name of the written file, with the .npz extension for the
+    npz fallback.
+    """
+    fmt = get_format(filename, fmt)
+    if fmt == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        n = len(columns['slabel'])
+        table = {}
+        for key, column in columns.items():
+            if key.endswith('_offsets'):
+                name = key[:-len('_offsets')]
+                values = columns[name + '_values']
+                table[name] = pa.ListArray.from_arrays(pa.array(column, pa.int32()), pa.array(values))
+            elif key.endswith('_values'):
+                continue
+            elif column.ndim > 1:
+                table[key] = pa.array(list(column.reshape(n, -1)))
+            else:
+                table[key] = pa.array(column)
+        pq.write_table(pa.table(table), filename)
+    elif fmt == 'hdf5':
+        import h5py
+        with h5py.File(filename, 'w') as f:
+            for key, column in columns.items():
+                if column.dtype.kind == 'U':
+                    f.create_dataset(key, data=column.astype('S'), compression='gzip')
+                else:
+                    f.create_dataset(key, data=column, compression='gzip')
+    else:
+        if not filename.endswith('.npz'):
+            filename = os.path.splitext(filename)[0] + '.npz'
+        np.savez_compressed(filename, **columns)
+    logging.info('Written {} rows to {}'.format(len(columns['slabel']), filename))
+    return filename
+
+
+def read_columns(filename):
+    """
+    Returns the columns written by write_columns as a dictionary of numpy arrays.
+    """
+    fmt = formats.get(os.path.splitext(filename)[1], 'npz')
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        table = pq.read_table(filename)
+        columns = {}
+        n = table.num_rows
+        for key in table.column_names:
+            column = table.column(key).combine_chunks()
+            if key in array_keys:
+                columns[key + '_values'] = column.flatten().to_numpy(zero_copy_only=False).astype(float)
+                columns[key + '_offsets'] = column.offsets.to_numpy().astype(np.int64)
+            elif key == 'nasa_coeffs':
+                columns[key] = np.array(column.to_pylist(), dtype=float).reshape(n, 2, 7)
+            elif key == 'nasa_temps':
+                columns[key] = np.array(column.to_pylist(), dtype=float).reshape(n, 4)
+            else:
+                columns[key] = column.to_numpy(zero_copy_only=False)
+        return columns
+    elif fmt == 'hdf5':
+        import h5py
+        with h5py.File(filename, 'r') as f:
+            columns = dict((key, f[key][()]) for key in f)
+        for key, column in columns.items():
+            if column.dtype.kind == 'S':
+                columns[key] = column.astype(str)
+        return columns
+    with np.load(filename) as f:
+        return dict((key, f[key]) for key in f.files)
+
+
+def _select_coeffs(columns, T):
+    """
+    Returns the NASA coefficients of all rows for temperature T, from the
+    high temperature range if T is in it, as in tctools.get_heat_capacity.
+    Rows without a polynomial for T are NaN.
+    """
+    coeffs = columns['nasa_coeffs']
+    temps = columns['nasa_temps']
+    high = (T >= temps[:, 2]) & (T <= temps[:, 3])
+    low = (T >= temps[:, 0]) & (T <= temps[:, 1])
+    a = np.where(high[:, None], coeffs[:, 1], coeffs[:, 0])
+    a[~(high | low)] = np.nan
+    return a.T
+
+
+def get_cp(columns, T):
+    """
+    Returns the heat capacities in cal/mol/K of all rows at temperature T,
+    see tctools.get_heat_capacity.
+    """
+    a = _select_coeffs(columns, T)
+    return (a[0] + a[1] * T + a[2] * T**2 + a[3] * T**3 + a[4] * T**4) * ut.Rinkcal
+
+
+def get_h(columns, T):
+    """
+    Returns the enthalpies in kcal/mol of all rows at temperature T,
+    see tctools.get_enthalpy.
+    """
+    a = _select_coeffs(columns, T)
+    h = a[0] + a[1] * T / 2 + a[2] * T**2 / 3. + a[3] * T**3 / 4. + a[4] * T**4 / 5 + a[5] / T
+    return h * ut.Rinkcal * T / 1000.
+
+
+def get_s(columns, T):
+    """
+    Returns the entropies in cal/mol/K of all rows at temperature T,
+    see tctools.get_entropy.
+    """
+    a = _select_coeffs(columns, T)
+    s = a[0] * np.log(T) + a[1] * T + a[2] * T**2 / 2. + a[3] * T**3 / 3. + a[4] * T**4 / 4 + a[6]
+    return s * ut.Rinkcal
+
+
+def load_results(filename):
+    """
+    Returns {slabel: {qlabel: results}} from a qtc json dump (thermo or
+    harvest), or a StreamedResults mapping for json lines files.
+    """
+    if filename.endswith('.jsonl') or not os.path.isfile(filename):
+        return db.load_results_stream(filename)
+    with open(filename) as f:
+        d = json.load(f)
+    if 'all results' in d:
+        d = d['all results']
+    return d
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Columnar export of qtc results')
+    parser.add_argument('input', type=str,
+                        help='qtc json dump, or json lines file(s) from --stream (glob pattern allowed)')
+    parser.add_argument('-o', '--output', type=str, default='qtc_results.parquet',
+                        help='Output file, .parquet, .h5 or .npz; npz is used if the package is missing')
+    parser.add_argument('-f', '--format', type=str, default=None, choices=['parquet', 'hdf5', 'npz'],
+                        help='Output format, default from the extension')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    columns = get_columns(load_results(args.input))
+    write_columns(columns, args.output, args.format)
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,10 @@ Requires:
 pymongo
 You need to start a mongo session first with:
 mongod --logpath /Volumes/s/G/database_mongo/log --fork --dbpath /Volumes/s/G/database_mongo/
+Results are upserted in batches with:
+python -m qtc.dbtools qtc_results_*.jsonl --db qtc -c results
+The doctests are run with:
+python -m qtc.dbtools --test
 """
 __updated__ = "2018-04-13"
 try:
@@ -15,6 +19,15 @@ import json
 import logging
 import sys
 import os
+import time
+from collections import OrderedDict
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping
+
+# MongoClients by host, see get_client
+clients = {}
 
 def start_mongo(dbpath,logpath,mongoexe='mongod'):
     """
@@ -25,10 +38,34 @@ def start_mongo(dbpath,logpath,mongoexe='mongod'):
     return
 
 
-def get_database(db='mydatabase'):
-    from pymongo import MongoClient
-    client = MongoClient()
-    return client[db]
+def get_client(host=None):
+    """
+    Returns a MongoClient for host, e.g. 'mongodb://localhost:27017', reused
+    by later calls with the same host.
+    host='mongomock' returns an in-process stand-in (requires mongomock),
+    for testing without mongod.
+    """
+    if host not in clients:
+        if host == 'mongomock':
+            import mongomock
+            clients[host] = mongomock.MongoClient()
+        else:
+            clients[host] = MongoClient(host)
+    return clients[host]
+
+
+def close_clients():
+    """
+    Closes the clients returned by get_client.
+    """
+    for client in clients.values():
+        client.close()
+    clients.clear()
+    return
+
+
+def get_database(db='mydatabase', host=None):
+    return get_client(host)[db]
 
 
 def get_collection(db='mydatabase',collection='mycollection'):
@@ -41,6 +78,98 @@ def insert_entry(db,entry,efilter=None,upsert=True):
     return db.replace_one(efilter, entry, upsert=upsert)
 
 
+def get_filter(entry, keys=None):
+    """
+    Returns the filter that identifies entry, the values of keys, or the
+    entry itself as in insert_entry.
+    >>> get_filter({'slabel': 'C_m1', 'qlabel': 'opt/b3lyp', 'results': {}}, ['slabel', 'qlabel'])
+    {'slabel': 'C_m1', 'qlabel': 'opt/b3lyp'}
+    """
+    if keys is None:
+        return entry
+    return dict((key, entry[key]) for key in keys)
+
+
+def write_batch(collection, requests, retries=3, wait=1.):
+    """
+    Sends a list of write requests to collection with one bulk_write.
+    Retries up to retries times, waiting wait, 2*wait, ... seconds, if the
+    connection fails. Requests are replacements by filter, so a batch
+    that was partly written before the failure can be sent again. The
+    batch is ordered, so that the last of two entries with the same filter
+    is kept.
+    Returns the BulkWriteResult.
+    """
+    from pymongo.errors import AutoReconnect
+    for i in range(retries + 1):
+        try:
+            return collection.bulk_write(requests, ordered=True)
+        except AutoReconnect as e:
+            if i == retries:
+                raise
+            logging.warning('Bulk write of {} entries failed: {}, retrying in {} s'.format(len(requests), e, wait * 2**i))
+            time.sleep(wait * 2**i)
+
+
+def bulk_upsert(collection, entries, keys=None, batchsize=1000, retries=3):
+    """
+    Upserts entries, an iterable of dictionaries, into collection with
+    batched bulk writes of batchsize entries, instead of one insert_entry
+    round trip for each entry. keys gives the fields that identify an entry,
+    see get_filter. Entries are consumed as they are sent, so entries can be
+    a generator, e.g. yield_result_entries.
+    Returns a dictionary with the numbers of entries, batches, matched,
+    modified and upserted documents.
+    """
+    import itertools
+    from pymongo import ReplaceOne
+    counts = {'entries': 0, 'batches': 0, 'matched': 0, 'modified': 0, 'upserted': 0}
+    entries = iter(entries)
+    while True:
+        batch = list(itertools.islice(entries, batchsize))
+        if not batch:
+            break
+        result = write_batch(collection, [ReplaceOne(get_filter(entry, keys), entry, upsert=True) for entry in batch], retries)
+        counts['entries'] += len(batch)
+        counts['batches'] += 1
+        counts['matched'] += result.matched_count
+        counts['modified'] += result.modified_count
+        counts['upserted'] += result.upserted_count
+    return counts
+
+
+def yield_result_entries(filename):
+    """
+    Yields {'slabel', 'qlabel', 'time', 'results'} entries of a results file,
+    either a json lines file written by append_results (qtc --stream), read
+    one line at a time, or a json file {slabel: {qlabel: results}} written
+    by qtc --dumpjsonfile or --harvest.
+    """
+    if filename.endswith('.jsonl'):
+        for offset, record in yield_jsonl(filename):
+            yield record
+    else:
+        t = os.path.getmtime(filename)
+        for slabel, sresults in load_json(filename).items():
+            for qlabel, results in sresults.items():
+                yield {'slabel': slabel, 'qlabel': qlabel, 'time': t, 'results': results}
+
+
+def ingest_results(collection, filenames, batchsize=1000, retries=3):
+    """
+    Upserts the results in filenames, see yield_result_entries, into
+    collection, one document for each slabel and qlabel.
+    Returns the counts of bulk_upsert.
+    """
+    import itertools
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    entries = itertools.chain.from_iterable(yield_result_entries(filename) for filename in filenames)
+    counts = bulk_upsert(collection, entries, ['slabel', 'qlabel'], batchsize, retries)
+    logging.info('Upserted {entries} entries in {batches} batches: {upserted} new, {modified} modified'.format(**counts))
+    return counts
+
+
 def load_json(jsonfile):
     """
     Opens and loads a .json file. 
@@ -53,11 +182,15 @@ def load_json(jsonfile):
 def dump_json(d, filename):
     """
     Given a dictionary d and a string specifying a filename,
-    writes the dictionary as a json file
+    writes the dictionary as a json file.
+    A mapping such as SpillResults is written one item at a time.
     """
     try:
         with open(filename, 'w') as f:
-            json.dump(d, f, ensure_ascii=False, indent=2)
+            if isinstance(d, Mapping) and not isinstance(d, dict):
+                write_json_mapping(d, f)
+            else:
+                json.dump(d, f, ensure_ascii=False, indent=2, default=json_default)
     except Exception as e:
         logging.error('Error in dumping json file')
         exc_type, exc_obj, exc_tb = sys.exc_info()
@@ -66,6 +199,242 @@ def dump_json(d, filename):
     return
 
 
+def json_default(obj):
+    """
+    Converts numpy arrays and scalars, and mappings such as SpillResults,
+    for json.dump(s). Raises TypeError for other objects, as json does.
+    >>> import numpy as np
+    >>> json.dumps([np.array([300., 1000.]), np.int64(3)], default=json_default)
+    '[[300.0, 1000.0], 3]'
+    >>> json.dumps([object()], default=json_default)
+    Traceback (most recent call last):
+        ...
+    TypeError: Object of type object is not JSON serializable
+    """
+    if type(obj).__module__ == 'numpy' and hasattr(obj, 'tolist'):
+        return obj.tolist()
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+
+def write_json_mapping(d, f):
+    """
+    Writes a mapping to the open file f in the format of dump_json, loading
+    one value at a time.
+    """
+    f.write('{')
+    for i, (key, val) in enumerate(d.items()):
+        item = json.dumps(val, ensure_ascii=False, indent=2, default=json_default)
+        f.write('{}\n  {}: {}'.format(',' if i else '', json.dumps(key, ensure_ascii=False), item.replace('\n', '\n  ')))
+    f.write('\n}' if d else '}')
+    return
+
+
+def append_jsonl(record, filename, fsync=False):
+    """
+    Appends a dictionary as a single json line to filename.
+    The line is flushed when the file is closed; with fsync it is also
+    written to disk.
+    """
+    line = json.dumps(record, ensure_ascii=False, default=json_default) + '\n'
+    with open(filename, 'a') as f:
+        f.write(line)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    return
+
+
+def append_results(slabel, qlabel, results, filename, fsync=False):
+    """
+    Appends the results of a calculation, parameters['all results'][slabel][qlabel],
+    to the json lines file filename, see load_results_stream.
+    """
+    append_jsonl({'slabel': slabel, 'qlabel': qlabel, 'time': time.time(), 'results': results},
+                 filename, fsync)
+    return
+
+
+def yield_jsonl(filename):
+    """
+    Yields (offset, record) for the json lines in filename.
+    A last line that is incomplete, e.g. cut by a crash, is skipped.
+    """
+    offset = 0
+    with open(filename, 'rb') as f:
+        for line in f:
+            if line.endswith(b'\n') and line.strip():
+                try:
+                    yield offset, json.loads(line.decode('utf-8'))
+                except ValueError:
+                    logging.warning('Skipping invalid json line at byte {} of {}'.format(offset, filename))
+            offset += len(line)
+
+
+class StreamedResults(Mapping):
+    """
+    Read-only mapping {slabel: {qlabel: results}}, in the shape of
+    parameters['all results'], of json lines files written by append_results.
+    filenames is a file name or a list of them, e.g. one file per rank.
+    The files are indexed when the mapping is created, and the results of a
+    species are read from the files when it is first accessed. The last
+    record of each slabel and qlabel is used.
+    dict(results) or get_dict() loads all species.
+    """
+    def __init__(self, filenames):
+        if isinstance(filenames, str):
+            filenames = [filenames]
+        self.filenames = filenames
+        self.index = {}
+        self.loaded = {}
+        records = []
+        for i, filename in enumerate(filenames):
+            for offset, record in yield_jsonl(filename):
+                records.append((record.get('time', 0), record['slabel'], record['qlabel'], i, offset))
+        for t, slabel, qlabel, i, offset in sorted(records, key=lambda record: record[0]):
+            self.index.setdefault(slabel, {})[qlabel] = (i, offset)
+
+    def __getitem__(self, slabel):
+        if slabel not in self.loaded:
+            results = {}
+            for qlabel, (i, offset) in self.index[slabel].items():
+                with open(self.filenames[i], 'rb') as f:
+                    f.seek(offset)
+                    results[qlabel] = json.loads(f.readline().decode('utf-8'))['results']
+            self.loaded[slabel] = results
+        return self.loaded[slabel]
+
+    def __contains__(self, slabel):
+        return slabel in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_dict(self):
+        return dict((slabel, self[slabel]) for slabel in self)
+
+
+class SpillResults(MutableMapping):
+    """
+    Mapping {slabel: {qlabel: results}} for parameters['all results'] that
+    keeps the nmax most recently used species in memory and spills the
+    others to the SQLite file dbfile, a local key-value file, see
+    qtc --spill. A spilled species is read back when it is used, and
+    changes made to it are kept. Iteration follows insertion order, as
+    with an OrderedDict. Keep dbfile on local storage, e.g. TMPDIR.
+    >>> import tempfile
+    >>> d = SpillResults(os.path.join(tempfile.mkdtemp(), 'spill.sqlite'), nmax=2)
+    >>> for n in range(1, 6):
+    ...     d['C' * n] = {'opt': {'energy': -40. * n}}
+    >>> len(d), len(d.memory), d.nspill
+    (5, 2, 3)
+    >>> d['C']['opt']['energy'] = 0.
+    >>> d['CC']['opt']['energy'], d['CCC']['opt']['energy'], 'C' in d.memory
+    (-80.0, -120.0, False)
+    >>> d['C']['opt']['energy'], list(d)
+    (0.0, ['C', 'CC', 'CCC', 'CCCC', 'CCCCC'])
+    >>> d.close()
+    """
+    schema = """
+    CREATE TABLE IF NOT EXISTS species (
+        slabel TEXT PRIMARY KEY,
+        value  BLOB
+    );
+    """
+
+    def __init__(self, dbfile, nmax=100):
+        from . import sqltools as sq
+        self.dbfile = dbfile
+        self.nmax = max(nmax, 1)
+        self.order = OrderedDict()
+        self.memory = OrderedDict()
+        self.nspill = 0
+        self.connection = sq.get_connection(dbfile, self.schema)
+        with self.connection:
+            self.connection.execute('DELETE FROM species')
+
+    def spill(self):
+        """
+        Writes the least recently used species to dbfile until nmax are left in memory.
+        """
+        import pickle
+        import sqlite3
+        items = []
+        while len(self.memory) > self.nmax:
+            slabel, value = self.memory.popitem(last=False)
+            items.append((slabel, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))))
+        if items:
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO species VALUES (?, ?)', items)
+            self.nspill += len(items)
+        return
+
+    def __getitem__(self, slabel):
+        import pickle
+        if slabel in self.memory:
+            value = self.memory.pop(slabel)
+            self.memory[slabel] = value
+            return value
+        if slabel not in self.order:
+            raise KeyError(slabel)
+        row = self.connection.execute('SELECT value FROM species WHERE slabel = ?', (slabel,)).fetchone()
+        value = pickle.loads(bytes(row[0]))
+        self.memory[slabel] = value
+        self.spill()
+        return value
+
+    def __setitem__(self, slabel, value):
+        self.order[slabel] = None
+        self.memory.pop(slabel, None)
+        self.memory[slabel] = value
+        self.spill()
+
+    def __delitem__(self, slabel):
+        del self.order[slabel]
+        self.memory.pop(slabel, None)
+        with self.connection:
+            self.connection.execute('DELETE FROM species WHERE slabel = ?', (slabel,))
+
+    def __contains__(self, slabel):
+        return slabel in self.order
+
+    def __iter__(self):
+        return iter(list(self.order))
+
+    def __len__(self):
+        return len(self.order)
+
+    def close(self, remove=True):
+        """
+        Closes dbfile and removes it if remove is True. Spilled species are lost.
+        Called at exit by qtc.
+        """
+        from . import sqltools as sq
+        if sq._connections.get(self.dbfile) is self.connection:
+            del sq._connections[self.dbfile]
+        self.connection.close()
+        if remove and os.path.isfile(self.dbfile):
+            os.remove(self.dbfile)
+        return
+
+
+def load_results_stream(filenames):
+    """
+    Returns a StreamedResults mapping for json lines files written by
+    append_results, e.g. with qtc --stream.
+    filenames is a file name, a list of them, or a glob pattern such as
+    'qtc_results_*.jsonl' for the files of all ranks.
+    """
+    import glob
+    if isinstance(filenames, str) and not os.path.isfile(filenames):
+        filenames = sorted(glob.glob(filenames))
+    return StreamedResults(filenames)
+
+
 def gen_dict_extract(key, var):
     """
     https://stackoverflow.com/questions/9807634/find-all-occurrences-of-a-key-in-nested-python-dictionaries-and-lists
@@ -119,6 +488,37 @@ def merge_dicts(*dict_args):
   
 
 
+def get_args():
+    import argparse
+    parser = argparse.ArgumentParser(description='Upserts qtc results into a MongoDB collection')
+    parser.add_argument('files', type=str, nargs='+',
+                        help='Json lines files from qtc --stream, or json files from --dumpjsonfile or --harvest')
+    parser.add_argument('--host', type=str, default=None,
+                        help='MongoDB URI, default is localhost; mongomock for an in-process stand-in')
+    parser.add_argument('--db', type=str, default='qtc',
+                        help='Database name')
+    parser.add_argument('-c', '--collection', type=str, default='results',
+                        help='Collection name')
+    parser.add_argument('-b', '--batchsize', type=int, default=1000,
+                        help='Number of entries in each bulk write')
+    parser.add_argument('-r', '--retries', type=int, default=3,
+                        help='Number of retries of a failed bulk write')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    collection = get_collection(get_database(args.db, args.host), args.collection)
+    collection.create_index([('slabel', 1), ('qlabel', 1)], unique=True)
+    ingest_results(collection, args.files, args.batchsize, args.retries)
+    close_clients()
+    return
+
+
 if __name__ == "__main__":
-    import doctest
-    doctest.testmod(verbose=True)
+    if '--test' in sys.argv:
+        import doctest
+        doctest.testmod(verbose=True)
+    else:
+        main()
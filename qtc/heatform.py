@@ -626,8 +626,8 @@ def find_E(bas, opt, en, freq, runE=True, anharm=False, dbdir='./'):
         if anharm:
             zpvetype = 'anzpve'
         zpvefile = io.join_path(fdire, bas + '.' + zpvetype)
-    if io.check_file(enefile):
-        E = io.read_file(enefile).strip()
+    if io.check_result(enefile):
+        E = io.read_result(enefile).strip()
         logging.debug('{}    E:{:5} pulled from: {}'.format(bas, E, enefile))
         E = float(E)
     elif runE:
@@ -635,12 +635,12 @@ def find_E(bas, opt, en, freq, runE=True, anharm=False, dbdir='./'):
             run_opt(bas, optprog, optmethod, optbasis, True)
         E = run_energy(bas, optprog, optmethod, optbasis, enprog, enmethod, enbasis, 'ene')
         io.mkdir(edire)
-        io.write_file(str(E), enefile)
+        io.write_result(str(E), enefile)
         logging.debug('{}    E: {:5} saved to: {}'.format(bas, E,  enefile))
 
     if freq != None:
-        if io.check_file(zpvefile):
-            zpve= io.read_file(zpvefile).strip()
+        if io.check_result(zpvefile):
+            zpve= io.read_result(zpvefile).strip()
             zpve= float(zpve)
             logging.debug('{} ZPVE: {:5} pulled from: {}'.format(bas, zpve, zpvefile))
         elif runE:
@@ -648,7 +648,7 @@ def find_E(bas, opt, en, freq, runE=True, anharm=False, dbdir='./'):
                 run_opt(bas, optprog, optmethod, optbasis, True)
             zpve = run_energy(bas, optprog, optmethod, optbasis, freqprog, freqmethod, freqbasis, zpvetype)
             io.mkdir(fdire)
-            io.write_file(str(zpve), zpvefile)
+            io.write_result(str(zpve), zpvefile)
             logging.debug('{} ZPVE: {:5} saved to: {}'.format(bas, zpve, zpvefile))
     else:
         logging.debug('Zero point vibrational energy NOT accounted for')
@@ -705,12 +705,13 @@ def E_hfbasis_QTC(mol, basis, coefflist, E, opt, en, freq, parameters):
         bas = bas.split('_')[0]
         h  =  nest_2_dic(bas, 'delHf',  0)
         if h is None:
-            smilesdir = io.join_path(parameters['database'], formula, smilesname)
             import os
-            rundir =  io.join_path(*[os.getcwd().split(parameters['database'])[0], smilesdir, parameters['qcdirectory']])
+            dbdir = io.join_path(os.getcwd().split(parameters['database'])[0], parameters['database'])
+            smilesdir = io.get_species_dir(dbdir, formula, smilesname)
+            rundir =  io.join_path(*[smilesdir, parameters['qcdirectory']])
             hoffile = io.join_path(*[rundir, formula + '.hofk'])
-            if io.check_file(hoffile):
-                h = float(io.read_file(hoffile).splitlines()[2].split()[0]) / ut.au2kcal / ut.kj2au
+            if io.check_result(hoffile):
+                h = float(io.read_result(hoffile).splitlines()[2].split()[0]) / ut.au2kcal / ut.kj2au
                 logging.info('{} {}: {:5f}  pulled from {}'.format(bas, 'delHf', h, rundir))
             else:
                 h = 0
@@ -1020,7 +1021,7 @@ def main(mol,logfile='',basis='auto',E=9999.9,optlevel='auto/',freqlevel='optlev
     optprog, optmethod, optbasis = optlevel[0], optlevel[1], optlevel[2]
     hfdire = io.db_sp_path(enprog, enmethod, enbasis, mol, None, optprog, optmethod, optbasis)
     if '_' not in mol:
-        if not io.check_file(hfdire + '/' + mol + '.hf0k'):
+        if not io.check_result(hfdire + '/' + mol + '.hf0k'):
             io.db_store_sp_prop('Energy (kcal/mol)\tBasis\n----------------------------------', mol, 'hf0k', None, enprog, enmethod, enbasis, optprog, optmethod, optbasis)
         s = '\n' + str(hf0k) + '\t' + '  '.join(basis) 
         io.db_append_sp_prop(s, mol, 'hf0k', None, enprog, enmethod, enbasis, optprog, optmethod, optbasis)
@@ -5,6 +5,8 @@ a single module simplifying their usage.
 """
 import time
 import os
+import re
+import signal
 from os.path import isfile
 import logging
 __updated__ = "2018-07-23"
@@ -24,6 +26,20 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+# Magic numbers of the compressed files read by open_file
+compression_magic = {'gz': b'\x1f\x8b', 'xz': b'\xfd7zXZ\x00'}
+
+# Layouts of the species directories by database, see get_layout
+layouts = {}
+
+layout_name = 'qtc_layout.txt'
+
+# inotify event mask of wait_for_path: IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+inotify_mask = 0x8 | 0x80 | 0x100
+
+# libc handle for inotify, False if inotify is not available, see get_inotify
+_libc = {}
+
 
 def get_date():
     """
@@ -60,7 +76,7 @@ def rm(fname):
     return
 
 
-#def rmrf(dname):
+def rmrf(dname):
     """
     Deletes directories recursively including all of the contents.
     """
@@ -68,7 +84,7 @@ def rm(fname):
     try:
         shutil.rmtree(dname, ignore_errors=True)
     except OSError as e:
-        logging.error("Error in deleting {}: {}" % (dname, e.strerror))
+        logging.error("Error in deleting {}: {}".format(dname, e.strerror))
     return
 
 
@@ -135,8 +151,14 @@ def find_files_recursive(directory, pattern='*'):
     """
     Return matched filenames list in a given directory (including subdirectories) for a given pattern
     https://stackoverflow.com/questions/2186525/use-a-glob-to-find-files-recursively-in-python
+    The manifest is used instead of walking the directory if it is set, see
+    manifesttools.set_manifest.
     """
     import os, fnmatch
+    from . import manifesttools as mf
+    matches = mf.find_files(directory, pattern)
+    if matches is not None:
+        return matches
     matches = []
     for root, _, filenames in os.walk(directory):
         for filename in fnmatch.filter(filenames, pattern):
@@ -148,8 +170,16 @@ def yield_files_recursive(directory, pattern):
     """
     Yields files in a directory (including subdirectories) with a given pattern
     https://stackoverflow.com/questions/2186525/use-a-glob-to-find-files-recursively-in-python
+    The manifest is used instead of walking the directory if it is set, see
+    manifesttools.set_manifest.
     """
     import os, fnmatch
+    from . import manifesttools as mf
+    matches = mf.find_files(directory, pattern)
+    if matches is not None:
+        for filename in matches:
+            yield filename
+        return
     for root, dirs, files in os.walk(directory):
         for basename in files:
             if fnmatch.fnmatch(basename, pattern):
@@ -188,6 +218,19 @@ def get_file_attributes(path):
     return {'path':path, 'owner': owner,'group':group,'size_byte':size,'modified':date}
 
 
+def get_file_hash(filename, algorithm='sha1', blocksize=1048576):
+    """
+    Returns the hex digest of the content of a file.
+    The file is read in blocks of blocksize bytes.
+    """
+    import hashlib
+    h = hashlib.new(algorithm)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
 def join_path(*paths):
     """
     Concatenes strings into a portable path using correct seperators.
@@ -199,7 +242,11 @@ def join_path(*paths):
 def write_file(s, filename='newfile'):
     """
     Writes s string to a file with the given'filename'.
+    A link to a blob (see blobtools) is replaced by a new file.
     """
+    if os.path.islink(filename):
+        from . import blobtools as bt
+        bt.unlink_file(filename)
     with open(filename, 'w') as f:
         f.write(s)
     return
@@ -209,7 +256,11 @@ def append_file(s, filename='newfile'):
 
     """
     Appends s string to a file with the given 'filename'.
+    A link to a blob (see blobtools) is replaced by a copy of the blob first.
     """
+    if os.path.islink(filename):
+        from . import blobtools as bt
+        bt.unlink_file(filename, keep=True)
     with open(filename, 'a') as f:
         f.write(s)
     return
@@ -218,8 +269,9 @@ def append_file(s, filename='newfile'):
 def read_file(filename, aslines=False):
     """
     Reads a file and return either a list of lines or a string.
+    Compressed files (see get_compression) are decompressed.
     """
-    with open(filename, 'r') as f:
+    with open_file(filename) as f:
         if aslines:
             tmp = f.readlines()
         else:
@@ -227,6 +279,337 @@ def read_file(filename, aslines=False):
     return tmp
 
 
+def get_compression(filename):
+    """
+    Returns the compression method of a file, 'gz' or 'xz', identified by its
+    magic number, or None if the file is not compressed.
+    """
+    with open(filename, 'rb') as f:
+        magic = f.read(6)
+    for method, number in compression_magic.items():
+        if magic.startswith(number):
+            return method
+    return None
+
+
+def get_lzma():
+    """
+    Returns the lzma module for xz files, or backports.lzma on Python 2.
+    """
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            raise ImportError('xz compressed files need the lzma module of Python 3, or backports.lzma on Python 2')
+    return lzma
+
+
+def open_file(filename, mode='r'):
+    """
+    Returns a file object for reading a file, plain or compressed.
+    Compressed files are decompressed as they are read.
+    mode is 'r' for text and 'rb' for bytes.
+    >>> import tempfile
+    >>> filename = join_path(tempfile.mkdtemp(), 'C2H6.out')
+    >>> write_file('Normal termination', filename)
+    >>> compress_file(filename) > 0, get_compression(filename)
+    (True, 'gz')
+    >>> read_file(filename)
+    'Normal termination'
+    >>> rmrf(os.path.dirname(filename))
+    """
+    import sys
+    method = get_compression(filename)
+    if 'b' not in mode:
+        mode = 'rb' if sys.version_info[0] < 3 else 'rt'
+    if method == 'gz':
+        import gzip
+        return gzip.open(filename, mode)
+    elif method == 'xz':
+        return get_lzma().open(filename, mode)
+    return open(filename, mode)
+
+
+def compress_file(filename, method='gz', level=6):
+    """
+    Compresses a file in place, keeping its name and modification time.
+    The compressed file is written to a temporary file and renamed.
+    Returns the compressed size, or None if the file is already compressed.
+    """
+    import shutil
+    if get_compression(filename):
+        return None
+    tmpfile = '{}.{}.tmp'.format(filename, os.getpid())
+    if method == 'gz':
+        import gzip
+        fout = gzip.open(tmpfile, 'wb', compresslevel=level)
+    elif method == 'xz':
+        fout = get_lzma().open(tmpfile, 'wb', preset=level)
+    else:
+        raise ValueError('Unknown compression method {}'.format(method))
+    with open(filename, 'rb') as fin, fout:
+        shutil.copyfileobj(fin, fout, 1048576)
+    shutil.copystat(filename, tmpfile)
+    os.rename(tmpfile, filename)
+    return os.path.getsize(filename)
+
+
+def decompress_file(filename):
+    """
+    Decompresses a file compressed by compress_file in place.
+    """
+    import shutil
+    if not get_compression(filename):
+        return
+    tmpfile = '{}.{}.tmp'.format(filename, os.getpid())
+    with open_file(filename, 'rb') as fin, open(tmpfile, 'wb') as fout:
+        shutil.copyfileobj(fin, fout, 1048576)
+    shutil.copystat(filename, tmpfile)
+    os.rename(tmpfile, filename)
+    return
+
+
+def write_result(s, filename, append=False):
+    """
+    Writes (or appends) s to a result file, such as formula.ene.
+    If a results store is set (see sqltools.set_store), s is stored there and
+    written to the file only if the store keeps files.
+    """
+    from . import sqltools as sq
+    from . import cachetools as ct
+    from . import journaltools as jt
+    if jt.write_value(filename, s, append):
+        return
+    if sq.write_value(filename, s, append) and not sq.store['files']:
+        return
+    if append:
+        append_file(s, filename)
+    else:
+        write_file(s, filename)
+    ct.write_through(filename)
+    return
+
+
+def read_result(filename):
+    """
+    Returns the content of a result file from the results store if it is
+    set and has it, or from the file. Returns None if there is neither.
+    The file is read through the node-local cache if it is set, see
+    cachetools.set_cache.
+    """
+    from . import sqltools as sq
+    from . import cachetools as ct
+    from . import journaltools as jt
+    s = jt.read_value(filename)
+    if s is None:
+        s = sq.read_value(filename)
+    if s is None:
+        s = ct.read_through(filename)
+    if s is None and check_file(filename):
+        s = read_file(filename)
+    return s
+
+
+def check_result(filename):
+    """
+    Returns True if a result file is in the journal or the results store,
+    or exists.
+    """
+    return read_result(filename) is not None
+
+
+def find_results(directory, pattern):
+    """
+    Returns the sorted list of result files in a given directory with names
+    matching the pattern, in the journal, the results store or the directory.
+    """
+    from . import sqltools as sq
+    from . import journaltools as jt
+    files = set(find_files(directory, pattern))
+    for name in sq.find_values(directory, pattern) + jt.find_values(directory, pattern):
+        files.add(directory + '/' + name)
+    return sorted(files)
+
+
+def get_mmap(filename):
+    """
+    Returns a read-only memory map of a file.
+    Returns None for an empty file, which cannot be mapped.
+    Pages are loaded by the OS on demand, so searching a mapped
+    file does not read it into memory.
+    """
+    import mmap
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def find_in_file(filename, keyword, reverse=False, start=0, end=None):
+    """
+    Returns the byte offset of the first occurrence of a keyword in a file.
+    If reverse is True, returns the offset of the last occurrence, searching
+    backward from the end of the file.
+    Returns -1 if keyword is not found.
+    Compressed files are searched while they are decompressed, and offsets
+    are in the decompressed text.
+    """
+    if get_compression(filename):
+        with open_file(filename, 'rb') as f:
+            return find_in_stream(f, keyword, reverse, start, end)
+    m = get_mmap(filename)
+    if m is None:
+        return -1
+    if end is None:
+        end = len(m)
+    try:
+        if reverse:
+            pos = m.rfind(keyword.encode(), start, end)
+        else:
+            pos = m.find(keyword.encode(), start, end)
+    finally:
+        m.close()
+    return pos
+
+
+def find_in_stream(f, keyword, reverse=False, start=0, end=None, blocksize=1048576):
+    """
+    Returns the byte offset of the first (last if reverse is True) occurrence
+    of a keyword in the file object f opened in binary mode, between the
+    offsets start and end, reading blocksize bytes at a time.
+    Returns -1 if keyword is not found.
+    """
+    keyword = keyword.encode()
+    f.seek(start)
+    offset = start
+    buf = b''
+    pos = -1
+    while end is None or offset < end:
+        block = f.read(blocksize if end is None else min(blocksize, end - offset))
+        if not block:
+            break
+        buf += block
+        offset += len(block)
+        i = buf.rfind(keyword) if reverse else buf.find(keyword)
+        if i >= 0:
+            pos = offset - len(buf) + i
+            if not reverse:
+                return pos
+        buf = buf[-(len(keyword) - 1):] if len(keyword) > 1 else b''
+    return pos
+
+
+def get_size(filename):
+    """
+    Returns the size of a file in bytes, the decompressed size for
+    compressed files, which are decompressed to get it. The size in the
+    gzip trailer is not used, it is the size modulo 4 GiB.
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> filename = join_path(tmpdir, 'C2H6.out')
+    >>> write_file('Normal termination\\n' * 1000, filename)
+    >>> compress_file(filename, 'gz') is not None, get_size(filename)
+    (True, 19000)
+    >>> rmrf(tmpdir)
+    """
+    if get_compression(filename):
+        size = 0
+        with open_file(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1048576), b''):
+                size += len(block)
+        return size
+    return os.path.getsize(filename)
+
+
+def read_window(filename, start=0, nbytes=None):
+    """
+    Returns nbytes of a file, starting from the byte offset start, as a string.
+    Negative start is counted from the end of the file.
+    If nbytes is None, reads until the end of the file.
+    Offsets of compressed files are in the decompressed text, which is read
+    once from the beginning.
+    """
+    if get_compression(filename):
+        with open_file(filename, 'rb') as f:
+            if start < 0:
+                b = read_stream_tail(f, -start)
+                if nbytes is not None:
+                    b = b[:nbytes]
+            else:
+                f.seek(start)
+                b = f.read() if nbytes is None else f.read(nbytes)
+        return b.decode('utf-8', 'replace')
+    with open(filename, 'rb') as f:
+        if start < 0:
+            f.seek(0, os.SEEK_END)
+            start = max(f.tell() + start, 0)
+        f.seek(start)
+        if nbytes is None:
+            b = f.read()
+        else:
+            b = f.read(nbytes)
+    return b.decode('utf-8', 'replace')
+
+
+def read_stream_tail(f, nbytes, blocksize=1048576):
+    """
+    Returns the last nbytes bytes read from the file object f.
+    """
+    b = b''
+    for block in iter(lambda: f.read(blocksize), b''):
+        b = (b + block)[-nbytes:]
+    return b
+
+
+def read_head_tail(filename, nhead=65536, ntail=65536):
+    """
+    Returns (head, tail, whole), the first nhead and the last ntail bytes of
+    a file as strings, and True if head is the whole file.
+    Compressed files are read once.
+    """
+    if get_compression(filename):
+        with open_file(filename, 'rb') as f:
+            head = f.read(nhead)
+            rest = read_stream_tail(f, ntail)
+        if not rest:
+            head = head.decode('utf-8', 'replace')
+            return head, head, True
+        tail = (head + rest)[-ntail:]
+        return head.decode('utf-8', 'replace'), tail.decode('utf-8', 'replace'), False
+    head = read_head(filename, nhead)
+    if os.path.getsize(filename) <= nhead:
+        return head, head, True
+    return head, read_tail(filename, ntail), False
+
+
+def read_head(filename, nbytes=65536):
+    """
+    Returns the first nbytes of a file as a string.
+    """
+    return read_window(filename, 0, nbytes)
+
+
+def read_tail(filename, nbytes=65536):
+    """
+    Returns the last nbytes of a file as a string.
+    """
+    return read_window(filename, -nbytes)
+
+
+def read_from_last(filename, keyword, nbytes=None):
+    """
+    Returns the text of a file starting from the last occurrence of keyword.
+    At most nbytes are returned, all the remaining text if nbytes is None.
+    Returns an empty string if keyword is not found.
+    """
+    pos = find_in_file(filename, keyword, reverse=True)
+    if pos < 0:
+        return ''
+    return read_window(filename, pos, nbytes)
+
+
 def get_unique_filename(fname):
     """
     Try to return a unique filename.
@@ -234,7 +617,7 @@ def get_unique_filename(fname):
     """
     counter = 1
     uname = fname
-    while check_file(uname, timeout=0.01):
+    while check_file(uname):
         uname = fname + '_' + str(counter)
         counter += 1
     return uname
@@ -261,22 +644,93 @@ def fix_path(s):
     return s
 
 
+def get_inotify(dirname):
+    """
+    Returns an inotify file descriptor watching dirname for new and written
+    files, or None if inotify is not available (not Linux) or dirname
+    cannot be watched.
+    """
+    import sys
+    if not sys.platform.startswith('linux'):
+        return None
+    if 'libc' not in _libc:
+        try:
+            import ctypes
+            import ctypes.util
+            _libc['libc'] = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            _libc['libc'].inotify_init1
+        except (OSError, AttributeError):
+            _libc['libc'] = False
+    libc = _libc['libc']
+    if not libc:
+        return None
+    try:
+        fd = libc.inotify_init1(os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0o2000000))
+    except Exception as e:
+        logging.debug('Cannot use inotify: {}'.format(e))
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, dirname.encode(), inotify_mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def wait_for_path(path, exists=isfile, timeout=0, interval=0.001, maxinterval=1.):
+    """
+    Returns True if exists(path) is True within timeout seconds.
+    With timeout=0 checks once. Otherwise the process sleeps between checks,
+    starting with interval seconds and doubling up to maxinterval, and wakes
+    up early when a file is created or written in the parent directory of
+    path if inotify is available. inotify does not see files written on
+    other nodes of a shared file system, which are found by the checks.
+    """
+    import select
+    if exists(path):
+        return True
+    if timeout <= 0:
+        return False
+    end = time.time() + timeout
+    fd = get_inotify(os.path.dirname(os.path.abspath(path)))
+    try:
+        while True:
+            remaining = end - time.time()
+            if remaining <= 0:
+                return exists(path)
+            wait = min(interval, remaining)
+            if fd is None:
+                time.sleep(wait)
+            elif select.select([fd], [], [], wait)[0]:
+                try:
+                    os.read(fd, 65536)
+                except OSError:
+                    pass
+            if exists(path):
+                return True
+            interval = min(2 * interval, maxinterval)
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+
 def check_file(filename, timeout=0, verbose=False):
     """
     Returns True (False) if a file exists (doesn't exist).
-    If timeout>0 is given, then checks file in a loop until
-    timeout seconds pass.
+    If timeout>0 is given, then waits for the file until
+    timeout seconds pass, see wait_for_path.
     If verbose is True and file does not exist, prints an error message
-    """
-    import time
-    from os.path import isfile
-    exists = isfile(filename)
-    if timeout > 0 and not exists:
-        t0 = time.time()
-        while time.time() < t0 + timeout:
-            if isfile(filename):
-                exists = True
-                break
+    >>> import tempfile, threading
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> filename = join_path(tmpdir, 'file.txt')
+    >>> check_file(filename), check_file(filename, timeout=0.1)
+    (False, False)
+    >>> threading.Timer(0.2, write_file, ['done', filename]).start()
+    >>> check_file(filename, timeout=10)
+    True
+    >>> rmrf(tmpdir)
+    """
+    exists = wait_for_path(filename, isfile, timeout)
     if not exists and verbose:
         logging.debug('"{0}" file not found.'.format(filename))
     return exists
@@ -285,19 +739,10 @@ def check_file(filename, timeout=0, verbose=False):
 def check_dir(dirname, timeout=0):
     """
     Returns True (False) if a directory exists (doesn't exist).
-    If timeout>0 is given, then checks file in a loop until
-    timeout seconds pass.
-    """
-    import time
-    from os.path import isdir
-    exists = isdir(dirname)
-    if timeout > 0 and not exists:
-        t0 = time.time()
-        while time.time() < t0 + timeout:
-            if isdir(dirname):
-                exists = True
-                break
-    return exists
+    If timeout>0 is given, then waits for the directory until
+    timeout seconds pass, see wait_for_path.
+    """
+    return wait_for_path(dirname, os.path.isdir, timeout)
 
 
 def check_exe(exename):
@@ -348,12 +793,93 @@ def get_path(f, executable=False, directory=False):
         return os.path.abspath(f)
 
 
-def get_line_number(keyword, lines=None, filename=None,getlastone=False):
+def get_trie_pattern(strings):
+    """
+    Returns a regular expression matching any of the given literal strings.
+    Strings are merged into a prefix tree so that the regex engine tests a
+    single character class at each position of the text instead of trying
+    every alternative. The longest string wins when one is a prefix of another.
+    >>> print(get_trie_pattern(['CCSD', 'CCSD(T)', 'MP2']))
+    (?:CCSD(?:\\(T\\))?|MP2)
+    """
+    trie = {}
+    for string in strings:
+        node = trie
+        for c in string:
+            node = node.setdefault(c, {})
+        node[''] = {}
+
+    def build(node):
+        alts = [re.escape(c) + build(node[c]) for c in sorted(node) if c]
+        if not alts:
+            return ''
+        if len(alts) == 1:
+            pattern = alts[0]
+        else:
+            pattern = '(?:' + '|'.join(alts) + ')'
+        if '' in node:
+            pattern = '(?:' + pattern + ')?'
+        return pattern
+    return build(trie)
+
+
+def get_line_index(keywords, lines=None, filename=None):
+    """
+    Returns a dictionary {keyword: [line numbers]} with the numbers of the lines
+    containing each keyword. All keywords are searched in a single pass, and
+    the result can be passed as index to get_line_number and get_line_numbers
+    instead of scanning the lines for each keyword.
+    >>> sorted(get_line_index(['CCSD', 'CCSD(T)', 'MP2'], lines=['CCSD(T)= 1', 'MP2= 2', 'CCSD= 3']).items())
+    [('CCSD', [0, 2]), ('CCSD(T)', [0]), ('MP2', [1])]
+    """
+    index = dict((keyword, []) for keyword in keywords)
+    if lines is None and filename is None:
+        logging.debug('List of lines or a filename to be read is required for get_line_index')
+        return index
+    elif filename:
+        lines = read_file(filename, aslines=True)
+    if isinstance(lines, str):
+        lines = lines.splitlines()
+    keywords = [keyword for keyword in index if keyword]
+    if not keywords:
+        return index
+    if lines and lines[0].endswith('\n'):
+        s = ''.join(lines)
+    else:
+        s = '\n'.join(lines)
+    regex = re.compile(get_trie_pattern(keywords))
+    n = 0
+    start = 0
+    match = regex.search(s)
+    while match:
+        pos = match.start()
+        n += s.count('\n', start, pos)
+        start = s.rfind('\n', 0, pos) + 1
+        end = s.find('\n', pos)
+        if end < 0:
+            end = len(s)
+        line = s[start:end]
+        for keyword in keywords:
+            if keyword in line:
+                index[keyword].append(n)
+        match = regex.search(s, end + 1)
+    return index
+
+
+def get_line_number(keyword, lines=None, filename=None,getlastone=False,index=None):
     """
     Returns the line number of a keyword found in given lines of string.
     Returns -1 if keyword is not found
+    If index, returned by get_line_index, is given, it is used instead of lines.
     """
     num = -1
+    if index is not None:
+        if index[keyword]:
+            if getlastone:
+                num = index[keyword][-1]
+            else:
+                num = index[keyword][0]
+        return num
     if lines is None and filename is None:
         logging.debug('List of lines or a filename to be read is required for get_line_number')
     elif filename:
@@ -368,11 +894,16 @@ def get_line_number(keyword, lines=None, filename=None,getlastone=False):
     return num
 
 
-def get_line_numbers(keyword, lines=None, filename=None):
+def get_line_numbers(keyword, lines=None, filename=None, index=None):
     """
     Returns the line numbers as a list for a keyword in given lines of string.
     Returns -1 if keyword is not found
+    If index, returned by get_line_index, is given, it is used instead of lines.
     """
+    if index is not None:
+        if index[keyword]:
+            return list(index[keyword])
+        return -1
     if lines is None and filename is None:
         logging.debug('List of lines or a filename to be read is required for get_line_numbers')
     elif filename:
@@ -555,7 +1086,7 @@ def get_env(var,default=None):
     return val
 
 
-def execute(command, stdoutfile=None, stderrfile=None, merge=False, wait=True):
+def execute(command, stdoutfile=None, stderrfile=None, merge=False, wait=True, monitor=None, interval=30):
     r"""
     Executes a given command, and optionally write stderr and/or stdout.
     Parameters
@@ -563,6 +1094,10 @@ def execute(command, stdoutfile=None, stderrfile=None, merge=False, wait=True):
     command: List of strings, where a command line is seperated into words.
     stderrfile: None or a string for a file name to write stderr
     stdoutfile: None or a string for a file name to write stdout
+    monitor: None or a function called every interval seconds while the
+             command runs. If it returns a nonempty string, the process and
+             its children are terminated, see kill_process_group, and the
+             string is added to the returned message.
 
     Returns
     ---------
@@ -577,6 +1112,17 @@ def execute(command, stdoutfile=None, stderrfile=None, merge=False, wait=True):
     "STDOUT:\nb'this works\\n'\nSTDERR:\nb''\n"
     >>> execute('echo this also works')
     "STDOUT:\nb'this also works\\n'\nSTDERR:\nb''\n"
+    >>> start = time.time()
+    >>> msg = execute(['sh', '-c', 'sleep 30 & sleep 30'], monitor=lambda: 'stop', interval=0.1)
+    >>> msg.startswith('Terminated: stop'), time.time() - start < 10
+    (True, True)
+    >>> def fail():
+    ...     raise KeyboardInterrupt
+    >>> try:
+    ...     execute(['sleep', '30'], monitor=fail, interval=0.1)
+    ... except KeyboardInterrupt:
+    ...     time.time() - start < 20
+    True
     """
     from subprocess import Popen, PIPE
     if isinstance(command, str):
@@ -587,7 +1133,43 @@ def execute(command, stdoutfile=None, stderrfile=None, merge=False, wait=True):
     msg = 'Running Popen with command: {0}\n'.format(commandstr)
     logging.debug(msg)
     msg =''
-    if wait:
+    if wait and monitor:
+        import tempfile
+        stdout, stderr = tempfile.TemporaryFile(), tempfile.TemporaryFile()
+        process = Popen(command, stdout=stdout, stderr=stderr, preexec_fn=os.setsid)
+        last = time.time()
+        try:
+            # SIGTERM from the batch system raises SystemExit, handled below
+            sigterm = signal.signal(signal.SIGTERM, raise_exit)
+        except ValueError:
+            # Not in the main thread
+            sigterm = None
+        try:
+            while process.poll() is None:
+                time.sleep(min(1., interval))
+                if process.poll() is None and time.time() - last >= interval:
+                    last = time.time()
+                    reason = monitor()
+                    if reason:
+                        logging.error('Terminating {0}: {1}'.format(commandstr, reason))
+                        kill_process_group(process)
+                        msg += 'Terminated: {0}\n'.format(reason)
+                        break
+        except BaseException:
+            # The process is in its own session and does not get the
+            # terminal's SIGINT, do not leave it running without qtc.
+            logging.error('Terminating {0}: interrupted'.format(commandstr))
+            kill_process_group(process)
+            raise
+        finally:
+            if sigterm is not None:
+                signal.signal(signal.SIGTERM, sigterm)
+        stdout.seek(0)
+        stderr.seek(0)
+        out, err = stdout.read(), stderr.read()
+        stdout.close()
+        stderr.close()
+    elif wait:
         process = Popen(command, stdout=PIPE, stderr=PIPE)
         out, err = process.communicate()
     else:
@@ -615,6 +1197,35 @@ def execute(command, stdoutfile=None, stderrfile=None, merge=False, wait=True):
     return msg
 
 
+def raise_exit(signum, frame):
+    """
+    Signal handler raising SystemExit, so that cleanup code runs.
+    """
+    raise SystemExit(128 + signum)
+
+
+def kill_process_group(process, grace=10):
+    """
+    Terminates a process started in its own session, see execute, and the
+    other processes in its group, e.g. Gaussian links or MPI ranks.
+    Processes still running after grace seconds are killed.
+    """
+    import signal
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        return
+    end = time.time() + grace
+    while process.poll() is None and time.time() < end:
+        time.sleep(0.1)
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    process.wait()
+    return
+
+
 def get_stdout_stderr(command):
     r"""
     Executes a given command, and get stdout and stderr.
@@ -723,18 +1334,93 @@ def get_zip_info(zipfilename):
 
 def db_head_path(db_location=None):
     """
-    Returns default database path (in pacc) unless otherwise specified
+    Returns default database path (in pacc) unless otherwise specified.
+    The default can be changed with the QTC_DATABASE environment variable.
     """
     if db_location == 'test':
         return '/home/elliott/testdirectory/'
     if db_location == None:
-        return '/lcrc/project/PACC/databases/qtc_database/'
+        return get_env('QTC_DATABASE', '/lcrc/project/PACC/databases/qtc_database/')
         #return '/lcrc/project/PACC/databases/torsscan_database/'
         #return '/home/elliott/testdirectory/'
     else:
         return fix_path(db_location)
 
 
+def get_shard(smilesname, nchar=2):
+    """
+    Returns the hash prefix directory of a species in the sharded layout,
+    the first nchar hex digits of the sha1 hash of its smilesname.
+    >>> get_shard('CC_m1')
+    'e6'
+    """
+    import hashlib
+    return hashlib.sha1(smilesname.encode('utf-8')).hexdigest()[:nchar]
+
+
+def get_layout(database):
+    """
+    Returns the layout of the species directories of a database, 'sharded'
+    if database/qtc_layout.txt says so, 'flat' otherwise.
+    """
+    key = os.path.abspath(database)
+    if key not in layouts:
+        layoutfile = join_path(database, layout_name)
+        layout = 'flat'
+        if isfile(layoutfile):
+            layout = read_file(layoutfile).strip() or 'flat'
+        layouts[key] = layout
+    return layouts[key]
+
+
+def set_layout(database, layout, write=True):
+    """
+    Sets the layout of the species directories of a database, 'flat' or
+    'sharded', for new species. Existing species are not moved, see shardtools.
+    The layout file is written only if write is True and it changes.
+    """
+    if write and get_layout(database) != layout:
+        mkdir(database)
+        write_file(layout + '\n', join_path(database, layout_name))
+    layouts[os.path.abspath(database)] = layout
+    return
+
+
+def get_species_dir(database, formula, smilesname):
+    """
+    Returns the directory of a species, database/formula/smilesname in the
+    flat layout, or database/formula/shard/smilesname in the sharded layout
+    (see get_shard), so that isomers of a formula are spread over 256
+    directories. An existing directory of the species in the other layout
+    is returned, so that trees can be read while they are migrated.
+    """
+    flat = join_path(database, formula, smilesname)
+    sharded = join_path(database, formula, get_shard(smilesname), smilesname)
+    if get_layout(database) == 'sharded':
+        first, second = sharded, flat
+    else:
+        first, second = flat, sharded
+    if check_dir(first) or not check_dir(second):
+        return first
+    return second
+
+
+def split_species_path(path):
+    """
+    Returns (formula, smilesname, rest) for a path relative to a database
+    in either layout, where rest is the list of the remaining directories
+    and the file name.
+    >>> split_species_path('C2H6/CC_m1/opt/gaussian/C2H6.out')
+    ('C2H6', 'CC_m1', ['opt', 'gaussian', 'C2H6.out'])
+    >>> split_species_path('C2H6/e6/CC_m1/opt/gaussian/C2H6.out')
+    ('C2H6', 'CC_m1', ['opt', 'gaussian', 'C2H6.out'])
+    """
+    tokens = path.replace(os.sep, '/').split('/')
+    if len(tokens) > 3 and tokens[1] == get_shard(tokens[2]):
+        del tokens[1]
+    return tokens[0], tokens[1], tokens[2:]
+
+
 def db_smiles_path(smiles, db_location = None):
     """
     Returns the path for a smiles molecule in a database
@@ -801,7 +1487,7 @@ def db_store_opt_prop(s, smiles, typ='zmat', db_location=None, prog=None, method
         directory =  db_opt_path(prog, method, basis, db_location, smiles)
 
     mkdir(directory)
-    write_file(s, join_path(directory, smiles + '.' + typ))
+    write_result(s, join_path(directory, smiles + '.' + typ))
     return
 
 def db_get_opt_prop(smiles, typ='zmat', db_location=None, prog=None, method=None, basis=None):
@@ -815,9 +1501,7 @@ def db_get_opt_prop(smiles, typ='zmat', db_location=None, prog=None, method=None
         directory =  db_head_path(db_location)
     else:
         directory =  db_opt_path(prog, method, basis, db_location, smiles)
-    if check_file(join_path(directory, smiles + '.' + typ)):
-        return read_file(join_path(directory, smiles + '.' + typ))
-    return
+    return read_result(join_path(directory, smiles + '.' + typ))
 
 def db_store_sp_prop(s, smiles, typ='ene', db_location=None, prog=None, method=None, basis=None, optprog=None, optmethod=None, optbasis=None):
     """
@@ -837,7 +1521,7 @@ def db_store_sp_prop(s, smiles, typ='ene', db_location=None, prog=None, method=N
     else:
         directory =  db_sp_path(prog, method, basis, db_location, smiles, optprog, optmethod, optbasis)
     mkdir(directory)
-    write_file(s, join_path(directory, smiles + '.' + typ))
+    write_result(s, join_path(directory, smiles + '.' + typ))
     return
 
 def db_append_sp_prop(s, smiles, typ='ene', db_location=None, prog=None, method=None, basis=None, optprog=None, optmethod=None, optbasis=None):
@@ -858,7 +1542,7 @@ def db_append_sp_prop(s, smiles, typ='ene', db_location=None, prog=None, method=
         directory =  db_sp_path(prog, method, basis, db_location, smiles, optprog, optmethod, optbasis)
 
     mkdir(directory)
-    append_file(s, join_path(directory, smiles + '.' + typ))
+    write_result(s, join_path(directory, smiles + '.' + typ), append=True)
     return
 
 
@@ -877,9 +1561,7 @@ def db_get_sp_prop(smiles, typ='ene', db_location=None, prog=None, method=None,
         directory =  db_head_path(db_location)
     else:
         directory =  db_sp_path(prog, method, basis, db_location, smiles, optprog, optmethod, optbasis)
-    if check_file(join_path(directory, smiles + '.' + typ)):
-        return read_file(join_path(directory, smiles + '.' + typ))
-    return
+    return read_result(join_path(directory, smiles + '.' + typ))
 
 
 def db_logfile_dir(db_location, smiles=None, prog=None, method=None, basis=None, optprog=None, optmethod=None, optbasis=None):
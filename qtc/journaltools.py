@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+"""
+Per-rank result journals.
+
+With a journal set (see set_journal, or qtc with --journal), each rank
+appends the result files it writes with iotools.write_result, its results
+and its state changes as json lines to its own journal,
+journaldir/journal_<hostname>_<rank>.jsonl, instead of creating small
+files in the shared database. Records are buffered and written with one
+append when the buffer is full or flushed, e.g. at the end of each
+calculation, so that ranks finishing at the same time do not create a
+metadata storm. A rank reads back the result files it wrote from its own
+journal, only the byte offsets of their records are kept in memory; other
+ranks see them after the journals are merged.
+
+merge_journals folds the journals into the database tree (or the SQLite
+results store, see sqltools) and into journaldir/merged.json, which holds
+the results and the last state of each species and qlabel. The merged
+offset of each journal is kept, so merge can be run repeatedly, or with
+--follow as a streaming merger while the ranks are running.
+
+Usage:
+   python -m qtc.journaltools merge journaldir              # fold journals once
+   python -m qtc.journaltools merge journaldir --follow 60  # every 60 s
+   python -m qtc.journaltools merge journaldir -d database --store results.sqlite --storeonly
+   python -m qtc.journaltools bench -r 1 16 256             # throughput
+   python -m qtc.journaltools --test                        # run the doctests
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import sys
+import time
+from . import iotools as io
+from . import dbtools as db
+
+mergedname = 'merged.json'
+
+# The active journal, see set_journal. files maps the path of a result file
+# to the byte offsets of its records in the journal, size and flushed are the
+# sizes of the journal with and without the buffered records.
+journal = {'file': None, 'rank': 0, 'buffer': [], 'nbuffer': 64, 'files': {},
+           'size': 0, 'flushed': 0, 'atexit': False}
+
+
+def get_journal_name(journaldir, rank, hostname=None):
+    """
+    Returns the journal file of a rank.
+    >>> get_journal_name('journals', 3, 'node1')
+    'journals/journal_node1_3.jsonl'
+    """
+    hostname = hostname or socket.gethostname()
+    return io.join_path(journaldir, 'journal_{}_{}.jsonl'.format(hostname, rank))
+
+
+def set_journal(journaldir, rank=0, nbuffer=64):
+    """
+    Sets the journal of this rank in journaldir. Records are written in
+    batches of nbuffer records.
+    """
+    import atexit
+    journaldir = os.path.abspath(journaldir)
+    io.mkdir(journaldir)
+    journal['file'] = get_journal_name(journaldir, rank)
+    journal['rank'] = rank
+    journal['nbuffer'] = nbuffer
+    journal['buffer'] = []
+    journal['files'] = {}
+    journal['size'] = journal['flushed'] = os.path.getsize(journal['file']) if os.path.isfile(journal['file']) else 0
+    if not journal['atexit']:
+        atexit.register(flush)
+        journal['atexit'] = True
+    logging.info('Journal: {}'.format(journal['file']))
+    return journal['file']
+
+
+def unset_journal():
+    """
+    Flushes and stops using the journal.
+    """
+    flush()
+    journal['file'] = None
+    journal['files'] = {}
+    return
+
+
+def add_record(kind, key, value, **kwargs):
+    """
+    Adds a record to the journal buffer, writing the buffer if it is full.
+    kind is 'file', 'result' or 'state'.
+    Returns False if there is no journal.
+    """
+    if journal['file'] is None:
+        return False
+    record = {'time': time.time(), 'rank': journal['rank'], 'kind': kind, 'key': key, 'value': value}
+    record.update(kwargs)
+    line = json.dumps(record, default=db.json_default)
+    journal['buffer'].append(line)
+    # json.dumps escapes non-ascii characters, len(line) is the size in bytes
+    journal['size'] += len(line) + 1
+    if len(journal['buffer']) >= journal['nbuffer']:
+        flush()
+    return True
+
+
+def flush():
+    """
+    Appends the buffered records to the journal file.
+    """
+    if journal['file'] is None or not journal['buffer']:
+        return
+    with open(journal['file'], 'a') as f:
+        f.write('\n'.join(journal['buffer']) + '\n')
+    journal['buffer'] = []
+    journal['flushed'] = journal['size']
+    return
+
+
+def read_record(offset):
+    """
+    Returns the record at the byte offset of the journal of this rank,
+    from the buffer if it is not written yet.
+    """
+    if offset >= journal['flushed']:
+        pos = journal['flushed']
+        for line in journal['buffer']:
+            if pos == offset:
+                return json.loads(line)
+            pos += len(line) + 1
+        return None
+    with open(journal['file'], 'rb') as f:
+        f.seek(offset)
+        return json.loads(f.readline().decode('utf-8'))
+
+
+def write_value(filename, s, append=False):
+    """
+    Records the content of a result file in the journal instead of writing it.
+    With append=True the record holds s, which merge_journals appends to the
+    file or the store, and this rank reads back s appended to the current
+    content of the result file, see iotools.read_result. That content is
+    kept in the first record of the file as base.
+    Returns False if there is no journal.
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> filename = io.join_path(tmpdir, 'C2H6.ene')
+    >>> io.write_file('-79.8', filename)
+    >>> import importlib
+    >>> jt = importlib.import_module('qtc.journaltools')
+    >>> journalfile = jt.set_journal(io.join_path(tmpdir, 'journals'))
+    >>> io.write_result(' -79.9', filename, append=True)
+    >>> io.read_result(filename) == '-79.8 -79.9', io.read_file(filename)
+    (True, '-79.8')
+    >>> jt.flush()
+    >>> io.write_result(' -80.0', filename, append=True)
+    >>> io.read_result(filename) == '-79.8 -79.9 -80.0', len(jt.journal['files'][os.path.abspath(filename)])
+    (True, 2)
+    >>> io.find_results(tmpdir, '*.xyz'), jt.write_value(io.join_path(tmpdir, 'C2H6.xyz'), '8')
+    ([], True)
+    >>> [os.path.basename(f) for f in io.find_results(tmpdir, '*.xyz')] == ['C2H6.xyz']
+    True
+    >>> jt.unset_journal()
+    >>> jt.merge_journals(io.join_path(tmpdir, 'journals'))
+    3
+    >>> io.read_file(filename)
+    '-79.8 -79.9 -80.0'
+    >>> io.rmrf(tmpdir)
+    """
+    if journal['file'] is None:
+        return False
+    path = os.path.abspath(filename)
+    offset = journal['size']
+    if not append:
+        add_record('file', path, s)
+        journal['files'][path] = [offset]
+    elif path in journal['files']:
+        add_record('file', path, s, append=True)
+        journal['files'][path].append(offset)
+    else:
+        add_record('file', path, s, append=True, base=io.read_result(filename) or '')
+        journal['files'][path] = [offset]
+    return True
+
+
+def read_value(filename):
+    """
+    Returns the content of a result file recorded in the journal by this
+    rank, including the content it had before a record appended to it, or
+    None.
+    """
+    if journal['file'] is None:
+        return None
+    path = os.path.abspath(filename)
+    if path not in journal['files']:
+        return None
+    records = [read_record(offset) for offset in journal['files'][path]]
+    return records[0].get('base', '') + ''.join(record['value'] for record in records)
+
+
+def find_values(directory, pattern='*'):
+    """
+    Returns the names of the result files in a directory recorded in the
+    journal by this rank with names matching pattern.
+    """
+    import fnmatch
+    if journal['file'] is None:
+        return []
+    directory = os.path.abspath(directory)
+    return [os.path.basename(path) for path in journal['files']
+            if os.path.dirname(path) == directory and fnmatch.fnmatch(os.path.basename(path), pattern)]
+
+
+def add_result(slabel, qlabel, results):
+    """
+    Records the results of a calculation.
+    """
+    return add_record('result', [slabel, qlabel], results)
+
+
+def add_state(slabel, qlabel, state):
+    """
+    Records a state change of a calculation, e.g. 'running' or 'done'.
+    """
+    return add_record('state', [slabel, qlabel], state)
+
+
+def read_records(filename, offset=0):
+    """
+    Returns (records, offset), the records of a journal file starting at
+    the byte offset, and the offset after the last complete line.
+    A line that is still being written is left for the next call.
+    """
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        b = f.read()
+    end = b.rfind(b'\n') + 1
+    records = [json.loads(line) for line in b[:end].decode('utf-8').splitlines() if line]
+    return records, offset + end
+
+
+def _merge_records(records, merged):
+    """
+    Writes the file records to the results store, if it is set, and to the
+    database tree, and adds the result and state records to the merged
+    dictionary.
+    """
+    from . import sqltools as sq
+    files = [record for record in records if record['kind'] == 'file']
+    stored = sq.write_values([(r['key'], r['value'], r.get('append', False)) for r in files])
+    for record in files:
+        if record['key'] in stored and not sq.store['files']:
+            continue
+        io.mkdir(os.path.dirname(record['key']))
+        if record.get('append', False):
+            io.append_file(record['value'], record['key'])
+        else:
+            io.write_file(record['value'], record['key'])
+    for record in records:
+        kind, key, value = record['kind'], record['key'], record['value']
+        if kind == 'result':
+            merged['results'].setdefault(key[0], {})[key[1]] = value
+        elif kind == 'state':
+            merged['states'].setdefault(key[0], {})[key[1]] = value
+    return
+
+
+def merge_journals(journaldir, mergedfile=None):
+    """
+    Folds the new records of the journals in journaldir.
+    File records are written to the database tree, and to the results store
+    if it is set (see sqltools.set_store); results and states are added to
+    mergedfile, journaldir/merged.json by default.
+    Returns the number of merged records.
+    """
+    mergedfile = mergedfile or io.join_path(journaldir, mergedname)
+    merged = {'offsets': {}, 'results': {}, 'states': {}}
+    if io.check_file(mergedfile):
+        with open(mergedfile) as f:
+            merged = json.load(f)
+    records = []
+    for name in sorted(os.listdir(journaldir)):
+        if not (name.startswith('journal_') and name.endswith('.jsonl')):
+            continue
+        new, offset = read_records(io.join_path(journaldir, name), merged['offsets'].get(name, 0))
+        merged['offsets'][name] = offset
+        records.extend(new)
+    records.sort(key=lambda record: record['time'])
+    _merge_records(records, merged)
+    tmpfile = mergedfile + '.tmp'
+    with open(tmpfile, 'w') as f:
+        json.dump(merged, f, default=db.json_default)
+    os.rename(tmpfile, mergedfile)
+    logging.info('Merged {} records from {}'.format(len(records), journaldir))
+    return len(records)
+
+
+def _bench_direct(item):
+    """
+    Writes nrecord small result files, each in its own directory, as qtc
+    does without a journal.
+    """
+    directory, rank, nrecord = item
+    for i in range(nrecord):
+        rundir = io.join_path(directory, 'rank{}'.format(rank), 'species{}'.format(i))
+        io.mkdir(rundir)
+        io.write_file('-100.{}\n'.format(i), io.join_path(rundir, 'species.ene'))
+        io.write_file('0.0{}\n'.format(i), io.join_path(rundir, 'species.zpve'))
+    return
+
+
+def _bench_journal(item):
+    """
+    Records nrecord pairs of small result files in the journal of a rank.
+    """
+    directory, rank, nrecord = item
+    set_journal(io.join_path(directory, 'journals'), rank)
+    for i in range(nrecord):
+        rundir = io.join_path(directory, 'rank{}'.format(rank), 'species{}'.format(i))
+        write_value(io.join_path(rundir, 'species.ene'), '-100.{}\n'.format(i))
+        write_value(io.join_path(rundir, 'species.zpve'), '0.0{}\n'.format(i))
+    unset_journal()
+    return
+
+
+def benchmark(nranks, nrecord=100, directory=None):
+    """
+    Returns a dictionary with the times in seconds for nranks local processes
+    writing nrecord pairs of result files each, directly and with journals,
+    and for merging the journals.
+    """
+    import shutil
+    import tempfile
+    from multiprocessing import Pool
+    directory = directory or tempfile.mkdtemp(prefix='qtc_journal_bench_')
+    timing = {'ranks': nranks, 'files': 2 * nranks * nrecord}
+    pool = Pool(nranks)
+    try:
+        for label, function in [('direct', _bench_direct), ('journal', _bench_journal)]:
+            workdir = io.join_path(directory, label)
+            io.mkdir(workdir)
+            items = [(workdir, rank, nrecord) for rank in range(nranks)]
+            start = time.time()
+            pool.map(function, items, chunksize=1)
+            timing[label] = time.time() - start
+        start = time.time()
+        merge_journals(io.join_path(directory, 'journal', 'journals'))
+        timing['merge'] = time.time() - start
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(directory, ignore_errors=True)
+    return timing
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Per-rank result journals of qtc')
+    parser.add_argument('action', choices=['merge', 'bench'],
+                        help='merge: fold the journals in JOURNALDIR, bench: time journals and direct writes')
+    parser.add_argument('journaldir', type=str, nargs='?', default='.',
+                        help='Journal directory')
+    parser.add_argument('-d', '--database', type=str, default='',
+                        help='Database directory, needed with --store')
+    parser.add_argument('--store', type=str, default='',
+                        help='Merge result files into this SQLite results store, see sqltools')
+    parser.add_argument('--storeonly', action='store_true',
+                        help='Do not write merged result files to the database directory')
+    parser.add_argument('--follow', type=float, default=0,
+                        help='Merge again every FOLLOW seconds')
+    parser.add_argument('-r', '--ranks', type=int, nargs='*', default=[1, 16, 256],
+                        help='Numbers of simulated ranks for bench')
+    parser.add_argument('-n', '--nrecord', type=int, default=100,
+                        help='Number of calculations of each rank for bench')
+    parser.add_argument('--tmpdir', type=str, default=None,
+                        help='Directory for bench, e.g. on the shared file system')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(format='%(message)s', level=logging.INFO if args.action == 'merge' else logging.WARNING)
+    if args.action == 'merge':
+        if args.store:
+            from . import sqltools as sq
+            sq.set_store(args.database, args.store, files=not args.storeonly)
+        merge_journals(args.journaldir)
+        while args.follow > 0:
+            time.sleep(args.follow)
+            merge_journals(args.journaldir)
+    else:
+        print('{:>6s} {:>8s} {:>10s} {:>10s} {:>10s} {:>10s}'.format('Ranks', 'Files', 'Direct', 'Journal', 'Merge', 'Speedup'))
+        for nranks in args.ranks:
+            directory = None
+            if args.tmpdir:
+                import tempfile
+                directory = tempfile.mkdtemp(prefix='qtc_journal_bench_', dir=args.tmpdir)
+            t = benchmark(nranks, args.nrecord, directory)
+            print('{ranks:6d} {files:8d} {direct:10.3f} {journal:10.3f} {merge:10.3f}'.format(**t) +
+                  ' {:10.1f}'.format(t['direct'] / t['journal']))
+    return
+
+
+if __name__ == "__main__":
+    if '--test' in sys.argv:
+        import doctest
+        doctest.testmod(verbose=True)
+    else:
+        main()
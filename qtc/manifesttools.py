@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+"""
+Manifest index of a database tree.
+
+The manifest is an SQLite file with one row for each file of the database
+tree, with its path relative to the database, name, kind (file extension),
+size, modification time, and the formula, slabel (smilesname directory) and
+qlabel (qcdirectory) keys of its path,
+database/formula/smilesname/qcdirectory/name, or
+database/formula/shard/smilesname/qcdirectory/name in the sharded layout.
+It is built once with a walk of the tree and then updated incrementally,
+one run directory at a time, as calculations finish. After set_manifest is
+called, e.g. by qtc with --manifest, iotools.find_files_recursive and
+yield_files_recursive answer from the manifest for directories in the tree,
+so that lookups do not walk the tree on the parallel file system.
+Files written to the tree by other programs are not seen until the manifest
+is updated, e.g. with the update action.
+
+Usage:
+   python -m qtc.manifesttools build database        # walk the tree once
+   python -m qtc.manifesttools update database/C2H6  # update a subtree
+   python -m qtc.manifesttools find database -p '*.out' -q 'opt/b3lyp/6-31g/gaussian'
+   python -m qtc.manifesttools --test                 # run the doctests
+"""
+import argparse
+import fnmatch
+import logging
+import os
+import stat
+import sys
+from . import iotools as io
+from . import sqltools as sq
+
+default_name = 'qtc_manifest.sqlite'
+
+# Upper bound of the paths starting with a prefix, for range queries on the path index
+prefix_end = u'\uffff'
+
+# The active manifest, see set_manifest
+manifest = {'root': None, 'file': None}
+
+schema = """
+CREATE TABLE IF NOT EXISTS files (
+    path    TEXT PRIMARY KEY,
+    name    TEXT NOT NULL,
+    kind    TEXT NOT NULL,
+    size    INTEGER,
+    mtime   REAL,
+    formula TEXT NOT NULL,
+    slabel  TEXT NOT NULL,
+    qlabel  TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_name ON files (name);
+CREATE INDEX IF NOT EXISTS files_keys ON files (slabel, qlabel, kind);
+"""
+
+
+def get_connection(dbfile):
+    """
+    Returns a connection to the manifest file dbfile, see sqltools.get_connection.
+    """
+    return sq.get_connection(dbfile, schema)
+
+
+def set_manifest(database, dbfile=None):
+    """
+    Sets the manifest for the database directory.
+    dbfile is the SQLite file, database/qtc_manifest.sqlite if not given.
+    The manifest is built if it has no files.
+    """
+    root = os.path.abspath(database)
+    dbfile = os.path.abspath(dbfile or io.join_path(root, default_name))
+    manifest['root'] = root
+    manifest['file'] = dbfile
+    if get_connection(dbfile).execute('SELECT 1 FROM files LIMIT 1').fetchone() is None:
+        build_manifest(root, dbfile)
+    logging.info('Manifest: {}'.format(dbfile))
+    return dbfile
+
+
+def unset_manifest():
+    """
+    Stops using the manifest.
+    """
+    manifest['root'] = None
+    manifest['file'] = None
+    return
+
+
+def get_row(path, size, mtime):
+    """
+    Returns the manifest row for a file with path relative to the database.
+    >>> get_row('C2H6/CC_m1/opt/gaussian/C2H6.out', 10, 0.)
+    ('C2H6/CC_m1/opt/gaussian/C2H6.out', 'C2H6.out', 'out', 10, 0.0, 'C2H6', 'CC_m1', 'opt/gaussian')
+    >>> get_row('C2H6/e6/CC_m1/opt/gaussian/C2H6.out', 10, 0.)[5:]
+    ('C2H6', 'CC_m1', 'opt/gaussian')
+    """
+    tokens = path.split('/')
+    name = tokens[-1]
+    kind = name.rsplit('.', 1)[-1] if '.' in name else ''
+    formula = tokens[0] if len(tokens) > 1 else ''
+    slabel = qlabel = ''
+    if len(tokens) > 2:
+        formula, slabel, tokens = io.split_species_path(path)
+        qlabel = '/'.join(tokens[:-1])
+    return path, name, kind, size, mtime, formula, slabel, qlabel
+
+
+def list_directory(directory):
+    """
+    Returns a list of (name, path, isdir) for the entries of a directory,
+    where isdir is False for links to directories. Uses os.scandir, which
+    gets the entry types without a stat call, or os.listdir and os.lstat
+    on Python 2.
+    """
+    if hasattr(os, 'scandir'):
+        return [(entry.name, entry.path, entry.is_dir(follow_symlinks=False)) for entry in os.scandir(directory)]
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        entries.append((name, path, stat.S_ISDIR(os.lstat(path).st_mode)))
+    return entries
+
+
+def scan_directory(directory, root, recursive=True):
+    """
+    Yields manifest rows for the files in a directory of the database tree root.
+    The manifest file itself is skipped.
+    """
+    try:
+        entries = list_directory(directory)
+    except OSError as e:
+        logging.debug('Cannot scan {}: {}'.format(directory, e))
+        return
+    for name, path, isdir in entries:
+        if isdir:
+            if recursive:
+                for row in scan_directory(path, root, recursive):
+                    yield row
+        elif not name.startswith(default_name):
+            filestat = os.stat(path)
+            path = os.path.relpath(path, root).replace(os.sep, '/')
+            yield get_row(path, filestat.st_size, filestat.st_mtime)
+
+
+def build_manifest(database, dbfile=None):
+    """
+    Builds the manifest of a database tree with a single walk of the tree.
+    Returns the number of files.
+    """
+    root = os.path.abspath(database)
+    dbfile = dbfile or io.join_path(root, default_name)
+    connection = get_connection(dbfile)
+    with connection:
+        connection.execute('DELETE FROM files')
+        connection.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               scan_directory(root, root))
+    n = connection.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+    logging.info('Manifest of {} with {} files written to {}'.format(root, n, dbfile))
+    return n
+
+
+def get_prefix(directory, root=None):
+    """
+    Returns the path of a directory relative to the manifest root, ending
+    with '/', or '' for the root.
+    Returns None if the directory is not in the tree.
+    >>> get_prefix('/db/C2H6/CC_m1', '/db')
+    'C2H6/CC_m1/'
+    """
+    root = root or manifest['root']
+    if root is None:
+        return None
+    path = os.path.relpath(os.path.abspath(directory), root)
+    if path.startswith('..'):
+        return None
+    if path == '.':
+        return ''
+    return path.replace(os.sep, '/') + '/'
+
+
+def update_directory(directory, recursive=True):
+    """
+    Updates the rows of the files in a directory of the active manifest.
+    Rows of removed files are deleted. Returns the number of files, or None
+    if there is no manifest or the directory is not in its tree.
+    >>> import tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> rundir = io.join_path(root, 'C2H6', 'CC_m1', 'opt')
+    >>> io.mkdir(rundir)
+    >>> io.write_file('output', io.join_path(rundir, 'C2H6.out'))
+    >>> dbfile = set_manifest(root)
+    >>> io.write_file('log', io.join_path(rundir, 'C2H6.log'))
+    >>> [os.path.basename(f) for f in find_files(rundir)] == ['C2H6.out']
+    True
+    >>> update_directory(rundir)
+    2
+    >>> [os.path.basename(f) for f in find_files(rundir, '*.log')] == ['C2H6.log']
+    True
+    >>> query(dbfile, kind='log')[0][0] == 'C2H6/CC_m1/opt/C2H6.log'
+    True
+    >>> unset_manifest()
+    >>> io.rmrf(root)
+    """
+    prefix = get_prefix(directory)
+    if prefix is None:
+        return None
+    rows = list(scan_directory(os.path.abspath(directory), manifest['root'], recursive))
+    connection = get_connection(manifest['file'])
+    with connection:
+        if recursive:
+            connection.execute('DELETE FROM files WHERE path >= ? AND path < ?', (prefix, prefix + prefix_end))
+        else:
+            connection.execute("DELETE FROM files WHERE path >= ? AND path < ? AND substr(path, ?) NOT LIKE '%/%'",
+                               (prefix, prefix + prefix_end, len(prefix) + 1))
+        connection.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    return len(rows)
+
+
+def find_files(directory, pattern='*'):
+    """
+    Returns the list of files in a directory of the active manifest tree
+    (including subdirectories) with names matching pattern.
+    Returns None if there is no manifest or the directory is not in its tree,
+    so that the caller walks the directory instead.
+    """
+    prefix = get_prefix(directory)
+    if prefix is None:
+        return None
+    rows = get_connection(manifest['file']).execute(
+        'SELECT path, name FROM files WHERE path >= ? AND path < ? ORDER BY path',
+        (prefix, prefix + prefix_end)).fetchall()
+    return [os.path.join(directory, path[len(prefix):]) for path, name in rows if fnmatch.fnmatch(name, pattern)]
+
+
+def query(dbfile, pattern='*', formula=None, slabel=None, qlabel=None, kind=None):
+    """
+    Returns a list of (path, size, mtime) rows of the manifest dbfile with
+    names matching pattern, selected by any of formula, slabel, qlabel and kind.
+    """
+    conditions = []
+    args = []
+    for column, val in [('formula', formula), ('slabel', slabel), ('qlabel', qlabel), ('kind', kind)]:
+        if val is not None:
+            conditions.append('{} = ?'.format(column))
+            args.append(val)
+    sql = 'SELECT path, name, size, mtime FROM files'
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    rows = get_connection(dbfile).execute(sql + ' ORDER BY path', args).fetchall()
+    return [(path, size, mtime) for path, name, size, mtime in rows if fnmatch.fnmatch(name, pattern)]
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Manifest index of a qtc database')
+    parser.add_argument('action', choices=['build', 'update', 'find'],
+                        help='build: walk the database, update: rescan a directory in it, find: query the manifest')
+    parser.add_argument('directory', type=str,
+                        help='Database directory, or a directory in it for update')
+    parser.add_argument('-m', '--manifest', type=str, default='',
+                        help='SQLite file, default is database/{}'.format(default_name))
+    parser.add_argument('-d', '--database', type=str, default='',
+                        help='Database directory for update, if it is not DIRECTORY')
+    parser.add_argument('-p', '--pattern', type=str, default='*',
+                        help='File name pattern for find')
+    parser.add_argument('-f', '--formula', type=str, default=None)
+    parser.add_argument('-s', '--slabel', type=str, default=None)
+    parser.add_argument('-q', '--qlabel', type=str, default=None)
+    parser.add_argument('-k', '--kind', type=str, default=None)
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    database = args.database or args.directory
+    dbfile = args.manifest or io.join_path(database, default_name)
+    if args.action == 'build':
+        build_manifest(database, dbfile)
+    elif args.action == 'update':
+        set_manifest(database, dbfile)
+        print('Updated {} files'.format(update_directory(args.directory)))
+    else:
+        for path, size, mtime in query(dbfile, args.pattern, args.formula, args.slabel, args.qlabel, args.kind):
+            print('{:12d} {}'.format(size, path))
+    return
+
+
+if __name__ == "__main__":
+    if '--test' in sys.argv:
+        import doctest
+        doctest.testmod(verbose=True)
+    else:
+        main()
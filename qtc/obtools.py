@@ -1924,8 +1924,7 @@ def get_smiles_path(x, mult=0, db= 'database'):
 #    elements_noH = get_formula(s, stoichiometry=False, hydrogens=False)
     s = get_smiles_filename(s)
 #    dirs = db, elements_noH, formula_noH, formula, s
-    dirs = db, formula, s
-    return io.join_path(*dirs)
+    return io.get_species_dir(db, formula, s)
 
 
 def get_smiles(x):
@@ -1981,6 +1980,22 @@ def get_smiles_filename(x):
     return s
 
 
+def get_smiles_from_filename(filename):
+    """
+    Returns the smiles string for a filename generated by get_smiles_filename.
+    Does not use open babel.
+    >>> get_smiles_from_filename('C_b_C_d__p_C_q_O_m2')
+    'C[C](C)O_m2'
+    """
+    s = filename
+    for code, c in [('_b_', '['), ('_d_', ']'), ('_i_', ':'), ('_j_', '|'),
+                    ('_k_', '\\'), ('_l_', '/'), ('_p_', '('), ('_q_', ')'),
+                    ('_s_', '*'), ('_S_', '$'), ('_t_', '#'), ('_v_', '<'),
+                    ('_y_', '>'), ('_aa_', '@@'), ('_a_', '@')]:
+        s = s.replace(code, c)
+    return s
+
+
 def smiles2formula(filename):
     from . import iotools as io
     mols = io.read_list(filename)
@@ -37,6 +37,143 @@ def get_prog(lines):
        return 'qchem'
    return
 
+################################################
+############     NUMERIC BLOCKS     ############
+################################################
+def read_lower_triangle(text, n, ncol=5):
+    """
+    Returns an n x n numpy array with the lower triangle of a matrix printed
+    in blocks of ncol columns, as the Gaussian X matrix.
+    text starts with the column numbers of the first block, anything after
+    the matrix is ignored. The needed tokens are split and converted
+    at once and placed with index arithmetic.
+    Raises ValueError if text does not have the expected layout.
+    >>> read_lower_triangle(' 1 2\\n 1 1.0\\n 2 2.0 3.0\\n 3 4.0 5.0\\n 3\\n 3 6.0\\n\\n end', 3, ncol=2).tolist()
+    [[1.0, 0.0, 0.0], [2.0, 3.0, 0.0], [4.0, 5.0, 6.0]]
+    """
+    pos, labels, labelvals, rows, cols = [], [], [], [], []
+    ntoken = 0
+    for c0 in range(0, n, ncol):
+        nc = min(ncol, n - c0)
+        labels.append(ntoken + np.arange(nc))
+        labelvals.append(np.arange(c0 + 1, c0 + nc + 1))
+        ntoken += nc
+        r = np.arange(c0, n)
+        k = np.minimum(r - c0 + 1, nc)
+        rowstart = ntoken + np.concatenate(([0], np.cumsum(k + 1)[:-1]))
+        labels.append(rowstart)
+        labelvals.append(r + 1)
+        first = np.repeat(rowstart + 1, k)
+        within = np.arange(k.sum()) - np.repeat(np.cumsum(k) - k, k)
+        pos.append(first + within)
+        rows.append(np.repeat(r, k))
+        cols.append(c0 + within)
+        ntoken += int((k + 1).sum())
+    tokens = text.split(None, ntoken)[:ntoken]
+    if len(tokens) < ntoken:
+        raise ValueError('Expected {0} tokens, found {1}'.format(ntoken, len(tokens)))
+    try:
+        tokens = np.array(tokens, dtype=float)
+    except ValueError:
+        tokens = np.array(' '.join(tokens).replace('D', 'E').split(), dtype=float)
+    if not np.array_equal(tokens[np.concatenate(labels)], np.concatenate(labelvals)):
+        raise ValueError('Unexpected row or column numbers in the matrix')
+    mat = np.zeros((n, n))
+    mat[np.concatenate(rows), np.concatenate(cols)] = tokens[np.concatenate(pos)]
+    return mat
+
+
+def count_triangle_tokens(n, ncol=5):
+    """
+    Returns the number of tokens, values and row and column numbers, of an
+    n x n lower triangle printed in blocks of ncol columns, see
+    read_lower_triangle.
+    >>> count_triangle_tokens(3, ncol=2)
+    13
+    """
+    count = 0
+    for c0 in range(0, n, ncol):
+        nc = min(ncol, n - c0)
+        m = n - c0
+        count += nc + m
+        if m <= nc:
+            count += m * (m + 1) // 2
+        else:
+            count += nc * (nc + 1) // 2 + (m - nc) * nc
+    return count
+
+
+def read_hessian(hess):
+    """
+    Returns the full symmetric Hessian as a numpy array from the text returned
+    by gaussian_hessian or molpro_hessian, a lower triangle printed in blocks.
+    The number of columns per block is taken from the first line.
+    Returns None if hess cannot be parsed.
+    >>> read_hessian('  1  2\\n 1  1.0\\n 2  2.0  3.0\\n').tolist()
+    [[1.0, 2.0], [2.0, 3.0]]
+    """
+    lines = hess.strip().splitlines()
+    if not lines:
+        return None
+    ncol = len(lines[0].split())
+    ntoken = len(hess.split())
+    # count_triangle_tokens(n) >= n(n+1)/2, search down from the largest n
+    n = int(np.sqrt(2 * ntoken)) + 1
+    while n > 0 and count_triangle_tokens(n, ncol) > ntoken:
+        n -= 1
+    if n == 0 or count_triangle_tokens(n, ncol) != ntoken:
+        return None
+    try:
+        mat = read_lower_triangle(hess, n, ncol)
+    except ValueError:
+        return None
+    return mat + np.tril(mat, -1).T
+
+
+def read_columns(lines, columns):
+    """
+    Returns a numpy array with the given columns of a table, given as a list of
+    lines. Negative column indices count from the end of each line.
+    >>> read_columns([' 1(1)  3.0  2.5  0.1', ' 2(1)  2.0  1.5  0.2'], [-3, -2]).tolist()
+    [[3.0, 2.5], [2.0, 1.5]]
+    """
+    rows = [line.split() for line in lines]
+    try:
+        table = np.array(rows)
+        return table[:, columns].astype(float)
+    except (ValueError, IndexError):
+        return np.array([[row[i] for i in columns] for row in rows], dtype=float)
+
+
+def format_molpro_hessian(lines):
+    """
+    Returns the lines of a Molpro force constant matrix as tab separated text,
+    with the atom labels nGX, nGY, nGZ replaced by 3(n-1)+1, +2, +3.
+    Values are copied as text, only the label tokens are converted: all
+    tokens of the column header lines and the first token of the other lines.
+    >>> format_molpro_hessian(['     1GX     1GY', ' 1GX  0.5', '', ' 1GY  0.1  0.6'])
+    '\\t1\\t2\\n\\t1\\t0.5\\n\\n\\t2\\t0.1\\t0.6\\n'
+    """
+    label = {'X': 1, 'Y': 2, 'Z': 3}
+
+    def get_index(val):
+        return str((int(val[:-2]) - 1) * 3 + label.get(val[-1], 3))
+    hess = []
+    for line in lines:
+        tokens = line.split()
+        if tokens:
+            if 'G' in tokens[-1]:
+                tokens = [get_index(val) if 'G' in val else val for val in tokens]
+            elif 'G' in tokens[0]:
+                tokens[0] = get_index(tokens[0])
+            hess.append('\t' + '\t'.join(tokens))
+        else:
+            hess.append('')
+    if not hess:
+        return ''
+    return '\n'.join(hess) + '\n'
+
+
 ################################################
 ############     Gaussian PARSER    ############
 ################################################
@@ -411,24 +548,7 @@ def molpro_hessian(lines):
     eline = io.get_line_number(endkey, lines=lines)
     if sline < 0:
         return ''
-    hess = ''
-    for line in lines[sline+1:eline-2]:
-       hessline = ''
-       for val in line.split():
-           if 'G'  in val:
-               if 'GX' in val:
-                   add = 1
-                   val = val.replace('GX', '')
-               elif 'GY' in val:
-                   add = 2
-                   val = val.replace('GY', '')
-               else:
-                   add = 3
-                   val = val.replace('GZ', '')
-               val =  str( (int(val) - 1 ) * 3 + add)
-           hessline += '\t' +  val
-       hess +=  hessline + '\n'
-    return hess
+    return format_molpro_hessian(lines[sline+1:eline-2])
 
 
 def molpro_zpve(lines):
@@ -609,6 +729,149 @@ def EStokTP_freqs(lines):
     freqs  = np.sort(freqs)[::-1]
     return freqs.tolist()
 
+##############################################
+############  STRUCTURED OUTPUTS   ###########
+##############################################
+"""
+Readers for the machine-readable files written by the qc packages, which
+keep full precision: Gaussian formatted checkpoint (fchk), Molpro xml and
+NWChem json outputs.
+The read_*_results functions return a dictionary with the available keys of:
+energy    : float (hartree)
+energies  : dict of floats (hartree), by method
+atomnos   : list of atomic numbers, or symbols: list of element symbols
+coords    : numpy array, natom x 3 (angstrom)
+freqs     : list of floats (cm-1)
+Hessian   : numpy array, 3natom x 3natom (hartree/bohr^2)
+nbasis    : int
+"""
+def read_fchk(filename, keys=None):
+    """
+    Returns a dictionary of the sections of a Gaussian formatted checkpoint file.
+    Scalars are returned as int, float or str, arrays as numpy arrays (str
+    for character arrays). If keys is given, only these sections are read.
+    """
+    fchk = {}
+    with io.open_file(filename) as f:
+        lines = f.readlines()
+    i = 2
+    while i < len(lines):
+        line = lines[i]
+        name = line[:40].strip()
+        vtype = line[43:44]
+        i += 1
+        if line[47:49] == 'N=':
+            n = int(line[49:])
+            if vtype in 'IRL':
+                nper = {'I': 6, 'R': 5, 'L': 72}[vtype]
+            else:
+                nper = 5
+            nline = (n + nper - 1) // nper
+            if keys is None or name in keys:
+                text = ''.join(lines[i:i+nline])
+                if vtype == 'I':
+                    fchk[name] = np.array(text.split(), dtype=int)
+                elif vtype == 'R':
+                    fchk[name] = np.array(text.split(), dtype=float)
+                else:
+                    fchk[name] = text.replace('\n', '')
+            i += nline
+        elif keys is None or name in keys:
+            value = line[49:].strip()
+            if vtype == 'I':
+                fchk[name] = int(value)
+            elif vtype == 'R':
+                fchk[name] = float(value)
+            else:
+                fchk[name] = value
+    return fchk
+
+
+def read_fchk_results(filename):
+    """
+    Returns the results in a Gaussian formatted checkpoint file.
+    """
+    fchk = read_fchk(filename, ['Total Energy', 'Atomic numbers', 'Current cartesian coordinates',
+                                'Number of basis functions', 'Cartesian Force Constants',
+                                'Vib-NDim', 'Vib-E2'])
+    d = {}
+    if 'Total Energy' in fchk:
+        d['energy'] = fchk['Total Energy']
+    if 'Number of basis functions' in fchk:
+        d['nbasis'] = fchk['Number of basis functions']
+    if 'Atomic numbers' in fchk:
+        d['atomnos'] = fchk['Atomic numbers'].tolist()
+        natom = len(d['atomnos'])
+        if 'Current cartesian coordinates' in fchk:
+            d['coords'] = fchk['Current cartesian coordinates'].reshape(natom, 3) * ut.bohr2ang
+        if 'Cartesian Force Constants' in fchk:
+            n = 3 * natom
+            hess = np.zeros((n, n))
+            hess[np.tril_indices(n)] = fchk['Cartesian Force Constants']
+            d['Hessian'] = hess + np.tril(hess, -1).T
+    if 'Vib-E2' in fchk:
+        nfreq = fchk.get('Vib-NDim', len(fchk['Vib-E2']) // 14)
+        d['freqs'] = fchk['Vib-E2'][:nfreq].tolist()
+    return d
+
+
+def read_molpro_xml_results(filename):
+    """
+    Returns the results in a Molpro xml output.
+    energies holds the last energy of each method, energy is the last one.
+    The geometry and the frequencies are taken from the last ones printed.
+    Zero frequencies of translations and rotations are not included.
+    """
+    import xml.etree.ElementTree as et
+    d = {}
+    energies = {}
+    with io.open_file(filename, 'rb') as f:
+        for event, elem in et.iterparse(f):
+            tag = elem.tag.split('}')[-1]
+            if tag == 'property' and elem.get('name', '').lower() == 'energy' and elem.get('value'):
+                energy = float(elem.get('value').split()[-1])
+                energies[elem.get('method', '')] = energy
+                d['energy'] = energy
+            elif tag == 'atomArray':
+                atoms = [atom for atom in elem if atom.tag.split('}')[-1] == 'atom']
+                d['symbols'] = [atom.get('elementType') for atom in atoms]
+                d['coords'] = np.array([[float(atom.get(x)) for x in ['x3', 'y3', 'z3']] for atom in atoms])
+            elif tag == 'vibrations':
+                freqs = [float(mode.get('wavenumber')) for mode in elem.iter()
+                         if mode.tag.split('}')[-1] == 'normalCoordinate' and mode.get('wavenumber')]
+                d['freqs'] = [freq for freq in freqs if abs(freq) > 0.5]
+                elem.clear()
+    if energies:
+        d['energies'] = energies
+    return d
+
+
+def read_nwchem_json_results(filename):
+    """
+    Returns the results in an NWChem json output.
+    Values are taken from the last calculation that has them.
+    """
+    import json
+    with io.open_file(filename) as f:
+        data = json.load(f)
+    d = {}
+    for calc in data.get('simulation', {}).get('calculations', []):
+        results = calc.get('calculationResults', {})
+        if 'totalEnergy' in results:
+            d['energy'] = float(results['totalEnergy']['value'])
+        molecule = results.get('molecule', calc.get('calculationSetup', {}).get('molecule'))
+        if molecule and 'atoms' in molecule:
+            atoms = molecule['atoms']
+            d['symbols'] = [atom['elementLabel'] for atom in atoms]
+            d['coords'] = np.array([atom['cartesianCoordinates']['value'] for atom in atoms], dtype=float)
+            if atoms and atoms[0]['cartesianCoordinates'].get('units', '').lower().startswith('bohr'):
+                d['coords'] *= ut.bohr2ang
+        if 'vibrationalModes' in results:
+            freqs = results['vibrationalModes']['frequencies']['value']
+            d['freqs'] = [float(freq) for freq in freqs if abs(float(freq)) > 0.5]
+    return d
+
+
 ###########################
 #####  FOR GENERAL ########
 ############################
@@ -705,6 +968,25 @@ def rotconsts(lines):
     print('program not recognized as gaussian or molpro')
     return
 
+def read_last_value(getter, filename, nbytes=65536):
+    """
+    Returns getter(text) for the last nbytes of the file filename, for
+    getters returning the last match of a keyword, such as gaussian_zpve,
+    gaussian_anzpve or get_298. The whole file is read if the window has
+    no value.
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> outfile = io.join_path(tmpdir, 'thermp.out')
+    >>> io.write_file('h298 final -20.1\\n' + 'x' * 100 + '\\n h298 final -20.2\\n', outfile)
+    >>> read_last_value(get_298, outfile, nbytes=30), read_last_value(get_298, outfile, nbytes=10)
+    (-20.2, -20.2)
+    >>> io.rmrf(tmpdir)
+    """
+    value = getter(io.read_tail(filename, nbytes))
+    if value in (None, '', 0.0):
+        value = getter(io.read_file(filename, aslines=False))
+    return value
+
 def get_298(lines):
     deltaH298 = ' h298 final\s*([\d,\-,\.]*)'
     lines = lines.splitlines()
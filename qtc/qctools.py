@@ -6,7 +6,11 @@ from . import obtools as ob
 from . import iotools as io
 import numpy as np
 from . import patools as pa
+from . import scantools as st
+from . import scratchtools as sc
+from . import blobtools as bt
 import logging
+import os
 try:
     import cclib
 except:
@@ -15,6 +19,10 @@ except:
 __updated__ = "2018-03-03"
 __authors__ = 'Murat Keceli, Sarah Elliott'
 
+# Version of parse_output results, increase it when parse_output changes
+# so that the parsed results cached in sidecar files are not used.
+parse_version = 2
+
 
 def sort_species_list(slist, printinfo=False, byMass=False):
     """
@@ -618,11 +626,21 @@ def get_qcdirectory(topdir, task, method, basis, package):
     return qcdir
 
 
-def get_xyz(out,package=None):
+def get_xyz(out,package=None,filename=False):
     """
     Return xyz as a string from a qc output.
+    If filename is True, out is the path of the output file. For molpro
+    only the text after the last geometry is read.
     """
     xyz = ''
+    if filename:
+        if package is None:
+            package = get_output_package(out, filename=True)
+        if package == 'molpro':
+            out = (io.read_from_last(out, 'Current geometry (xyz format') or
+                   io.read_from_last(out, 'Dump information in style XYZ'))
+        else:
+            out = io.read_file(out, aslines=False)
     if package is None:
         package = get_output_package(out)
     if package == 'nwchem':
@@ -636,7 +654,7 @@ def get_xyz(out,package=None):
     return xyz
         
         
-def parse_output(s, formula, write=False):
+def parse_output(s, formula, write=False, structured=None):
     if isinstance(s, list):
         lines = s
         s = ''.join(lines)
@@ -669,64 +687,27 @@ def parse_output(s, formula, write=False):
     parsed = False
     messhindered = None
     RPHtinput = None
-    if package == 'nwchem':
-        method = get_nwchem_method(s)
-        calculation = get_nwchem_calculation(s)
-        xyz = get_nwchem_xyz(lines)
-        nbasis = get_nwchem_nbasis(s)
-        energies = get_nwchem_energies(lines)
-        energy = energies[method]
-        freqs = get_nwchem_frequencies(lines)
-        zpve = get_zpve(freqs)
-        if energy:
-            parsed = True
-    elif package == 'molpro':
-        method, energy = pa.molpro_energy(s)
-        method = method.replace('\(', '(').replace('\)', ')')  #will figureout source of this later
-        zpve           = pa.molpro_zpve(s)
-        xyz            = pa.molpro_xyz(s)
-        geo            = pa.molpro_geo(s)
-        calculation    = pa.molpro_calc(s)
-        basis          = pa.molpro_basisset(s)
-        zmat           = pa.molpro_zmat(s)
-        hessian        = pa.molpro_hessian(s)
-        freqs          = list(pa.molpro_freqs(s))
-        if energy:
-            parsed = True
-    elif package == 'qchem':
-        energy = pa.qchem_energy(s)
-        method = pa.qchem_method(s)
-        zpve           = pa.qchem_zpve(s)
-        xyz            = pa.qchem_xyz(s)
-        geo            = pa.qchem_geo(s)
-        calculation    = pa.qchem_calc(s)
-        basis          = pa.qchem_basisset(s)
-        freqs          = list(pa.qchem_freqs(s))
-        if energy:
-            parsed = True
-    elif package == 'gaussian':
-	    method, energy = pa.gaussian_energy(s)
-	    zpve           = pa.gaussian_zpve(s)
-	    azpve          = pa.gaussian_anzpve(s)
-	    calculation    = pa.gaussian_calc(s)
-	    basis          = pa.gaussian_basisset(s)
-	    zmat           = pa.gaussian_zmat(s)
-	    xyz            = pa.gaussian_xyz(s)
-	    geo            = pa.gaussian_geo(s)
-	    hessian        = pa.gaussian_hessian(s)
-	    rotconsts      = pa.gaussian_rotconsts(s) 
-	    vibrots        = pa.gaussian_vibrot(s) 
-	    rotdists       = pa.gaussian_rotdists(s) 
-	    freqs          = list(pa.gaussian_freqs(s))
-	    afreqs         = list(get_gaussian_fundamentals(s)[:, 1])
-	    if sum(afreqs) > 0:
-	        xmat           = get_gaussian_xmatrix(s, get_gaussian_nfreq(s))
-	        if isinstance(xmat, str):
-		        xmat = []
-	    else:
-	        afreqs = []
-	    if energy:
-	        parsed = True
+    if package in st.scan_packages:
+        record = st.scan_output(s, package)
+        method = record['method']
+        calculation = record['calculation']
+        basis = record['basis']
+        nbasis = record['nbasis']
+        energy = record['energy']
+        energies = record['energies']
+        zpve = record['zpve']
+        azpve = record['azpve']
+        xyz = record['xyz']
+        geo = record['geo']
+        zmat = record['zmat']
+        hessian = record['Hessian']
+        rotconsts = record['rotconsts']
+        vibrots = record['vibrots']
+        rotdists = record['rotdists']
+        freqs = list(record['freqs'])
+        afreqs = record['afreqs']
+        xmat = record['xmat']
+        parsed = record['parsed']
     elif package == 'mopac':
         method = 'SEMO'
         energy = get_mopac_energy(s)
@@ -780,29 +761,31 @@ def parse_output(s, formula, write=False):
             parsed = True
         else:
             logging.debug('Error in parsing {}'.format(package))
+    if parsed and structured:
+        energy, freqs, xyz = merge_structured_results(structured, energy, freqs, xyz)
     if parsed:
         if write:
             fname = formula + '.ene'
-            io.write_file(str(energy), fname)
+            io.write_result(str(energy), fname)
             if xyz:
                 fname = formula + '.xyz'
-                io.write_file(xyz, fname)
+                io.write_result(xyz, fname)
             if zpve:
                 fname = formula + '.zpve'
-                io.write_file(str(zpve), fname)
+                io.write_result(str(zpve), fname)
             if azpve:
                 fname = formula + '.anzpve'
-                io.write_file(str(azpve), fname)
+                io.write_result(str(azpve), fname)
             if len(freqs) > 0:
-                if any(freq < 0 for freq in freqs):
-                    logging.error('Imaginary frequency detected: {}'.format(['{:6.1f}'.format(freq) for freq in freqs]))
+                if any(float(freq) < 0 for freq in freqs):
+                    logging.error('Imaginary frequency detected: {}'.format(['{:6.1f}'.format(float(freq)) for freq in freqs]))
                 fname = formula + '.hrm'
-                io.write_file('\n'.join(str(x) for x in freqs), fname )
+                io.write_result('\n'.join(str(x) for x in freqs), fname )
             if sum(afreqs) > 0:
                 if any(freq < 0 for freq in afreqs):
                     logging.error('Imaginary frequency detected: {}'.format(['{:6.1f}'.format(freq) for freq in afreqs]))
                 fname = formula + '.anhrm'
-                io.write_file('\n'.join(str(x) for x in afreqs), fname)
+                io.write_result('\n'.join(str(x) for x in afreqs), fname)
         d = {'nbasis':nbasis,
                'energy':energy,
                'xyz':xyz,
@@ -820,10 +803,377 @@ def parse_output(s, formula, write=False):
                'Hessian'   : hessian,
                'deltaH0': hof0,
                'deltaH298': hof298}
+        if write:
+            hessian = structured.get('Hessian') if structured else None
+            fname = write_output_arrays(formula + '.npz', d, hessian)
+            if fname:
+                d['arrays'] = fname
 
     return d
 
 
+# Machine-readable outputs written next to a qc output, as
+# {package: (extension, reader)}
+structured_outputs = {'gaussian': ('.fchk', pa.read_fchk_results),
+                      'molpro'  : ('.xml' , pa.read_molpro_xml_results),
+                      'nwchem'  : ('.json', pa.read_nwchem_json_results)}
+
+
+def get_structured_output(outfile, package):
+    """
+    Returns the path of the machine-readable output of package with the same
+    name as the qc output outfile, e.g. formula.fchk for formula.out.
+    Returns an empty string if there is none.
+    """
+    if package not in structured_outputs:
+        return ''
+    filename = os.path.splitext(outfile)[0] + structured_outputs[package][0]
+    if io.check_file(filename):
+        return filename
+    return ''
+
+
+def write_fchk(outfile, formchk='formchk'):
+    """
+    Converts the Gaussian checkpoint file of the output outfile, formula.chk
+    for formula.out, to a formatted checkpoint file with formchk, and removes
+    the checkpoint file. Returns the name of the fchk file, or an empty string
+    if there is no checkpoint file or formchk is not found.
+    """
+    base = os.path.splitext(outfile)[0]
+    chkfile = base + '.chk'
+    fchkfile = base + '.fchk'
+    if not io.check_file(chkfile):
+        return ''
+    if not io.get_path(formchk, executable=True):
+        logging.debug('{} not found, keeping {}'.format(formchk, chkfile))
+        return ''
+    bt.unlink_file(fchkfile)
+    io.execute([formchk, chkfile, fchkfile])
+    if not io.check_file(fchkfile):
+        logging.warning('Cannot write {}'.format(fchkfile))
+        return ''
+    io.rm(chkfile)
+    return fchkfile
+
+
+def read_structured_output(filename, package):
+    """
+    Returns the results in a machine-readable output of package, see patools.
+    Returns an empty dictionary if the file cannot be read.
+    """
+    try:
+        return structured_outputs[package][1](filename)
+    except Exception as e:
+        logging.warning('Cannot read {}: {}'.format(filename, e))
+        return {}
+
+
+def merge_structured_results(structured, energy, freqs, xyz):
+    """
+    Returns energy, freqs and xyz with the full precision values from a
+    machine-readable output, see read_structured_output.
+    Values are replaced only if they agree with the ones parsed from the text
+    output within its printed precision, the geometry only if it is missing.
+    """
+    if 'energy' in structured:
+        energies = [structured['energy']] + list(structured.get('energies', {}).values())
+        matches = [e for e in energies if abs(e - energy) < 1.e-5]
+        if matches:
+            energy = matches[0]
+        else:
+            logging.warning('Energy {} in the structured output does not match {}'.format(structured['energy'], energy))
+    if len(freqs) > 0 and 'freqs' in structured:
+        sfreqs = structured['freqs']
+        if len(sfreqs) == len(freqs) and all(abs(x - float(y)) < 0.01 for x, y in zip(sfreqs, freqs)):
+            freqs = list(sfreqs)
+        else:
+            logging.warning('Frequencies in the structured output do not match')
+    if (not xyz or xyz == 'na') and 'coords' in structured:
+        if 'symbols' in structured:
+            symbols = structured['symbols']
+        else:
+            symbols = [ob.get_symbol(atomno) for atomno in structured['atomnos']]
+        geo = ''.join(' {}  {:.8f}  {:.8f}  {:.8f}\n'.format(symbol, *coords)
+                      for symbol, coords in zip(symbols, structured['coords']))
+        xyz = str(len(symbols)) + '\n\n' + geo
+    return energy, freqs, xyz
+
+
+# Keys of parse_output results that are also stored as numpy arrays
+array_keys = ['freqs', 'afreqs', 'xmat', 'Hessian']
+
+
+def write_output_arrays(filename, results, hessian=None):
+    """
+    Writes the arrays in parse_output results to a numpy .npz file.
+    The Hessian text is stored as a full symmetric matrix, unless the
+    Hessian array is given.
+    Returns filename, or None if there is no array to write.
+    """
+    arrays = {}
+    for key in array_keys:
+        val = results.get(key)
+        if key == 'Hessian' and hessian is not None:
+            val = hessian
+        elif key == 'Hessian' and val:
+            val = pa.read_hessian(val)
+        if val is not None and len(val) > 0 and np.any(val):
+            arrays[key] = np.array(val, dtype=float)
+    if not arrays:
+        return None
+    np.savez(filename, **arrays)
+    return filename
+
+
+def read_output_arrays(filename, keys=None):
+    """
+    Returns a dictionary of the arrays stored by write_output_arrays.
+    Only the given keys are read, all keys are read if keys is None.
+    A missing key is skipped.
+    """
+    with np.load(filename) as data:
+        if keys is None:
+            keys = data.files
+        return {key: data[key] for key in keys if key in data.files}
+
+
+def get_arrays_path(results, directory=None):
+    """
+    Returns the path of the arrays file of parse_output results, or None.
+    results['arrays'] is the name of the file in the directory of the output,
+    which is directory, or results['path'] if directory is None. Absolute
+    paths written by earlier versions are also resolved in that directory,
+    so that they still work after the database is moved or migrated.
+    >>> get_arrays_path({'arrays': 'C2H6.npz', 'path': '/db/C2H6/e6/CC_m1/opt'})
+    '/db/C2H6/e6/CC_m1/opt/C2H6.npz'
+    >>> get_arrays_path({'arrays': '/old/db/C2H6/CC_m1/opt/C2H6.npz'}, 'opt')
+    'opt/C2H6.npz'
+    """
+    filename = results.get('arrays')
+    if not filename:
+        return None
+    directory = directory or results.get('path')
+    if directory:
+        filename = io.join_path(directory, os.path.basename(filename))
+    return filename
+
+
+def get_output_array(results, key, directory=None):
+    """
+    Returns the array for key from parse_output results, either stored in the
+    results or in the arrays file referenced by results['arrays'], see
+    get_arrays_path. Returns None if the array is not available.
+    >>> import tempfile
+    >>> rundir = tempfile.mkdtemp()
+    >>> write_output_arrays(io.join_path(rundir, 'C2H6.npz'), {'freqs': [300., 1000.]})[-8:]
+    'C2H6.npz'
+    >>> get_output_array({'arrays': 'C2H6.npz', 'path': rundir}, 'freqs').tolist()
+    [300.0, 1000.0]
+    >>> io.rmrf(rundir)
+    """
+    filename = get_arrays_path(results, directory)
+    if filename and io.check_file(filename):
+        arrays = read_output_arrays(filename, [key])
+        if key in arrays:
+            return arrays[key]
+    val = results.get(key)
+    if key == 'Hessian' and val:
+        return pa.read_hessian(val)
+    if val is not None and len(val) > 0:
+        return np.array(val, dtype=float)
+    return None
+
+
+def get_sidecar_name(outfile):
+    """
+    Returns the name of the file storing the parsed results of outfile.
+    """
+    return outfile + '.parsed.json'
+
+
+def read_sidecar(outfile):
+    """
+    Returns the results stored in the sidecar of outfile by parse_output_file.
+    Returns None if there is no sidecar, or if it was written by another
+    parser version or for another content of outfile.
+    The content is matched with the file size and the modification time, or
+    with the sha1 hash when only the modification time differs, e.g. after
+    a copy or a restore from the blob store. The sidecar is then rewritten
+    with the new modification time, so that the file is hashed only once.
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> outfile = io.join_path(tmpdir, 'C2H6.out')
+    >>> io.write_file('Normal termination', outfile)
+    >>> write_sidecar(outfile, {'energy': -79.8})
+    >>> os.utime(outfile, (0, 0))
+    >>> read_sidecar(outfile) == {'energy': -79.8}
+    True
+    >>> import json
+    >>> json.load(open(get_sidecar_name(outfile)))['mtime'] == 0
+    True
+    >>> io.write_file('Error termination', outfile)
+    >>> read_sidecar(outfile) is None
+    True
+    >>> io.rmrf(tmpdir)
+    """
+    import json
+    sidecar = get_sidecar_name(outfile)
+    if not io.check_file(sidecar):
+        return None
+    try:
+        with open(sidecar) as f:
+            d = json.load(f)
+    except Exception as e:
+        logging.debug('Cannot read sidecar {}: {}'.format(sidecar, e))
+        return None
+    stat = os.stat(outfile)
+    if d.get('version') != parse_version or d.get('size') != stat.st_size:
+        return None
+    if d.get('mtime') != stat.st_mtime:
+        if d.get('sha1') != io.get_file_hash(outfile):
+            return None
+        d['mtime'] = stat.st_mtime
+        try:
+            with open(sidecar, 'w') as f:
+                json.dump(d, f, separators=(',', ':'), default=float)
+        except Exception as e:
+            logging.debug('Cannot update sidecar {}: {}'.format(sidecar, e))
+    return d['results']
+
+
+def write_sidecar(outfile, results):
+    """
+    Writes the parsed results of outfile to its sidecar together with
+    the parser version, size, modification time and sha1 hash of outfile.
+    """
+    import json
+    stat = os.stat(outfile)
+    d = {'version': parse_version,
+         'size': stat.st_size,
+         'mtime': stat.st_mtime,
+         'sha1': io.get_file_hash(outfile),
+         'results': results}
+    try:
+        with open(get_sidecar_name(outfile), 'w') as f:
+            json.dump(d, f, separators=(',', ':'), default=float)
+    except Exception as e:
+        logging.error('Cannot write sidecar for {}: {}'.format(outfile, e))
+    return
+
+
+def compress_output(outfile, method='gz'):
+    """
+    Compresses the output file outfile in place, see io.compress_file.
+    A valid sidecar of outfile is rewritten for the compressed file, so
+    that the parsed results are not invalidated.
+    """
+    results = read_sidecar(outfile)
+    size = io.compress_file(outfile, method)
+    if size is not None:
+        logging.debug('Compressed {} ({} bytes)'.format(outfile, size))
+        if results is not None:
+            write_sidecar(outfile, results)
+    return size
+
+
+def parse_output_file(outfile, formula, write=False):
+    """
+    Returns parse_output results for the output file outfile.
+    Results are cached in a sidecar file next to outfile (see read_sidecar),
+    and parsing is skipped if outfile has not changed since.
+    The cache is not used if write is True, since parse_output writes files
+    while parsing, or for torsscan outputs, which depend on other files.
+    Values in a machine-readable output next to outfile, see
+    get_structured_output, are preferred to the ones in the text.
+    """
+    package = get_output_package(outfile, filename=True)
+    cache = not write and package in st.scan_packages + ['mopac']
+    if cache:
+        results = read_sidecar(outfile)
+        if results is not None:
+            logging.debug('Using parsed results in {}'.format(get_sidecar_name(outfile)))
+            return results
+    structured = get_structured_output(outfile, package)
+    if structured:
+        logging.debug('Using {} with {}'.format(structured, outfile))
+        structured = read_structured_output(structured, package)
+    results = parse_output(io.read_file(outfile, aslines=False), formula, write, structured)
+    if package in st.scan_packages + ['mopac']:
+        write_sidecar(outfile, results)
+    return results
+
+
+def get_harvest_paths(database):
+    """
+    Yields the paths of qc outputs in a database directory.
+    Outputs are stored as database/formula/smilesname/qcdirectory/formula.out,
+    or database/formula/shard/smilesname/... in the sharded layout.
+    """
+    for formula in sorted(os.listdir(database)):
+        formuladir = io.join_path(database, formula)
+        if os.path.isdir(formuladir):
+            for path in io.yield_files_recursive(formuladir, formula + '.out'):
+                yield path
+
+
+def harvest_output(item):
+    """
+    Returns (slabel, qcdirectory, results) for a qc output in a database.
+    item is a (database, path) tuple, see get_harvest_paths.
+    results is None if the calculation is not completed or cannot be parsed.
+    Species information is taken from the path, open babel is not used.
+    """
+    database, path = item
+    formula, smilesname, tokens = io.split_species_path(os.path.relpath(path, database))
+    qcdirectory = '/'.join(tokens[:-1])
+    slabel = ob.get_smiles_from_filename(smilesname)
+    rundir = os.path.dirname(io.get_path(path))
+    outfile = tokens[-1]
+    results = None
+    cwd = io.pwd()
+    io.cd(rundir)
+    try:
+        if check_output(outfile, filename=True):
+            results = parse_output_file(outfile, formula)
+            if results:
+                results['path'] = rundir
+            else:
+                results = None
+    except Exception as e:
+        logging.error('Cannot parse {}: {}'.format(path, e))
+    finally:
+        io.cd(cwd)
+    return slabel, qcdirectory, results
+
+
+def harvest_database(database, nproc=1):
+    """
+    Returns a dictionary, {slabel: {qcdirectory: results}}, with the parse_output
+    results of all completed qc outputs in a database directory.
+    Outputs are parsed by a pool of nproc processes.
+    """
+    items = [(database, path) for path in get_harvest_paths(database)]
+    logging.info('Harvesting {} outputs in {} with {} processes'.format(len(items), database, nproc))
+    if nproc > 1:
+        from multiprocessing import Pool
+        pool = Pool(nproc)
+        harvested = pool.imap_unordered(harvest_output, items, chunksize=8)
+    else:
+        pool = None
+        harvested = map(harvest_output, items)
+    allresults = {}
+    try:
+        for slabel, qcdirectory, results in harvested:
+            if results is not None:
+                allresults.setdefault(slabel, {})[qcdirectory] = results
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return allresults
+
+
 def get_output_data(out, package=None):
     """
     Parse the output text "out" and return a dictionary
@@ -1106,9 +1456,14 @@ def get_atomno(symbol):
     return pt.index(symbol)
 
 
+# Packages run in the node-local stage directory, see scratchtools
+sc_packages = ['gaussian', 'molpro', 'nwchem', 'qchem', 'mopac']
+
+
 def run(s, parameters, mult=None, trial=0):
     """
     Runs qc, returns a string specifying the status of the calculation.
+    If a stage directory is set, see scratchtools, the calculation runs there.
     """
     maxtrial = 4
     package = parameters['qcpackage']
@@ -1131,7 +1486,6 @@ def run(s, parameters, mult=None, trial=0):
             msg = 'Overwriting previous calculation "{0}"\n'.format(io.get_path(outfile))
             runqc = True
         else:
-            out = io.read_file(outfile)
             if task.startswith('tors'):
                 if io.check_file('geom.xyz'):
                     msg = 'Skipping calculation, found "{0}"\n'.format(io.get_path('geom.xyz'))
@@ -1142,7 +1496,7 @@ def run(s, parameters, mult=None, trial=0):
                         msg = 'Skipping calculation, found "{0}"\n'.format(io.get_path('me_files/reac1_hr.me'))
                         runqc = False               
             else:
-                if check_output(out):
+                if check_output(outfile, filename=True):
                     logging.info('Successful calculation found "{0}"\n'.format(io.get_path(outfile)))
                     runqc = False
                 else:
@@ -1199,6 +1553,9 @@ def run(s, parameters, mult=None, trial=0):
             io.cd(pwd)
         inpfile = io.join_path(*[pwd, inpfile])
         io.write_file(inptext, inpfile)
+        base = os.path.splitext(outfile)[0]
+        for name in [outfile, inpfile + '.out', base + '.log', base + '.fchk', base + '.xml']:
+            bt.unlink_file(name)
         if package in ['nwchem', 'molpro', 'mopac', 'gaussian', 'torsscan', 'torsopt', 'qchem', 'md' ]:
             if package.startswith('nwc'):
                 io.mkdir(tmpdir)
@@ -1222,6 +1579,16 @@ def run(s, parameters, mult=None, trial=0):
                 parameters['qcexe'] = parameters['torsscan']
             else:
                 parameters['qcexe'] = parameters[package]
+        stagedir = None
+        if sc.stage['dir'] and package in sc_packages and io.check_file(inpfile):
+            stagedir = sc.stage_in(pwd, [os.path.basename(inpfile)])
+            inpfile = io.join_path(stagedir, os.path.basename(inpfile))
+            io.cd(stagedir)
+        if parameters['monitor'] > 0:
+            monitor = get_output_monitor(io.join_path(*[stagedir or pwd, outfile]), package,
+                                         runfile=io.join_path(*[pwd, 'RUNNING.tmp']))
+        else:
+            monitor = None
         if io.check_file(inpfile, timeout=1):
             if package in  ['nwchem', 'torsscan', 'torsopt', 'md']:
                 command = parameters['qcexe'] + ' ' + inpfile
@@ -1239,17 +1606,33 @@ def run(s, parameters, mult=None, trial=0):
                     io.symlink(tmpdir, 'tmp')
                     io.cp(inpfile, tmpdir)
                     io.cd(tmpdir)
+                    if monitor:
+                        # molpro writes the output in tmpdir, copied back when done
+                        monitor = get_output_monitor(io.join_path(os.getcwd(), outfile), package,
+                                                     runfile=io.join_path(*[pwd, 'RUNNING.tmp']))
                 command = parameters['qcexe'] + ' ' + inpfile + ' -o ' + outfile
                 logging.info('Running quantum chemistry calculation with {}'.format(command))
-                msg += io.execute(command, stdoutfile='stdouterr.txt', merge=True)
+                msg += io.execute(command, stdoutfile='stdouterr.txt', merge=True,
+                                  monitor=monitor, interval=parameters['monitor'])
                 if len(inppath) > 255:
                     logging.info('Copying {} from {}'.format(outfile, tmpdir))
                     io.cp(outfile, pwd)
+                    xmlfile = os.path.splitext(outfile)[0] + '.xml'
+                    if io.check_file(xmlfile):
+                        io.cp(xmlfile, pwd)
                     io.cd(pwd)
             else:
                 command = parameters['qcexe'] + ' ' + inpfile + ' ' + outfile
                 logging.info('Running quantum chemistry calculation with {}'.format(command))
-                msg += io.execute(command)
+                msg += io.execute(command, monitor=monitor, interval=parameters['monitor'])
+            if stagedir:
+                if package == 'gaussian':
+                    write_fchk(outfile)
+                io.cd(pwd)
+                base = os.path.splitext(outfile)[0]
+                inpname = os.path.basename(inpfile)
+                sc.stage_out(stagedir, pwd, [outfile, inpname + '.out', base + '.fchk', base + '.xml'])
+                inpfile = io.join_path(pwd, inpname)
             outfile2 = inpfile + '.out'
             ### MOPAC may create *.inp.out file depending on the version
             if io.check_file(outfile2, timeout=1):
@@ -1257,9 +1640,8 @@ def run(s, parameters, mult=None, trial=0):
             ### 
             if io.check_file(outfile, timeout=1):
                 msg += ' Output file: "{0}"\n'.format(io.get_path(outfile))
-                out = io.read_file(outfile)
                 io.rmrf('tmp')
-                if not check_output(out):
+                if not check_output(outfile, filename=True):
                     logging.error('Failed calculation "{0}"\n'.format(io.get_path(outfile)))
                     if recover:
                         logging.info('Attempting to recover, trial {}'.format(trial+1))
@@ -1269,6 +1651,8 @@ def run(s, parameters, mult=None, trial=0):
                     else:
                         logging.info('Skipping calculation')
                         runqc = False
+                elif package == 'gaussian':
+                    write_fchk(outfile)
             io.rmrf(tmpdir)
         else:
             msg += 'Failed, cannot find input file "{0}"\n'.format(io.get_path(inpfile))
@@ -1301,7 +1685,7 @@ def run_composite(parameters):
             logging.error('Energy not found for {0} {1}. Exception: {2}'.format(slabel, qlabel, err))
     exec(compositeformula)
     if energy:
-        io.write_file(str(energy), enefile )
+        io.write_result(str(energy), enefile )
         io.write_file(compositeformula, inpfile )
         logging.info('Composite energy = {} Hartree\n'.format(energy))
         logging.debug('Energy file: "{}"\n'.format(io.get_path(enefile)))
@@ -1700,19 +2084,47 @@ def get_list_info(slist,sep=' , '):
     return final
 
 
-def check_output(s):
+# Sizes of the windows at the beginning and at the end of an output that are
+# read to detect the package and the status of a calculation.
+head_bytes = 65536
+tail_bytes = 65536
+
+
+def get_output_windows(out, filename=False):
+    """
+    Returns (head, tail, whole) for the output text out, where head and tail
+    are the first head_bytes and the last tail_bytes of the output, and whole
+    is True if the output is not longer than head_bytes, i.e. head is the
+    whole output.
+    If filename is True, out is the path of the output file and only the two
+    windows are read.
+    >>> get_output_windows('abc')
+    ('abc', 'abc', True)
+    """
+    if filename:
+        return io.read_head_tail(out, head_bytes, tail_bytes)
+    return out[:head_bytes], out[-tail_bytes:], len(out) <= head_bytes
+
+
+def check_output(s, filename=False):
     """
     Returns true/false if quantum chemistry calculation completed/failed.
+    Only the last tail_bytes of the output are searched for the termination
+    messages. If filename is True, s is the path of the output file.
     """
-    if "Normal termination of Gaussian" in s:
+    if filename:
+        tail = io.read_tail(s, tail_bytes)
+    else:
+        tail = s[-tail_bytes:]
+    if is_gaussian_completed(tail):
         completed = True
-    elif "== MOPAC DONE ==" in s:
+    elif "== MOPAC DONE ==" in tail:
         completed = True
-    elif "Kowalski" in s:
+    elif "Kowalski" in tail:
         completed = True
-    elif "Variable memory released" in s:
+    elif "Variable memory released" in tail:
         completed = True
-    elif "Thank you very much for using Q-Chem" in s:
+    elif "Thank you very much for using Q-Chem" in tail:
         completed = True
     elif io.check_file('me_files/reac1_fr.me'):#TorsScan/ES2KTP
         completed = True
@@ -1723,59 +2135,212 @@ def check_output(s):
     return completed
 
 
+"""
+Signatures of failed calculations, as {package: [marker]}.
+A calculation printing one of these markers is not expected to recover.
+"""
+failure_markers = {
+    'gaussian': ['Error termination', 'Convergence failure -- run terminated.'],
+    'molpro'  : ['ERROR EXIT', 'GLOBAL ERROR'],
+    'nwchem'  : ['There is an error in the input file', 'Calculation failed to converge'],
+    'qchem'   : ['SCF failed to converge', 'Q-Chem fatal error'],
+    'mopac'   : ['JOB ENDED ABNORMALLY'],
+}
+
+"""
+Markers of the progress of a calculation, as {package: [(label, marker)]}.
+The last line containing each marker is reported.
+"""
+progress_markers = {
+    'gaussian': [('opt step', 'Step number'), ('scf cycle', ' Cycle ')],
+    'molpro'  : [('opt step', 'ITER.  ENERGY'), ('program', '1PROGRAM')],
+    'nwchem'  : [('opt step', '@ Step'), ('scf cycle', 'iter       energy')],
+    'qchem'   : [('opt step', 'Optimization Cycle:'), ('scf cycle', 'Cycle       Energy')],
+    'mopac'   : [('scf cycle', 'CYCLE:')],
+}
+
+
+def get_output_monitor(outfile, package, runfile=None):
+    """
+    Returns a function that follows the qc output file outfile of a running
+    calculation, to be passed as monitor to io.execute.
+    Each call reads only the text appended since the previous call.
+    It returns a message if a failure marker of the package is found, so that
+    the calculation is terminated early, and an empty string otherwise.
+    If runfile is given, the last progress lines are written to it.
+    """
+    state = {'offset': 0, 'tail': b'', 'progress': {}}
+    failures = failure_markers.get(package, [])
+    progress = progress_markers.get(package, [])
+
+    def monitor():
+        if not io.check_file(outfile):
+            return ''
+        with open(outfile, 'rb') as f:
+            f.seek(state['offset'])
+            b = f.read()
+        state['offset'] += len(b)
+        lines = (state['tail'] + b).split(b'\n')
+        state['tail'] = lines.pop()
+        for line in lines:
+            line = line.decode('utf-8', 'replace')
+            for marker in failures:
+                if marker in line:
+                    return 'found "{0}" in {1}'.format(line.strip(), outfile)
+            for label, marker in progress:
+                if marker in line:
+                    state['progress'][label] = line.strip()
+        if runfile and state['progress']:
+            report = '\n'.join('{0}: {1}'.format(label, line) for label, line in sorted(state['progress'].items()))
+            io.write_file(report + '\n', runfile)
+        return ''
+    return monitor
+
+
 def find_xyzfile(xyzpath, smilesdir):
     """
-    Returns the path for xyzfile.
+    Returns the path for xyzfile, read it with io.read_result, since it
+    may be only in the results store.
     """
     xyzfile = ''
-    if io.check_file(xyzpath):
+    if io.check_result(xyzpath):
         xyzfile = xyzpath
-    elif io.check_file(io.join_path(*(smilesdir, xyzpath))):
+    elif io.check_result(io.join_path(*(smilesdir, xyzpath))):
         xyzfile = io.join_path(*(smilesdir, xyzpath))
     elif io.check_dir(xyzpath):
         try:
-            xyzfile = io.find_files(xyzpath, '*.xyz')[0]
+            xyzfile = io.find_results(xyzpath, '*.xyz')[0]
         except:
             pass
     elif xyzpath and io.check_dir(io.join_path(*(smilesdir, xyzpath))):
         xyzpath = io.join_path(*(smilesdir, xyzpath))
         try:
-            xyzfile = io.find_files(xyzpath, '*.xyz')[0]
+            xyzfile = io.find_results(xyzpath, '*.xyz')[0]
         except:
             pass
     return xyzfile 
 
   
+"""
+Program banners printed at the start of an output, as [(marker, package)].
+"""
+head_markers = [('Gaussian(R)', 'gaussian'),
+                ('Entering Gaussian System', 'gaussian'),
+                ('MOPAC', 'mopac'),
+                ('Northwest Computational Chemistry Package', 'nwchem'),
+                ('PROGRAM SYSTEM MOLPRO', 'molpro'),
+                ('Task: Submitting EStokTP job', 'torsscan'),
+                ('Beta-scission bonds:', 'x2z'),
+                ('thermo properties for species', 'thermp'),
+                ('Welcome to Q-Chem', 'qchem')]
+
+
+"""
+Termination messages printed at the end of a successful output, as
+{package: marker}, see is_window_completed.
+"""
+tail_markers = {'gaussian': 'Normal termination of Gaussian',
+                'mopac': '== MOPAC DONE ==',
+                'nwchem': 'Straatsma',
+                'molpro': 'Variable memory released',
+                'qchem': 'Thank you very much for using Q-Chem'}
+
+
+def get_head_package(head):
+    """
+    Returns the package whose banner is in the head of an output, or None.
+    >>> get_head_package(' Entering Gaussian System, Link 0=g09')
+    'gaussian'
+    """
+    for marker, package in head_markers:
+        if marker in head:
+            return package
+    return None
+
+
+def is_gaussian_completed(tail):
+    """
+    Returns True if the last step of a Gaussian output in tail terminated
+    normally: the last "Normal termination" follows the start of the last
+    step of a multi-step job and the last "Error termination".
+    >>> is_gaussian_completed(' Entering Link 1\\n Normal termination of Gaussian 09\\n')
+    True
+    >>> is_gaussian_completed(' Normal termination of Gaussian 09\\n Entering Link 1\\n Error termination\\n')
+    False
+    >>> is_gaussian_completed(' Normal termination of Gaussian 09\\n Entering Link 1\\n SCF Done\\n')
+    False
+    """
+    end = tail.rfind('Normal termination of Gaussian')
+    return end >= 0 and end > tail.rfind('Entering Link 1') and end > tail.rfind('Error termination')
+
+
+def is_window_completed(package, tail):
+    """
+    Returns True if the tail of an output of package has its termination
+    message, see tail_markers and is_gaussian_completed.
+    """
+    if package == 'gaussian':
+        return is_gaussian_completed(tail)
+    return tail_markers[package] in tail
+
+
+def get_status_windows(out, filename=False):
+    """
+    Returns the head and the tail of an output for get_output_package and
+    get_output_status, see get_output_windows. The package is found from
+    the program banner in the head, and the status only from the tail.
+    The whole output is read, as the head, only if the package cannot be
+    found in the head window.
+    """
+    head, tail, whole = get_output_windows(out, filename)
+    if not whole and get_head_package(head) is None:
+        if filename:
+            out = io.read_file(out, aslines=False)
+        head = out
+    return head, tail
+
+
 def get_output_package(out,filename=False):
     """
     Returns the name of qc package if the calculation is successful.
     Returns None if failed or unknown package.
+    Program banners are searched in the head and termination messages in the
+    tail of the output, see get_status_windows.
+    >>> get_output_package(' Entering Gaussian System\\n' + 'x' * 200000 + '\\n Normal termination of Gaussian 09\\n')
+    'gaussian'
+    >>> get_output_package(' Entering Gaussian System\\n Normal termination of Gaussian 09\\n' + 'x' * 200000) is None
+    True
     """
-    if filename:
-        out = io.read_file(out, aslines=False)
-    if "Gaussian(R)" in out:
-        p = 'gaussian'
-    if "Normal termination of Gaussian" in out:
+    head, tail = get_status_windows(out, filename)
+    return get_window_package(head, tail)
+
+
+def get_window_package(head, tail):
+    """
+    Returns the package for get_output_package from the head and the tail of
+    an output.
+    """
+    if is_gaussian_completed(tail):
         p = 'gaussian'
-    elif "== MOPAC DONE ==" in out:
+    elif "== MOPAC DONE ==" in tail:
         p = 'mopac'
-    elif "Northwest Computational Chemistry Package" in out:
-        if "Straatsma" in out:
+    elif "Northwest Computational Chemistry Package" in head:
+        if "Straatsma" in tail:
             p = 'nwchem'
         else:
             p = 'failed_nwchem'
-    elif "PROGRAM SYSTEM MOLPRO" in out:
-        if "Variable memory released" in out:
+    elif "PROGRAM SYSTEM MOLPRO" in head:
+        if "Variable memory released" in tail:
             p = 'molpro'
         else:
             p = 'failed_molpro'
-    elif "Task: Submitting EStokTP job" in out:
+    elif "Task: Submitting EStokTP job" in head:
         p = 'torsscan'
-    elif "Beta-scission bonds:" in out:
+    elif "Beta-scission bonds:" in head:
         p = 'x2z'
-    elif "thermo properties for species" in out:
+    elif "thermo properties for species" in head:
         p = 'thermp'
-    elif "Thank you very much for using Q-Chem" in out:
+    elif "Thank you very much for using Q-Chem" in tail:
         p = 'qchem'
     else:
         p = None
@@ -1786,49 +2351,31 @@ def get_output_status(out,filename=False):
     """
     Returns the name of qc package if the calculation is successful.
     Returns None if failed or unknown package.
+    Only the head and the tail of the output are read, unless the package
+    cannot be found in the head, see get_status_windows.
+    """
+    head, tail = get_status_windows(out, filename)
+    return get_window_status(head, tail)
+
+
+def get_window_status(head, tail):
+    """
+    Returns the package, status and message for get_output_status from the
+    head and the tail of an output. The package is found with the banners
+    in head_markers, as in get_status_windows.
+    >>> get_window_status(' Entering Gaussian System\\n', ' Normal termination of Gaussian 09\\n')
+    ('gaussian', 'OK', '')
     """
-    p = 'NA'
     s = 'NA'
     m = ''
     nchar = 512
-    if filename:
-        out = io.read_file(out, aslines=False)
-    if "Gaussian(R)" in out:
-        p = 'gaussian'
-        if "Normal termination of Gaussian" in out:
+    p = get_head_package(head)
+    if p in tail_markers:
+        if is_window_completed(p, tail):
             s = 'OK'
         else:
             s = 'FAILED'
-            m = out[-nchar:-1]
-    elif "MOPAC" in out:
-        p = 'mopac'
-        if "== MOPAC DONE ==" in out:
-            s = 'OK'
-        else:
-            s = 'FAILED'
-            m = out[-nchar:-1]
-    elif "Northwest Computational Chemistry Package" in out:
-        p = 'nwchem'
-        if "Straatsma" in out:
-            s = 'OK'
-        else:
-            s = 'FAILED'
-            m = out[-nchar:-1]
-    elif "PROGRAM SYSTEM MOLPRO" in out:
-        p = 'molpro'
-        if "Variable memory released" in out:
-            s = 'OK'
-        else:
-            s = 'FAILED'
-            m = out[-nchar:-1]
-    elif "Task: Submitting EStokTP job" in out:
-        p = 'torsscan'
-    elif "Beta-scission bonds:" in out:
-        p = 'x2z'
-    elif "thermo properties for species" in out:
-        p = 'thermp'
-    else:
-        p = None
+            m = tail[-nchar:-1]
     return p, s, m
 
 
@@ -2049,7 +2596,6 @@ def get_gaussian_xmatrix(s, nfreq):
 
  Resonance Analysis
     """
-    xmat = np.zeros((nfreq, nfreq))
     lines = s.splitlines()
     key = 'X matrix of Anharmonic Constants (cm-1)'
     key2 = 'Total Anharmonic X Matrix (in cm^-1)'
@@ -2062,19 +2608,9 @@ def get_gaussian_xmatrix(s, nfreq):
     line = lines[iline]
     if iline < 3:
         return 'Not found: {0}'.format(key)
+    nline = sum(nfreq - icol + 1 for icol in range(0, nfreq, 5))
     try:
-        while line.strip():
-            cols = line.split()
-            icol = int(cols[0])-1
-            for irow in range(icol, nfreq):
-                iline += 1
-                line = lines[iline]
-                cols = line.split()
-                ncol = len(cols) - 1
-                xmat[irow, icol:icol+ncol] = [float(num.replace('D', 'E')) for num in cols[1:]]
-            iline += 1
-            line = lines[iline]
-        xmat = xmat.tolist()
+        xmat = pa.read_lower_triangle('\n'.join(lines[iline:iline+nline]), nfreq).tolist()
     except:
             logging.warning('Ignoring anharmonicities -- unexpected length of xmat')
             xmat  = []
@@ -2124,11 +2660,7 @@ Overtones (DE w.r.t. Ground State)
     key = 'Fundamental Bands (DE w.r.t. Ground State)'
     iline = io.get_line_number(key, lines=lines)
     if iline > 0:
-        for i in range(nfreq):
-            iline += 1
-            line = lines[iline]
-            cols = line.split()
-            freqs[i,:] = [float(cols[-5]), float(cols[-4])]
+        freqs[:, :] = pa.read_columns(lines[iline+1:iline+1+nfreq], [-5, -4])
     return freqs[freqs[:, 0].argsort()]
 
 
@@ -2375,8 +2907,9 @@ def get_nwchem_energies(inp, filename=False):
     }
     energies={}
 #    energies = {'unit':'hartree'}
+    index = io.get_line_index(list(nwdict.values()), lines=lines)
     for key, value in nwdict.items():
-        i = io.get_line_number(value, lines=lines, getlastone=True)
+        i = io.get_line_number(value, getlastone=True, index=index)
         if i >= 0:
             try:
                 energies[key] = float(lines[i].split()[-1])
@@ -137,6 +137,8 @@ def get_args():
     parser.add_argument('-O', '--overwrite', type=str,
                         default = 'none',
                         help='Overwrite existing calculations. Be careful, data will be lost.')
+    parser.add_argument('-H', '--harvest', action='store_true',
+                        help='Parses all completed outputs in the database directory with NPROC processes and writes the results to a json file, without setting up species')
     parser.add_argument('-X', '--excel', action='store_true',
                         help='Generate excel file')
     parser.add_argument('-J', '--dumpjsonfile', action='store_true',
@@ -153,6 +155,35 @@ def get_args():
                         help='Turns off rotational pf input')
     parser.add_argument('--uncertainty', type=str, default='',
                         help='use to generate uncertainty analysis')
+    parser.add_argument('--store', type=str, default='',
+                        help='SQLite file for small result files (.ene, .xyz, .hofk, ...), use "default" for DATABASE/qtc_results.sqlite')
+    parser.add_argument('--storeonly', action='store_true',
+                        help='Keep small result files only in the STORE, not in the database directory')
+    parser.add_argument('--manifest', type=str, default='',
+                        help='SQLite manifest of the database tree, used instead of directory walks and updated as calculations finish, use "default" for DATABASE/qtc_manifest.sqlite')
+    parser.add_argument('--stream', type=str, default='',
+                        help='Json lines file, appended with the results of each calculation as it completes, use "default" for qtc_results_DATE.jsonl. Load with dbtools.load_results_stream')
+    parser.add_argument('--spill', type=int, default=0,
+                        help='If SPILL > 0, keeps the results of the SPILL most recently used species in memory and the others in a SQLite file in SCRATCH')
+    parser.add_argument('--columnar', type=str, default='',
+                        help='Columnar file (.parquet, .h5 or .npz) with one row per species and qlabel for analytics, use "default" for qtc_results_DATE.parquet, see columntools')
+    parser.add_argument('--journal', type=str, default='',
+                        help='Directory for per-rank journals of result files, results and states, merged with python -m qtc.journaltools merge JOURNAL')
+    parser.add_argument('--cache', type=str, default='',
+                        help='Node-local cache directory for result files read from the database, use "default" for TMPDIR/qtc_cache')
+    parser.add_argument('--cachesize', type=float, default=1024,
+                        help='Size limit of the CACHE in MB, least recently read files are evicted')
+    parser.add_argument('--cachettl', type=float, default=0,
+                        help='Seconds before a cached file is checked against the database again, 0 to check on every read')
+    parser.add_argument('--stage', type=str, default='',
+                        help='Node-local or tmpfs directory where qc calculations run, only whitelisted files are copied back to the database in the background, use "default" for /dev/shm or SCRATCH')
+    parser.add_argument('--layout', type=str, default='', choices=['', 'flat', 'sharded'],
+                        help='Layout of new species directories in DATABASE, sharded spreads the isomers of a formula over hash prefix directories, existing species are found in either layout, see shardtools')
+    parser.add_argument('--compress', type=str, default='none', choices=['none', 'gz', 'xz'],
+                        help='Compress completed qc outputs in place after parsing, they are read transparently')
+    parser.add_argument('--monitor', type=float,
+                        default=60,
+                        help='If MONITOR > 0, follows the output of running gaussian, molpro, qchem and mopac calculations every MONITOR seconds, reports progress in RUNNING.tmp and terminates calculations with a failure signature')
     parser.add_argument('--fix', type=int,
                         default=0,
                         help='If FIX > 0, interpolate negative energies in hindered potential input for mess')
@@ -199,6 +230,18 @@ def printp(string):
         print (string)
     return
 
+def write_columnar(allresults, filename):
+    """
+    Writes allresults as columns to filename, see columntools.
+    """
+    from . import columntools as cl
+    from time import strftime as get_date_time
+    if filename == 'default':
+        filename = 'qtc_results_' + get_date_time("%y%m%d_%H%M%S") + '.parquet'
+    filename = cl.write_columns(cl.get_columns(allresults), filename)
+    logging.info('Written columnar results to {}'.format(io.get_path(filename)))
+    return filename
+
 def run(s):
     """
     A driver function to run quantum chemistry and thermochemistry calculations for a given molecule object identified by a SMILES or InChI string.
@@ -251,7 +294,7 @@ def run(s):
     parameters['tmpdir']  = io.join_path(*[scratch, ob.get_smiles_filename(s)])
     results = parameters['results']
     smilesname = ob.get_smiles_filename(s)
-    smilesdir = io.join_path(parameters['database'], formula, smilesname)
+    smilesdir = io.get_species_dir(parameters['database'], formula, smilesname)
     rundir  = io.join_path(*[smilesdir, parameters['qcdirectory']])
     qcpackage = parameters['qcpackage']
     qcscript = io.get_path(parameters['qcscript'])
@@ -327,6 +370,9 @@ def run(s):
     parameters['xyzpath']=io.get_path(xyzfilename)
     if runqc:
         io.touch(runfile)
+        if parameters['journal']:
+            from . import journaltools as jt
+            jt.add_state(slabel, qlabel, 'running')
         try:
             if qcpackage in available_packages:
                 runstart = timer()
@@ -368,8 +414,8 @@ def run(s):
         logging.info('Parsing output...')
         if parameters['qctask'] == 'composite':
             enefile = formula + '.ene'
-            if io.check_file(enefile, 0, True):
-                energy = float(io.read_file(enefile).strip())
+            if io.check_result(enefile):
+                energy = float(io.read_result(enefile).strip())
                 parameters['results']['energy'] = energy
             else:
                 if runthermo:
@@ -379,14 +425,13 @@ def run(s):
                     logging.debug('No energy file "{0}".\n'.format(enefile))
         elif parameters['qcmethod'] == 'given':
             enefile = formula + '.ene'
-            if io.check_file(enefile, 0, True):
-                energy = float(io.read_file(enefile).strip())
+            if io.check_result(enefile):
+                energy = float(io.read_result(enefile).strip())
                 parameters['results']['energy'] = energy
         elif io.check_file(qcoutput, timeout=1, verbose=False):
-            out = io.read_file(qcoutput, aslines=False)
-            if qc.check_output(out):
+            if qc.check_output(qcoutput, filename=True):
                 try:
-                    results = qc.parse_output(out, formula, parameters['writefiles'])
+                    results = qc.parse_output_file(qcoutput, formula, parameters['writefiles'])
                 except Exception as e:
                     if 'opt' in task:
                         parameters['break'] = True
@@ -397,6 +442,9 @@ def run(s):
                         exc_type, exc_obj, exc_tb = sys.exc_info()
                         fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
                         logging.error('Exception {}: {} {} {}'.format( e, exc_type, fname, exc_tb.tb_lineno))        
+                else:
+                    if parameters['compress'] != 'none':
+                        qc.compress_output(qcoutput, parameters['compress'])
                 for key in list(results.keys()):
                     val = results[key]
                     if hasattr(val, '__iter__'):
@@ -474,8 +522,8 @@ def run(s):
         if parameters['bac']:
             bonds = {}
             x2zinp = ''
-            if io.check_file(formula + '.xyz') :
-                x2zinp = (formula + '.xyz')
+            if io.check_result(formula + '.xyz') :
+                x2zinp = io.read_result(formula + '.xyz')
             elif 'xyz' in parameters['results'] and natom > 1:
                 x2zinp = parameters['results']['xyz']
             logging.info('Running x2z for BAC bonds')
@@ -492,7 +540,7 @@ def run(s):
             bondstr = ''
             for key in bonds:
                 bondstr += '{} x{}\n'.format(key, bonds[key])
-            io.write_file('{:.3f}\n{}'.format(bac, bondstr), formula + '.bac')
+            io.write_result('{:.3f}\n{}'.format(bac, bondstr), formula + '.bac')
             parameters['all results'][slabel][qlabel]['bac'] = bac                   
         parameters['all results'][slabel][qlabel]['energy'] = float('nan')
     if 'zpve' in parameters['results']:
@@ -506,6 +554,8 @@ def run(s):
     #parameters['all results'][slabel]['mol_index'] = parameters['mol_index']  
     for key in list(results.keys()):
         val = results[key]
+        if key in ['xmat', 'Hessian'] and 'arrays' in results:
+            continue
         if hasattr(val, '__iter__'):
             if len(list(val))>0:
                 parameters['all results'][slabel][qlabel][key] = results[key]
@@ -550,8 +600,8 @@ def run(s):
                 pass
             else:
                 x2zinp = ''
-                if io.check_file(formula + '.xyz') :
-                    x2zinp = (formula + '.xyz')
+                if io.check_result(formula + '.xyz') :
+                    x2zinp = io.read_result(formula + '.xyz')
                 elif 'xyz' in parameters['results'] and natom > 1:
                     x2zinp = parameters['results']['xyz']
                 logging.info('Running x2z for symmetry number')
@@ -582,7 +632,7 @@ def run(s):
                 hof, hfset, hfcoeff = hf.main_keyword(s, parameters)
             hftxt  = 'Energy (kcal/mol)\tBasis\n----------------------------------'
             hftxt += '\n' + str(hof) + '\t' + '  '.join(hfset) 
-        io.write_file(hftxt, formula + '.hofk')
+        io.write_result(hftxt, formula + '.hofk')
         parameters['results']['deltaH0'] = hof
         parameters['results']['heat of formation basis'] = hfset
         parameters['all results'][slabel][qlabel]['deltaH0'] = hof
@@ -692,6 +742,16 @@ def run(s):
         parameters['all results'][slabel][qlabel]['partition function'] = pfout
      
     io.cd(cwd)
+    if parameters['stream']:
+        db.append_results(slabel, qlabel, parameters['all results'][slabel][qlabel], parameters['stream'])
+    if parameters['journal']:
+        from . import journaltools as jt
+        jt.add_result(slabel, qlabel, parameters['all results'][slabel][qlabel])
+        jt.add_state(slabel, qlabel, 'done')
+        jt.flush()
+    if parameters['manifest']:
+        from . import manifesttools as mf
+        mf.update_directory(rundir)
     return
 
 
@@ -728,7 +788,13 @@ def main(arg_update={}):
             qtcruninfo = 'Running QTC...'
     
     endindex = parameters['last']   
-    parameters['all results'] = collections.OrderedDict()
+    if parameters['spill'] > 0:
+        spillfile = io.join_path(parameters['scratch'], 'qtc_results_{}_{}.sqlite'.format(gethostname(), os.getpid()))
+        parameters['all results'] = db.SpillResults(spillfile, parameters['spill'])
+        import atexit
+        atexit.register(parameters['all results'].close)
+    else:
+        parameters['all results'] = collections.OrderedDict()
     logfile = parameters['logfile']
     logindex = parameters['logindex']
     hostname = gethostname()
@@ -776,6 +842,47 @@ def main(arg_update={}):
         if not hasattr(args, param):
             setattr(args, param, {})
         logging.info('                             --{0:20s}\t{1}'.format(param, getattr(args, param)))
+    if parameters['layout']:
+        io.set_layout(parameters['database'], parameters['layout'], write=mpirank == 0)
+    if parameters['store']:
+        from . import sqltools as sq
+        dbfile = '' if parameters['store'] == 'default' else parameters['store']
+        sq.set_store(parameters['database'], dbfile, files=not parameters['storeonly'])
+    if parameters['manifest']:
+        from . import manifesttools as mf
+        manifestfile = '' if parameters['manifest'] == 'default' else parameters['manifest']
+        mf.set_manifest(parameters['database'], manifestfile)
+    if parameters['journal']:
+        from . import journaltools as jt
+        jt.set_journal(parameters['journal'], mpirank)
+    if parameters['stream']:
+        if parameters['stream'] == 'default':
+            parameters['stream'] = 'qtc_results_' + get_date_time("%y%m%d_%H%M%S") + '.jsonl'
+        if mpisize > 1:
+            root, ext = os.path.splitext(parameters['stream'])
+            parameters['stream'] = '{}_{}{}'.format(root, mpirank, ext)
+        parameters['stream'] = os.path.abspath(parameters['stream'])
+        logging.info('Streaming results to {}'.format(parameters['stream']))
+    if parameters['cache']:
+        from . import cachetools as ct
+        cachedir = ct.default_dir if parameters['cache'] == 'default' else parameters['cache']
+        ct.set_cache(cachedir, parameters['cachesize'], parameters['cachettl'])
+    if parameters['stage']:
+        from . import scratchtools as sc
+        stagedir = parameters['stage']
+        if stagedir == 'default':
+            stagedir = '/dev/shm' if io.check_dir('/dev/shm') else parameters['scratch']
+        sc.set_stage(stagedir)
+    if parameters['harvest']:
+        allresults = qc.harvest_database(parameters['database'], parameters['nproc'])
+        jsonfile = 'qtc_harvest_' +  get_date_time("%y%m%d_%H%M%S") + '.json'
+        jsonfile = io.get_unique_filename(jsonfile)
+        logging.info('Writing harvested results for {} species to {}'.format(len(allresults), jsonfile))
+        db.dump_json(allresults, jsonfile)
+        if parameters['columnar']:
+            write_columnar(allresults, parameters['columnar'])
+        logging.info("QTC: Total time (s)          = {0:.2f}".format(timer() - start))
+        return
     if parameters['qckeyword']:
         parameters['qckeyword'] = qc.fix_qckeyword(parameters['qckeyword'])
         ncalc = len(parameters['qckeyword'].split(parameters['task_seperator']))
@@ -945,6 +1052,8 @@ def main(arg_update={}):
             ckinfile = io.get_unique_filename(ckinfile)
             io.write_file(ckin, ckinfile)
             logging.info('Written all chemkin polynomials in {}'.format(io.get_path(ckinfile)))
+        if parameters['columnar']:
+            write_columnar(parameters['all results'], parameters['columnar'])
         if parameters['dumpjsonfile']:
             jsonfile = 'qtc_parameters_' +  get_date_time("%y%m%d_%H%M%S") + '.json'
             jsonfile = io.get_unique_filename(jsonfile)
@@ -1005,6 +1114,15 @@ def main(arg_update={}):
                 if csvtext:
                     logging.info('Writing csv file {}'.format(csvfile))
                     io.write_file(csvtext, csvfile)
+    if parameters['cache']:
+        from . import cachetools as ct
+        logging.info("QTC: Cache hits, misses      = {hits}, {misses}".format(**ct.stats))
+    if parameters['stage']:
+        from . import scratchtools as sc
+        sc.wait()
+        logging.info("QTC: Staging                 = {0}".format(sc.get_report()))
+    if parameters['spill'] > 0:
+        logging.info("QTC: Spilled species         = {0}".format(parameters['all results'].nspill))
     logging.info("QTC: Calculations time (s)   = {0:.2f}".format(end - init))
     logging.info("QTC: Total time (s)          = {0:.2f}".format(end - start))
     logging.info("QTC: Date and time           = {0}".format(io.get_date()))
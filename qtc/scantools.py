@@ -0,0 +1,1090 @@
+#!/usr/bin/env python
+"""
+Single-pass, event-driven parser for quantum chemistry output files.
+
+The extractors in patools and qctools re-scan (and often split or strip)
+the whole output for every property. Here, the output is searched once for
+the marker strings of a package, with str.find, which is faster than a
+single regular expression combining them (see get_events). Every hit is
+recorded as an event (marker name and character offset) and the fields of
+the output record are then filled by reading only the bounded text around
+the relevant events.
+
+Values in the returned record match the ones obtained by qctools.parse_output
+with the patools/qctools extractors.
+
+The fields of a record are grouped in field_scanners, so that a record can
+also be scanned lazily with get_lazy_record: the output is walked and a group
+of fields is read only when one of its fields is first accessed.
+
+Usage:
+   from . import scantools as st
+   record = st.scan_output(s, package='gaussian')
+   record['energy'], record['freqs'], ...
+   record = st.get_lazy_record(s, package='gaussian')
+   record['energy'] # only method and energy are read
+"""
+import re
+import logging
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+import numpy as np
+from . import patools as pa
+from . import unittools as ut
+
+scan_packages = ['gaussian', 'molpro', 'nwchem', 'qchem']
+
+"""
+Markers for each package as (event name, marker string) tuples.
+Markers are matched without overlap, when two markers start at the same
+position the longer one is taken.
+"""
+gaussian_markers = [
+    ('natom', 'NAtoms='),
+    ('linear', 'Linear Molecule'),
+    ('basis', 'Standard basis:'),
+    ('done', 'Done:'),
+    ('ccsd(t)', 'CCSD(T)'),
+    ('ccsd', 'CCSD'),
+    ('mp2', 'MP2'),
+    ('mp4', 'MP4'),
+    ('anharm', 'anharm'),
+    ('anzpve', 'ZPE(anh)='),
+    ('e(', 'E('),
+    ('zpve', 'Zero-point'),
+    ('xmat2', 'Total Anharmonic X Matrix (in cm^-1)'),
+    ('totalanharm', 'Total Anharm'),
+    ('optcomplete', 'Optimization complete'),
+    ('zmat', 'Z-matrix:\n'),
+    ('variables', '       Variables:'),
+    ('optparams', 'Optimized Parameters'),
+    ('eckart', 'Eckart'),
+    ('gaussorient', 'Gaussian Orientation'),
+    ('coords', 'Coordinates (Angstroms)'),
+    ('distance', ' Distance matrix'),
+    ('rotation', ' Rotation'),
+    ('symm', 'Symm'),
+    ('harmvibrot', 'Harmonic vibro-rotational analysis'),
+    ('fccart', 'Force constants in Cartesian coordinates:'),
+    ('fcint', 'Force constants in internal coordinates:'),
+    ('fundamentals', 'Fundamental Bands (DE w.r.t. Ground State)'),
+    ('freqs', 'Frequencies --'),
+    ('xmat', 'X matrix of Anharmonic Constants (cm-1)'),
+    ('rotdists', 'Quartic Centrifugal Distortion Constants Tau Prime'),
+    ('vibrot', 'Vibro-Rot alpha Matrix (in cm^-1)'),
+    ('archive', '1\\1\\'),
+    ('archiveend', '\\@'),
+]
+
+molpro_markers = [
+    ('program', '1PROGRAM'),
+    ('ccsd(t)', 'CCSD(T)'),
+    ('ccsd', 'CCSD'),
+    ('mp2', 'MP2'),
+    ('f12', 'F12'),
+    ('dft', 'dft=['),
+    ('OPTG', 'OPTG'),
+    ('optg', 'optg'),
+    ('hartree', ') / Hartree'),
+    ('totalenergy', ' total energy'),
+    ('state', ' STATE'),
+    ('!', '!'),
+    ('settingenergy', 'SETTING ENERGY'),
+    ('settingcbsen', 'SETTING CBSEN'),
+    ('zpve', 'Zero point energy:'),
+    ('currentgeo', 'Current geometry (xyz format'),
+    ('dumpxyz', 'Dump information in style XYZ'),
+    ('basis', 'basis='),
+    ('rotconsts', 'Rotational constants:'),
+    ('geometry', 'geometry={'),
+    ('variable', 'Variable'),
+    ('endopt', 'END OF GEOMETRY OPTIMIZATION'),
+    ('hessian', 'Force Constants (Second Derivatives of the Energy)'),
+    ('masses', 'Atomic Masses'),
+    ('freqs', 'Wavenumbers [cm-1]'),
+]
+
+nwchem_energy_markers = [
+    ('nre', 'Effective nuclear repulsion energy (a.u.)'),
+    ('scf', 'Total SCF energy'),
+    ('mp2', 'Total MP2 energy'),
+    ('mbpt(2)', 'MBPT(2) total energy / hartree'),
+    ('mp3', 'Total MP3 energy'),
+    ('ccsd', 'CCSD total energy / hartree'),
+    ('ccsd(t)', 'CCSD(T) total energy / hartree'),
+    ('ccsd(2)_t', 'CCSD(2)_T total energy / hartree'),
+    ('ccsd(2)', 'CCSD(2) total energy / hartree'),
+    ('ccsdt', 'CCSDT total energy / hartree'),
+    ('ccsdt(2)_q', 'CCSDT(2)_Q total energy / hartree'),
+    ('ccsdtq', 'CCSDTQ total energy / hartree'),
+]
+
+nwchem_markers = nwchem_energy_markers + [
+    ('optconverged', 'Optimization converged'),
+    ('freqs', 'P.Frequency'),
+    ('xyz', 'No.       Tag          Charge          X              Y              Z'),
+    ('nbasis', 'functions       ='),
+]
+
+qchem_markers = [
+    ('finalenergy', 'Final energy is'),
+    ('basisenergy', 'energy in the final basis set ='),
+    ('method', 'method'),
+    ('zpve', 'Zero point vibrational energy:'),
+    ('optconverged', 'OPTIMIZATION CONVERGED'),
+    ('optcomplete', 'OPTIMIZATION COMPLETE'),
+    ('basis', 'Requested basis set is'),
+    ('freqs', 'Frequency:'),
+]
+
+def get_record(package=None):
+    """
+    Returns an output record with the default value of every field.
+    Field types:
+    package, method, basis, calculation, xyz, geo, vibrots,
+    rotdists, Hessian                   : str
+    zmat                                : str or None
+    natom, nfreq, nbasis                : int
+    energy, zpve                        : float (hartree)
+    azpve                               : float (hartree) or None
+    energies                            : dict of floats (hartree)
+    freqs                               : list of str (cm-1)
+    afreqs                              : list of floats (cm-1)
+    rotconsts                           : list of str (GHz)
+    xmat                                : list of lists of floats (cm-1)
+    parsed                              : bool, True if energy is found
+    """
+    return {'package'    : package,
+            'method'     : '',
+            'basis'      : '',
+            'calculation': '',
+            'natom'      : 0,
+            'nfreq'      : 0,
+            'nbasis'     : 0,
+            'energy'     : 0.,
+            'energies'   : {},
+            'xyz'        : '',
+            'geo'        : '',
+            'zmat'       : None,
+            'freqs'      : [],
+            'afreqs'     : [],
+            'xmat'       : [],
+            'zpve'       : 0.,
+            'azpve'      : 0.,
+            'rotconsts'  : [],
+            'vibrots'    : '',
+            'rotdists'   : '',
+            'Hessian'    : '',
+            'parsed'     : False}
+
+
+def get_events(s, markers):
+    """
+    Returns a dictionary of event lists, {name: [offsets]}, for the given
+    markers, list of (name, string) tuples.
+    The events are the ones of a regex alternation of the markers, the
+    leftmost longest marker, without overlaps, e.g. CCSD is not an event
+    inside CCSD(T). Each marker is searched with str.find, at C speed,
+    while the regex engine tries the alternation at every character.
+    >>> get_events('a\\nE(X)= 1\\nE(X)= 2\\n', [('e', 'E(')])
+    {'e': [2, 10]}
+    >>> sorted(get_events('CCSD(T) CCSD', [('ccsd', 'CCSD'), ('ccsd(t)', 'CCSD(T)')]).items())
+    [('ccsd', [8]), ('ccsd(t)', [0])]
+    """
+    hits = []
+    for name, marker in markers:
+        pos = s.find(marker)
+        while pos >= 0:
+            hits.append((pos, -len(marker), name))
+            pos = s.find(marker, pos + 1)
+    hits.sort()
+    events = dict((name, []) for name, _ in markers)
+    end = 0
+    for pos, size, name in hits:
+        if pos >= end:
+            events[name].append(pos)
+            end = pos - size
+    return events
+
+
+def first(events, name, start=0, end=None):
+    """
+    Returns the offset of the first event with the given name
+    in [start, end). Returns -1 if not found.
+    """
+    for pos in events[name]:
+        if pos >= start and (end is None or pos < end):
+            return pos
+        if end is not None and pos >= end:
+            break
+    return -1
+
+
+def last(events, name, start=0, end=None):
+    """
+    Returns the offset of the last event with the given name
+    in [start, end). Returns -1 if not found.
+    """
+    for pos in reversed(events[name]):
+        if pos >= start and (end is None or pos < end):
+            return pos
+        if pos < start:
+            break
+    return -1
+
+
+def line_start(s, pos):
+    """
+    Returns the offset of the beginning of the line containing pos.
+    """
+    return s.rfind('\n', 0, pos) + 1
+
+
+def line_end(s, pos):
+    """
+    Returns the offset of the end (newline) of the line containing pos.
+    """
+    end = s.find('\n', pos)
+    if end < 0:
+        end = len(s)
+    return end
+
+
+def next_line_start(s, pos):
+    """
+    Returns the offset of the beginning of the line following the one
+    containing pos. Raises IndexError at the last line, as list indexing
+    of splitlines does.
+    """
+    end = s.find('\n', pos)
+    if end < 0 or end + 1 >= len(s):
+        raise IndexError('No line after offset {}'.format(pos))
+    return end + 1
+
+
+def get_line(s, pos):
+    """
+    Returns the line containing the offset pos.
+    """
+    return s[line_start(s, pos):line_end(s, pos)]
+
+
+def get_lines(s, pos, n, skip=1):
+    """
+    Returns at most n lines starting skip lines after the line
+    containing pos. skip=0 includes the line containing pos.
+    """
+    start = line_start(s, pos)
+    for _ in range(skip):
+        start = s.find('\n', start) + 1
+        if start == 0:
+            return []
+    lines = []
+    while len(lines) < n and start < len(s):
+        end = line_end(s, start)
+        lines.append(s[start:end])
+        start = end + 1
+    return lines
+
+
+def search_last(s, events, names, regex, before=0, after=200, start=0):
+    """
+    Returns the last match of the compiled regex, searching the text
+    windows around the events with given names, from the last event to the
+    first one. Each window extends from the beginning of the event line,
+    moved back by 'before' lines, to 'after' characters past the event.
+    Returns None if there is no match.
+    """
+    positions = []
+    for name in names:
+        positions.extend(events[name])
+    for pos in sorted(positions, reverse=True):
+        if pos < start:
+            break
+        wstart = line_start(s, pos)
+        for _ in range(before):
+            wstart = line_start(s, max(wstart - 1, 0))
+        matches = list(regex.finditer(s, wstart, pos + after))
+        if matches:
+            return matches[-1]
+    return None
+
+
+def scan_output(s, package=None):
+    """
+    Returns an output record (see get_record) by walking the output text s once.
+    package can be gaussian, molpro, nwchem or qchem. If not given it is
+    determined with qctools.get_output_package.
+    """
+    if package is None:
+        from . import qctools as qc
+        package = qc.get_output_package(s)
+    if package == 'gaussian':
+        record = scan_gaussian(s)
+    elif package == 'molpro':
+        record = scan_molpro(s)
+    elif package == 'nwchem':
+        record = scan_nwchem(s)
+    elif package == 'qchem':
+        record = scan_qchem(s)
+    else:
+        logging.error('scan_output: package {} is not supported, use one of {}'.format(package, scan_packages))
+        record = get_record(package)
+    return record
+
+
+################################################
+############     Gaussian SCANNER   ############
+################################################
+def scan_gaussian(s):
+    """
+    Returns an output record for a Gaussian log, see get_record.
+    """
+    return dict(get_lazy_record(s, 'gaussian'))
+
+
+def _gaussian_natom(s, ev, r):
+    d = {'natom': 0, 'nfreq': 0}
+    pos = first(ev, 'natom')
+    if pos >= 0:
+        d['natom'] = int(get_line(s, pos).split()[1])
+    natom = d['natom']
+    if ev['linear'] or natom == 2:
+        d['nfreq'] = 3 * natom - 5
+    else:
+        d['nfreq'] = 3 * natom - 6
+    if natom == 1:
+        d['nfreq'] = 0
+    return d
+
+
+def _gaussian_geometry(s, ev, r):
+    d = {'geo': _gaussian_geo(s, ev)}
+    if d['geo']:
+        d['xyz'] = str(len(d['geo'].splitlines())) + '\n\n' + d['geo']
+    return d
+
+
+def _gaussian_anharmonic(s, ev, r):
+    d = {}
+    afreqs = _gaussian_fundamentals(s, ev, r['nfreq'])
+    if sum(afreqs) > 0:
+        d['afreqs'] = afreqs
+        d['xmat'] = _gaussian_xmatrix(s, ev, r['nfreq'])
+    return d
+
+
+def _gaussian_method(s, ev):
+    """
+    Same as patools.gaussian_method.
+    """
+    if ev['ccsd(t)']:
+        return 'CCSD(T)'
+    elif ev['ccsd']:
+        return 'CCSD'
+    match = search_last(s, ev, ['done'], re.compile(r'Done:\s*E\((\w+)'))
+    if match is None:
+        logging.error('scan_gaussian: cannot find method')
+        return ''
+    method = match.group(1).lstrip('r').lstrip('u').lstrip('R').lstrip('U')
+    if 'HF' in method:
+        if ev['mp2']:
+            return 'MP2'
+        if ev['mp4']:
+            return 'MP4'
+    return method
+
+
+def _get_archive(s, ev):
+    """
+    Returns the last archive block (summary at the end of a Gaussian job)
+    with spaces and newlines removed.
+    """
+    start = last(ev, 'archive')
+    if start < 0:
+        return ''
+    end = first(ev, 'archiveend', start)
+    if end < 0:
+        end = len(s)
+    return s[start:end].replace('\n', '').replace(' ', '')
+
+
+def _gaussian_energy(s, ev, method):
+    """
+    Same as patools.gaussian_energy, archive and energy lines are searched
+    instead of the whole log.
+    """
+    energy = 0.
+    if not method:
+        return energy
+    if 'CCSD' in method or 'MP' in method:
+        pattern = method.replace('(', r'\(').replace(')', r'\)') + r'=([u,U,r,R]*[\w,\.,\s,-]*)'
+        energ = re.findall(pattern, _get_archive(s, ev))
+        if not energ:
+            energ = re.findall(pattern, s.replace('\n', '').replace(' ', ''))
+        if energ:
+            energy = float(energ[-1])
+    elif ev['anharm']:
+        for pattern in [r'MP2=\s*([\d,\-,\.,D,\+]*)', r'HF=\s*([\d,\-,\.,D,\+]*)']:
+            energ = re.findall(pattern, _get_archive(s, ev))
+            if not energ:
+                energ = re.findall(pattern, s.replace('\n', '').replace(' ', ''))
+            if energ:
+                energy = float(energ[-1].replace('D', 'E'))
+                break
+    else:
+        regex = re.compile(r'E\([u,U,r,R]*' + method + r'\)\s*=\s*([\d,\-,\.,D,\+]*)')
+        for pos in reversed(ev['e(']):
+            window = s[pos:line_end(s, line_end(s, pos) + 1)]
+            match = regex.match(window.replace('\n', '').replace(' ', ''))
+            if match:
+                energy = float(match.group(1).replace('D', 'E'))
+                break
+    return energy
+
+
+def _gaussian_basis(s, ev):
+    match = search_last(s, ev, ['basis'], re.compile(r'Standard basis:\s*(\S*)'))
+    if match is None:
+        return ''
+    return match.group(1).replace('(d)', '*')
+
+
+def _gaussian_zpve(s, ev):
+    match = search_last(s, ev, ['zpve'], re.compile(r'Zero\-point\s*correction=\s*([\d,\.,\-]*)'))
+    if match is None:
+        return 0.0
+    return float(match.group(1))
+
+
+def _gaussian_anzpve(s, ev):
+    match = search_last(s, ev, ['anzpve'], re.compile(r'ZPE\(anh\)=\s*([\d,\w,\+,\.,\-]*)'))
+    if match:
+        return float(match.group(1).replace('D', 'E')) * ut.kj2au
+    match = search_last(s, ev, ['totalanharm'], re.compile(r'Total Anharm\s*:\s*cm\-1\s*=\s*([\d,\.,\-]*)'))
+    if match:
+        return float(match.group(1).replace('D', 'E')) * ut.rcm2au
+    return None
+
+
+def _gaussian_zmat(s, ev):
+    """
+    Same as patools.gaussian_zmat.
+    """
+    pos = first(ev, 'zmat')
+    if pos < 0:
+        return None
+    start = pos + len('Z-matrix:\n')
+    end = first(ev, 'zmat', start)
+    if end < 0:
+        end = len(s)
+    optpos = first(ev, 'optparams', start, end)
+    if optpos < 0:
+        return None
+    vpos = first(ev, 'variables', start, end)
+    if vpos < 0:
+        vpos = end
+    zmat = s[start:vpos] + 'Variables:\n'
+    zmat = zmat.replace('Charge = ', '').replace('Multiplicity =', '')
+    sep = '---------------------------------------'
+    optend = optpos
+    cursor = optpos
+    for _ in range(4):
+        i = s.find(sep, cursor, end)
+        if i < 0:
+            optend = end
+            break
+        optend = i
+        cursor = i + len(sep)
+    return zmat + pa.gaussian_opt_zmat_params(s[optpos:optend])
+
+
+def _gaussian_geo(s, ev):
+    """
+    Same as patools.gaussian_geo.
+    """
+    atomnum = {'1':'H','6':'C','7':'N','8':'O'}
+    xyz = ''
+    try:
+        if ev['eckart']:
+            start = last(ev, 'gaussorient')
+            start = start + len('Gaussian Orientation') if start >= 0 else 0
+            end = first(ev, 'eckart', start)
+            if end < 0:
+                end = len(s)
+            for line in s[start:end].split('\n')[5:-2]:
+                line = line.split()
+                xyz += atomnum[line[1]]+ '  ' + line[2] + '  ' + line[3] + '  ' + line[4] + '\n'
+        else:
+            start = last(ev, 'coords')
+            start = start + len('Coordinates (Angstroms)') if start >= 0 else 0
+            end = len(s)
+            for name in ['distance', 'rotation', 'symm']:
+                pos = first(ev, name, start)
+                if pos >= 0:
+                    end = min(end, pos)
+            for line in s[start:end].split('\n')[3:-2]:
+                line = line.split()
+                xyz += ' ' + atomnum[line[1]] + '  ' + line[3] + '  ' + line[4] + '  ' + line[5] + '\n'
+    except:
+        logging.error('Cannot parse xyz')
+    return xyz
+
+
+def _gaussian_hessian(s, ev):
+    """
+    Same as patools.gaussian_hessian.
+    """
+    start = last(ev, 'harmvibrot')
+    start = start + len('Harmonic vibro-rotational analysis') if start >= 0 else 0
+    spos = first(ev, 'fccart', start)
+    if spos < 0:
+        return ''
+    epos = first(ev, 'fcint', start)
+    hstart = line_end(s, spos) + 1
+    if epos < 0:
+        hend = line_start(s, len(s) - 1 if s.endswith('\n') else len(s))
+    elif epos < spos:
+        return ''
+    else:
+        hend = line_start(s, epos)
+    if hend <= hstart:
+        return ''
+    return s[hstart:hend - 1].replace('D', 'E')
+
+
+def _gaussian_rotconsts(s, ev, nfreq):
+    """
+    Same as patools.gaussian_rotconsts.
+    """
+    rot = []
+    regex = re.compile(r'Rotational constants\s*\(GHZ\):\s*([\s,\d,\.,\-]*)')
+    match = search_last(s, ev, ['rotation'], regex, after=500)
+    if match:
+        rot = match.group(1).split()
+    if nfreq < 2:
+        rot = rot[1:]
+    if len(rot) > 0:
+        if abs(float(rot[0])) < 0.000001:
+            rot = rot[1:]
+    return rot
+
+
+def _gaussian_vibrot(s, ev, nfreq):
+    """
+    Same as patools.gaussian_vibrot.
+    """
+    pos = first(ev, 'vibrot')
+    if pos < 0:
+        return ''
+    lines = get_lines(s, pos, nfreq, skip=3)
+    for i in range(len(lines)):
+        if ')' in lines[i]:
+            lines[i] = lines[i].split(')')[1]
+        if nfreq < 2:
+            lines[i] = '\t'.join(lines[i].split()[:-1])
+    return '\n'.join(lines).split('---------------')[0]
+
+
+def _gaussian_rotdists(s, ev):
+    """
+    Same as patools.gaussian_rotdists.
+    """
+    pos = first(ev, 'rotdists')
+    if pos < 0:
+        return ''
+    distlines = []
+    for line in get_lines(s, pos, 6, skip=3):
+        splitline = line.split()
+        if splitline[0] == 'TauP':
+            distlines.append('\t'.join(splitline[1:3]))
+        else:
+            break
+    return '\n'.join(distlines).replace('D', 'e')
+
+
+def _gaussian_freqs(s, ev, nfreq):
+    """
+    Same as patools.gaussian_freqs.
+    """
+    freqs = []
+    pos = first(ev, 'fundamentals')
+    if pos > 0 and line_start(s, pos) > 0:
+        for line in get_lines(s, pos, nfreq):
+            freqs.append(line.split()[-5])
+    elif ev['freqs']:
+        freqs = [''] * nfreq
+        k = 0
+        for pos in ev['freqs']:
+            line = get_line(s, pos)
+            i = line.find('Frequencies --  ')
+            if i < 0:
+                continue
+            for token in line[i + len('Frequencies --  '):].split():
+                freqs[k] = token
+                k += 1
+            if k == nfreq:
+                break
+    return freqs
+
+
+def _gaussian_fundamentals(s, ev, nfreq):
+    """
+    Returns anharmonic frequencies sorted by harmonic frequencies,
+    same as qctools.get_gaussian_fundamentals(s)[:, 1].
+    """
+    freqs = np.zeros((nfreq, 2))
+    pos = first(ev, 'fundamentals')
+    if pos > 0 and line_start(s, pos) > 0:
+        freqs[:, :] = pa.read_columns(get_lines(s, pos, nfreq), [-5, -4])
+    return list(freqs[freqs[:, 0].argsort()][:, 1])
+
+
+def _gaussian_xmatrix(s, ev, nfreq):
+    """
+    Same as qctools.get_gaussian_xmatrix, returns [] if it cannot be parsed.
+    """
+    pos = first(ev, 'xmat')
+    skip = 1
+    if pos < 0 or line_start(s, pos) == 0:
+        pos = first(ev, 'xmat2')
+        skip = 2
+    if pos < 0:
+        return []
+    if s.count('\n', 0, pos) + skip < 3:
+        return []
+    start = line_start(s, pos)
+    try:
+        for _ in range(skip):
+            start = next_line_start(s, start)
+        xmat = pa.read_lower_triangle(s[start:], nfreq).tolist()
+    except:
+        logging.warning('Ignoring anharmonicities -- unexpected length of xmat')
+        xmat = []
+    return xmat
+
+
+##############################################
+############      MOLPRO SCANNER    ##########
+##############################################
+def scan_molpro(s):
+    """
+    Returns an output record for a Molpro output, see get_record.
+    """
+    return dict(get_lazy_record(s, 'molpro'))
+
+
+def _molpro_energies(s, ev, r):
+    method = _molpro_method(s, ev)
+    method, energy = _molpro_energy(s, ev, method)
+    return {'method': method, 'energy': energy}
+
+
+def _molpro_zpve(s, ev, r):
+    match = search_last(s, ev, ['zpve'], re.compile(r'Zero point energy:\s*([\d,\-,\.]*)'))
+    if match:
+        return {'zpve': float(match.group(1))}
+    return {}
+
+
+def _molpro_basis(s, ev, r):
+    match = search_last(s, ev, ['basis'], re.compile(r'basis=(\S*)'))
+    if match:
+        return {'basis': match.group(1).replace('(d)', '*')}
+    return {}
+
+
+def _molpro_rotconsts(s, ev, r):
+    match = search_last(s, ev, ['rotconsts'], re.compile(r'Rotational constants:\s*([\s,\d,\.,\-]*)'), after=500)
+    if match:
+        return {'rotconsts': match.group(1).split()}
+    return {}
+
+
+def _molpro_freqs(s, ev, r):
+    freqs = []
+    for pos in ev['freqs']:
+        line = get_line(s, pos)
+        line = line[line.find('Wavenumbers [cm-1]') + len('Wavenumbers [cm-1]'):]
+        if line.startswith('   ') and line[3:] and line[3:].split()[0].strip() != '0.00':
+            freqs.extend(line[3:].split())
+    return {'freqs': freqs}
+
+
+def _molpro_method(s, ev):
+    """
+    Same as patools.molpro_method.
+    """
+    if ev['ccsd(t)']:
+        method = 'CCSD(T)'
+    elif ev['mp2']:
+        method = 'MP2'
+    elif ev['ccsd']:
+        method = 'CCSD'
+    else:
+        match = search_last(s, ev, ['program'], re.compile(r'1PROGRAM\s*\*\s*(\S*)'))
+        method = match.group(1) if match else ''
+        if method == 'DFT':
+            match = search_last(s, ev, ['dft'], re.compile(r'dft=\[([\d,\w]*)\]'))
+            method = match.group(1) if match else ''
+    method = method.lstrip('r').lstrip('u').lstrip('R').lstrip('U')
+    if ev['f12']:
+        method += '-F12'
+    return method
+
+
+def _molpro_energy(s, ev, method):
+    """
+    Same as patools.molpro_energy, returns method and energy.
+    The method is returned without regex escape characters.
+    """
+    tag = method.replace('(', r'\(').replace(')', r'\)') + '[a,b]?'
+    name = method
+    if ev['OPTG']:
+        regex = re.compile(r'E\([U,u,R,r]*' + tag + r'\) \/ Hartree\s*[\d,\-,\.]*\s*([\d,\-,\.]*)')
+        match = search_last(s, ev, ['hartree'], regex)
+        if match and match.group(1):
+            return name, float(match.group(1))
+    if 'CCSD' in tag:
+        match = search_last(s, ev, ['totalenergy'], re.compile(tag + r' total energy\s*([\d,\-,\.]+)'))
+        if match is None:
+            regex = re.compile(r'!\w*\-\s*[\\U,\R]' + tag + r'\s*energy\s*([\d,\-,\.]+)')
+            match = search_last(s, ev, ['!'], regex)
+        if match:
+            return name, float(match.group(1))
+    elif 'HF' in tag:
+        match = search_last(s, ev, ['state'], re.compile(tag + r' STATE\s*\d\.\d\s*Energy\s*([\w,\-,\.]+)'), before=0)
+        if match:
+            return name, float(match.group(1))
+    elif 'MP' in tag:
+        match = search_last(s, ev, ['totalenergy'], re.compile(' ' + tag + r' total energy:\s*([\w,\-,\.]+)'))
+        if match:
+            return name, float(match.group(1))
+    match = search_last(s, ev, ['settingenergy'], re.compile(r'SETTING ENERGY\s*=\s*([\w,\.,-]+)'))
+    if match is None:
+        match = search_last(s, ev, ['settingcbsen'], re.compile(r'SETTING CBSEN\s*=\s*([\w,\.,-]+)'))
+    if match:
+        return name, float(match.group(1))
+    logging.error('scan_molpro: energy not found')
+    return name, 0.
+
+
+def _molpro_xyz(s, ev, nskip):
+    """
+    Same as patools.molpro_xyz (nskip=2) and patools.molpro_geo (nskip=4).
+    """
+    for name, marker in [('currentgeo', 'Current geometry (xyz format'),
+                         ('dumpxyz', 'Dump information in style XYZ')]:
+        pos = last(ev, name)
+        if pos >= 0:
+            start = pos + len(marker)
+            end = s.find('************', start)
+            if end < 0:
+                end = len(s)
+            return '\n'.join(s[start:end].split('\n')[nskip:])
+    return None
+
+
+def _molpro_zmat(s, ev):
+    """
+    Same as patools.molpro_zmat.
+    """
+    pos = first(ev, 'geometry')
+    if pos < 0 or not ev['OPTG']:
+        return None
+    start = pos + len('geometry={')
+    end = s.find('}', start)
+    if end < 0:
+        end = len(s)
+    geolines = s[start:end].split('\n')[1:-1]
+    zmat = 'geometry={angstrom \n' + '\n'.join(geolines) + '\n}\n'
+    end = first(ev, 'endopt')
+    if end < 0:
+        end = len(s)
+    start = last(ev, 'variable', 0, end)
+    start = start + len('Variable') if start >= 0 else 0
+    for line in s[start:end].split('\n')[3:-3]:
+        zmat += line.split()[0].lower() + ' =  ' + line.split()[4] + '\n'
+    return zmat
+
+
+def _molpro_hessian(s, ev):
+    """
+    Same as patools.molpro_hessian.
+    """
+    spos = first(ev, 'hessian')
+    if spos < 0:
+        return ''
+    epos = first(ev, 'masses')
+    if epos < 0:
+        nline = s.count('\n', spos) - 4
+        if not s.endswith('\n'):
+            nline += 1
+    else:
+        nline = s.count('\n', spos, epos) - 3
+    return pa.format_molpro_hessian(get_lines(s, spos, nline))
+
+
+##############################################
+############     NWCHEM SCANNER     ##########
+##############################################
+def scan_nwchem(s, minfreq=10):
+    """
+    Returns an output record for an NWChem output, see get_record.
+    """
+    return _nwchem_record(s, get_events(s, nwchem_markers), minfreq)
+
+
+def _nwchem_record(s, ev, minfreq=10):
+    r = get_record('nwchem')
+    method = 'unknown'
+    for name, marker in reversed(nwchem_energy_markers):
+        if name == 'mbpt(2)':
+            marker = 'MBPT(2) total energy / hartree       ='
+            found = any(s.startswith(marker, pos) for pos in ev[name])
+        else:
+            found = len(ev[name]) > 0
+        if found:
+            method = name
+            break
+    r['method'] = method
+    if ev['optconverged']:
+        r['calculation'] = 'geometry optimization'
+    elif ev['freqs']:
+        r['calculation'] = 'frequency analysis'
+    else:
+        r['calculation'] = 'single point'
+    for name, marker in nwchem_energy_markers:
+        pos = last(ev, name)
+        if pos >= 0:
+            try:
+                r['energies'][name] = float(get_line(s, pos).split()[-1])
+            except:
+                logging.info('Cannot parse {0}'.format(marker))
+    r['energy'] = r['energies'].get(method, 0.)
+    pos = last(ev, 'xyz')
+    geolines = ''
+    natom = 0
+    if pos >= 0:
+        start = line_end(s, line_end(s, pos) + 1) + 1
+        while start < len(s):
+            items = get_line(s, start).split()
+            if len(items) == 6:
+                geolines += '{0}    {1}     {2}     {3}\n'.format(items[1], items[3], items[4], items[5])
+                natom += 1
+                start = line_end(s, start) + 1
+            else:
+                break
+    r['natom'] = natom
+    r['xyz'] = '{0}\nParsed by QTC from NWChem output file\n{1}\n\n'.format(natom, geolines)
+    for pos in ev['nbasis']:
+        line = get_line(s, pos)
+        if len(line.split()) == 3:
+            try:
+                r['nbasis'] = int(line.split()[2])
+                break
+            except:
+                logging.error('Parser error for get_nwchem_nbasis  in line {}'.format(line))
+    for pos in ev['freqs']:
+        for item in get_line(s, pos).split()[1:]:
+            freq = item.strip()
+            if float(freq) > minfreq:
+                r['freqs'].append(freq)
+    r['nfreq'] = len(r['freqs'])
+    r['zpve'] = sum(float(freq) for freq in r['freqs']) * 0.5 / 219474.63
+    if r['energy']:
+        r['parsed'] = True
+    return r
+
+
+##############################################
+############      QCHEM SCANNER     ##########
+##############################################
+def scan_qchem(s):
+    """
+    Returns an output record for a Q-Chem output, see get_record.
+    """
+    return _qchem_record(s, get_events(s, qchem_markers))
+
+
+def _qchem_record(s, ev):
+    r = get_record('qchem')
+    match = search_last(s, ev, ['finalenergy'], re.compile(r'Final energy is\s*([\d,\.,-]*)'))
+    if match is None:
+        match = search_last(s, ev, ['basisenergy'], re.compile(r'energy in the final basis set =\s*([\d,\.,-]*)'))
+    if match:
+        r['energy'] = float(match.group(1))
+    match = search_last(s, ev, ['method'], re.compile(r'method\s*(\S*)'))
+    if match:
+        r['method'] = match.group(1)
+    match = search_last(s, ev, ['zpve'], re.compile(r'Zero point vibrational energy:\s*([\d,\.,\-]*)'))
+    if match:
+        r['zpve'] = float(match.group(1)) / ut.au2kcal
+    pos = first(ev, 'optconverged')
+    if pos >= 0:
+        xyz = ''
+        try:
+            start = pos + len('OPTIMIZATION CONVERGED')
+            end = first(ev, 'optconverged', start)
+            if end < 0:
+                end = len(s)
+            i = s.find('\n\n', start, end)
+            if i >= 0:
+                j = s.find('\n\n', i + 2, end)
+                if j < 0:
+                    j = end
+                for line in s[i + 2:j].splitlines(True)[2:]:
+                    line = line.split()
+                    xyz += ' ' + line[1] + '  ' + line[2] + '  ' + line[3] + '  ' + line[4] +'\n'
+        except:
+            logging.error('Cannot parse xyz')
+        r['geo'] = xyz
+        if xyz:
+            r['xyz'] = str(len(xyz.splitlines())) + '\n\n' + xyz
+    if ev['optcomplete']:
+        r['calculation'] = 'geometry optimization'
+    match = search_last(s, ev, ['basis'], re.compile(r'Requested basis set is\s*(\S*)'))
+    if match:
+        r['basis'] = match.group(1).lower()
+    for pos in ev['freqs']:
+        line = get_line(s, pos)
+        r['freqs'].extend(line[line.find('Frequency: ') + len('Frequency: '):].split())
+    r['nfreq'] = len(r['freqs'])
+    if r['energy']:
+        r['parsed'] = True
+    return r
+
+
+##############################################
+############     LAZY RECORDS       ##########
+##############################################
+"""
+Markers and field scanners for each package.
+A field scanner is a (fields, scanner) tuple, where scanner(s, ev, r) returns
+a dictionary with the values of fields, given the output text s, its events
+ev, and the record r, from which other fields can be read.
+Fields that are missing in the returned dictionary take the values of
+get_record. NWChem and Q-Chem outputs are cheap to scan and are read at once.
+"""
+package_markers = {'gaussian': gaussian_markers,
+                   'molpro'  : molpro_markers,
+                   'nwchem'  : nwchem_markers,
+                   'qchem'   : qchem_markers}
+
+_all_fields = tuple(key for key in get_record() if key != 'package')
+
+field_scanners = {
+    'gaussian': [
+        (('natom', 'nfreq'), _gaussian_natom),
+        (('method',), lambda s, ev, r: {'method': _gaussian_method(s, ev)}),
+        (('energy',), lambda s, ev, r: {'energy': _gaussian_energy(s, ev, r['method'])}),
+        (('basis',), lambda s, ev, r: {'basis': _gaussian_basis(s, ev)}),
+        (('zpve',), lambda s, ev, r: {'zpve': _gaussian_zpve(s, ev)}),
+        (('azpve',), lambda s, ev, r: {'azpve': _gaussian_anzpve(s, ev)}),
+        (('calculation',), lambda s, ev, r: {'calculation': 'geometry optimization'} if ev['optcomplete'] else {}),
+        (('zmat',), lambda s, ev, r: {'zmat': _gaussian_zmat(s, ev)}),
+        (('geo', 'xyz'), _gaussian_geometry),
+        (('Hessian',), lambda s, ev, r: {'Hessian': _gaussian_hessian(s, ev)}),
+        (('rotconsts',), lambda s, ev, r: {'rotconsts': _gaussian_rotconsts(s, ev, r['nfreq'])}),
+        (('vibrots',), lambda s, ev, r: {'vibrots': _gaussian_vibrot(s, ev, r['nfreq'])}),
+        (('rotdists',), lambda s, ev, r: {'rotdists': _gaussian_rotdists(s, ev)}),
+        (('freqs',), lambda s, ev, r: {'freqs': _gaussian_freqs(s, ev, r['nfreq'])}),
+        (('afreqs', 'xmat'), _gaussian_anharmonic),
+        (('parsed',), lambda s, ev, r: {'parsed': bool(r['energy'])}),
+    ],
+    'molpro': [
+        (('method', 'energy'), _molpro_energies),
+        (('zpve',), _molpro_zpve),
+        (('xyz',), lambda s, ev, r: {'xyz': _molpro_xyz(s, ev, 2)}),
+        (('geo',), lambda s, ev, r: {'geo': _molpro_xyz(s, ev, 4)}),
+        (('calculation',), lambda s, ev, r: {'calculation': 'geometry optimization'} if ev['optg'] else {}),
+        (('basis',), _molpro_basis),
+        (('rotconsts',), _molpro_rotconsts),
+        (('zmat',), lambda s, ev, r: {'zmat': _molpro_zmat(s, ev)}),
+        (('Hessian',), lambda s, ev, r: {'Hessian': _molpro_hessian(s, ev)}),
+        (('freqs',), _molpro_freqs),
+        (('parsed',), lambda s, ev, r: {'parsed': bool(r['energy'])}),
+    ],
+    'nwchem': [(_all_fields, lambda s, ev, r: _nwchem_record(s, ev))],
+    'qchem' : [(_all_fields, lambda s, ev, r: _qchem_record(s, ev))],
+}
+
+
+class LazyRecord(Mapping):
+    """
+    Read-only mapping with the keys of defaults, whose values are computed
+    when first accessed and then kept.
+    scanners is a list of (fields, scanner) tuples, where scanner(record)
+    returns a dictionary with the values of fields. All the fields of a
+    scanner are set together, missing ones take the value in defaults.
+    Keys without a scanner take the value in defaults.
+    dict(record) computes all the values.
+    >>> r = LazyRecord([(('a', 'b'), lambda r: {'a': 1})], {'a': 0, 'b': 2, 'c': 3})
+    >>> r.computed
+    {}
+    >>> r['a'], sorted(r.computed.items())
+    (1, [('a', 1), ('b', 2)])
+    >>> sorted(dict(r).items())
+    [('a', 1), ('b', 2), ('c', 3)]
+    """
+    def __init__(self, scanners, defaults):
+        self.defaults = defaults
+        self.computed = {}
+        self.scanners = {}
+        for fields, scanner in scanners:
+            for field in fields:
+                self.scanners[field] = (fields, scanner)
+
+    def __getitem__(self, key):
+        if key not in self.computed:
+            if key not in self.defaults:
+                raise KeyError(key)
+            if key in self.scanners:
+                fields, scanner = self.scanners[key]
+                values = scanner(self)
+                for field in fields:
+                    self.computed[field] = values.get(field, self.defaults[field])
+            else:
+                self.computed[key] = self.defaults[key]
+        return self.computed[key]
+
+    def __contains__(self, key):
+        return key in self.defaults
+
+    def __iter__(self):
+        return iter(self.defaults)
+
+    def __len__(self):
+        return len(self.defaults)
+
+
+def get_lazy_record(s, package=None):
+    """
+    Returns an output record (see get_record) as a LazyRecord, whose fields
+    are scanned with field_scanners when first accessed.
+    The output is walked once, when the first field is accessed.
+    package is determined with qctools.get_output_package if not given.
+    """
+    if package is None:
+        from . import qctools as qc
+        package = qc.get_output_package(s)
+    if package not in field_scanners:
+        logging.error('get_lazy_record: package {} is not supported, use one of {}'.format(package, scan_packages))
+        return LazyRecord([], get_record(package))
+    events = []
+
+    def get_scanner(scanner):
+        def scan(r):
+            if not events:
+                events.append(get_events(s, package_markers[package]))
+            return scanner(s, events[0], r)
+        return scan
+    scanners = [(fields, get_scanner(scanner)) for fields, scanner in field_scanners[package]]
+    return LazyRecord(scanners, get_record(package))
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""
+Node-local scratch staging of qc calculations.
+
+With a stage directory set (see set_stage, or qtc with --stage), qctools.run
+writes the input of a gaussian, molpro, nwchem, qchem or mopac calculation
+to a short directory on node-local storage or tmpfs, e.g. /dev/shm, and
+runs the calculation there instead of in the run directory of the shared
+database. Checkpoint, integral and scratch files (tmp_nwchem, .chk, ...)
+never reach the shared file system, and the short path avoids the 255
+character input path limit of molpro.
+When the calculation ends, the output and the structured output (.fchk,
+.xml) that are parsed next are copied back at once. The other files
+matching the whitelist are copied back by a pool of background threads
+(multiprocessing.pool.ThreadPool, also available on Python 2), which then
+remove the stage directory, while qtc goes on with parsing and the next
+calculation. Copies are written to a temporary file and renamed.
+stats counts the bytes staged, copied back, and kept in scratch, and the
+seconds of copying and cleanup done in the background, off the critical
+path of the run.
+"""
+import fnmatch
+import hashlib
+import logging
+import os
+import shutil
+import socket
+import sys
+import time
+from . import iotools as io
+
+# Files copied back to the run directory
+default_patterns = ['*.out', '*.log', '*.xml', '*.fchk', '*.xyz', '*.molden', '*.hess', '*.txt']
+
+# The active stage directory, see set_stage
+stage = {'dir': None, 'patterns': default_patterns, 'executor': None, 'pending': []}
+
+# Bytes staged in, copied back at once and in the background, written to
+# the stage directories, and seconds spent in the foreground and the background
+stats = {'jobs': 0, 'staged bytes': 0, 'copied bytes': 0, 'async bytes': 0, 'scratch bytes': 0,
+         'copy time': 0., 'async time': 0., 'cleanup time': 0.}
+
+
+def set_stage(stagedir, patterns=None, nthreads=2):
+    """
+    Sets the node-local stage directory, a directory for this process is
+    created in it. patterns is the whitelist of files copied back, and
+    nthreads the number of background threads.
+    """
+    import atexit
+    from multiprocessing.pool import ThreadPool
+    stagedir = io.join_path(os.path.abspath(stagedir), 'qtc_{}_{}'.format(socket.gethostname(), os.getpid()))
+    io.mkdir(stagedir)
+    if stage['executor'] is None:
+        atexit.register(unset_stage)
+    stage['dir'] = stagedir
+    stage['patterns'] = patterns or default_patterns
+    stage['executor'] = ThreadPool(nthreads)
+    logging.info('Stage directory: {}'.format(stagedir))
+    return stagedir
+
+
+def unset_stage():
+    """
+    Waits for the background copies and removes the stage directory.
+    """
+    if stage['dir'] is None:
+        return
+    wait()
+    stage['executor'].close()
+    stage['executor'].join()
+    io.rmrf(stage['dir'])
+    stage['dir'] = None
+    return
+
+
+def get_stage_dir(rundir, stagedir=None):
+    """
+    Returns the stage directory of a run directory.
+    >>> get_stage_dir('/db/C2H6/CC_m1/opt/gaussian', '/dev/shm/qtc')
+    '/dev/shm/qtc/4dedc68a989e'
+    """
+    stagedir = stagedir or stage['dir']
+    return io.join_path(stagedir, hashlib.sha1(rundir.encode('utf-8')).hexdigest()[:12])
+
+
+def get_tree_size(directory):
+    """
+    Returns the total size in bytes of the files in directory.
+    """
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for name in filenames:
+            try:
+                size += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return size
+
+
+def copy_file(source, target):
+    """
+    Copies source to target through a temporary file, keeping the
+    modification time. Returns the number of bytes copied.
+    """
+    tmpfile = '{}.{}.tmp'.format(target, os.getpid())
+    shutil.copyfile(source, tmpfile)
+    shutil.copystat(source, tmpfile)
+    os.rename(tmpfile, target)
+    return os.path.getsize(target)
+
+
+def stage_in(rundir, filenames):
+    """
+    Creates a new stage directory for rundir and copies filenames from
+    rundir to it, after waiting for the background copies to rundir of an
+    earlier calculation. Returns the stage directory.
+    """
+    wait(rundir)
+    stagedir = '{}_{}'.format(get_stage_dir(rundir), stats['jobs'])
+    io.mkdir(stagedir)
+    for filename in filenames:
+        stats['staged bytes'] += copy_file(io.join_path(rundir, filename), io.join_path(stagedir, filename))
+    stats['jobs'] += 1
+    return stagedir
+
+
+def _copy_back(stagedir, rundir, names):
+    """
+    Copies names from stagedir to rundir and removes stagedir, in a
+    background thread.
+    """
+    start = time.time()
+    nbytes = 0
+    for name in names:
+        try:
+            nbytes += copy_file(io.join_path(stagedir, name), io.join_path(rundir, name))
+        except (IOError, OSError) as e:
+            logging.error('Cannot copy {} from {}: {}'.format(name, stagedir, e))
+    stats['async bytes'] += nbytes
+    stats['async time'] += time.time() - start
+    start = time.time()
+    io.rmrf(stagedir)
+    stats['cleanup time'] += time.time() - start
+    return nbytes
+
+
+def stage_out(stagedir, rundir, filenames=[]):
+    """
+    Copies filenames, e.g. the output to be parsed, from stagedir back to
+    rundir at once, and the other files matching the whitelist in the
+    background, after which stagedir is removed.
+    Returns the list of files copied at once.
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> rundir = io.join_path(tmpdir, 'run')
+    >>> io.mkdir(rundir)
+    >>> io.write_file('input', io.join_path(rundir, 'C2H6.inp'))
+    >>> stagedir = set_stage(io.join_path(tmpdir, 'stage'))
+    >>> jobdir = stage_in(rundir, ['C2H6.inp'])
+    >>> for name in ['C2H6.out', 'C2H6.chk', 'C2H6.log']:
+    ...     io.write_file(name, io.join_path(jobdir, name))
+    >>> stage_out(jobdir, rundir, ['C2H6.out'])
+    ['C2H6.out']
+    >>> wait(rundir)
+    >>> sorted(os.listdir(rundir)), os.path.exists(jobdir)
+    (['C2H6.inp', 'C2H6.log', 'C2H6.out'], False)
+    >>> unset_stage()
+    >>> io.rmrf(tmpdir)
+    """
+    start = time.time()
+    copied = []
+    for name in filenames:
+        if os.path.isfile(io.join_path(stagedir, name)):
+            stats['copied bytes'] += copy_file(io.join_path(stagedir, name), io.join_path(rundir, name))
+            copied.append(name)
+    stats['copy time'] += time.time() - start
+    names = [name for name in os.listdir(stagedir)
+             if name not in copied and os.path.isfile(io.join_path(stagedir, name))
+             and any(fnmatch.fnmatch(name, pattern) for pattern in stage['patterns'])]
+    stats['scratch bytes'] += get_tree_size(stagedir)
+    stage['pending'] = [(directory, result) for directory, result in stage['pending'] if not result.ready()]
+    stage['pending'].append((rundir, stage['executor'].apply_async(_copy_back, (stagedir, rundir, names))))
+    return copied
+
+
+def wait(rundir=None):
+    """
+    Waits for the background copies to rundir, or all of them, to finish.
+    """
+    for directory, result in stage['pending']:
+        if rundir is None or directory == rundir:
+            result.get()
+    stage['pending'] = [(directory, result) for directory, result in stage['pending'] if not result.ready()]
+    return
+
+
+def get_report():
+    """
+    Returns a summary of stats.
+    """
+    scratch = stats['scratch bytes'] - stats['staged bytes'] - stats['copied bytes'] - stats['async bytes']
+    return ('{} staged calculations, {:.1f} MB staged in, {:.1f} MB copied back ({:.1f} MB in the background), '
+            '{:.1f} MB kept off the shared file system, {:.2f} s of copying and cleanup in the background'.format(
+                stats['jobs'], stats['staged bytes'] / 1048576., (stats['copied bytes'] + stats['async bytes']) / 1048576.,
+                stats['async bytes'] / 1048576., scratch / 1048576., stats['async time'] + stats['cleanup time']))
+
+
+if __name__ == "__main__":
+    if '--test' in sys.argv:
+        import doctest
+        doctest.testmod(verbose=True)
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+"""
+Migration of a database tree between the flat and the sharded layouts.
+
+In the flat layout species are stored in database/formula/smilesname, so
+that all isomers of a formula share one directory. In the sharded layout
+they are stored in database/formula/shard/smilesname, where shard is a
+stable hash prefix of smilesname (see iotools.get_shard), which spreads
+the isomers of a formula over up to 256 directories.
+iotools.get_species_dir resolves species in either layout, so qtc can run
+on a tree while it is migrated.
+
+migrate first sets the layout of the database, so that new species go to
+the new layout, and then moves the species directories with NPROC
+processes. A move is a rename of the species directory within the
+database. Relative links in the moved directories, e.g. to the blob store
+(see blobtools), are updated, and so are the paths in the SQLite results
+store (see sqltools) and the manifest (see manifesttools) if they exist in
+the database directory. Sidecars of parsed outputs with an absolute
+'arrays' path written by earlier versions are rewritten with the file
+name, which is resolved in the output directory (see qctools.get_arrays_path).
+Results written outside the database keep the run directory of each
+calculation in 'path'. The json files given with --results, e.g. qtc json
+dumps or the merged.json of journaltools, are rewritten for the moved
+species. Json lines streams and MongoDB collections are not; ingest the
+rewritten json files again, or harvest the migrated database.
+
+Usage:
+   python -m qtc.shardtools migrate database -n 16            # flat to sharded
+   python -m qtc.shardtools migrate database -l flat -n 16    # sharded to flat
+   python -m qtc.shardtools migrate database -r qtc_thermo.json journals/merged.json
+   python -m qtc.shardtools stats database                     # species per directory
+   python -m qtc.shardtools --test                             # run the doctests
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+from . import iotools as io
+from . import blobtools as bt
+
+layouts = ['flat', 'sharded']
+
+
+def is_shard(name):
+    """
+    Returns True if name can be a shard directory, two hex digits.
+    >>> is_shard('e6'), is_shard('CC_m1')
+    (True, False)
+    """
+    return len(name) == 2 and all(c in '0123456789abcdef' for c in name)
+
+
+def yield_species(database):
+    """
+    Yields (formula, smilesname, path) for the species directories of a
+    database in either layout, path relative to the database.
+    """
+    for formula in sorted(os.listdir(database)):
+        formuladir = io.join_path(database, formula)
+        if not os.path.isdir(formuladir) or formula == bt.blob_dirname:
+            continue
+        for name in sorted(os.listdir(formuladir)):
+            if not os.path.isdir(io.join_path(formuladir, name)):
+                continue
+            if is_shard(name):
+                for smilesname in sorted(os.listdir(io.join_path(formuladir, name))):
+                    if io.get_shard(smilesname) == name:
+                        yield formula, smilesname, io.join_path(formula, name, smilesname)
+            else:
+                yield formula, name, io.join_path(formula, name)
+
+
+def get_target(formula, smilesname, layout):
+    """
+    Returns the path of a species directory relative to the database in layout.
+    >>> get_target('C2H6', 'CC_m1', 'sharded')
+    'C2H6/e6/CC_m1'
+    """
+    if layout == 'sharded':
+        return io.join_path(formula, io.get_shard(smilesname), smilesname)
+    return io.join_path(formula, smilesname)
+
+
+def fix_links(directory, olddirectory):
+    """
+    Updates the relative symbolic links in directory, moved from
+    olddirectory, so that they point to the same files.
+    Returns the number of updated links.
+    """
+    n = 0
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            if not os.path.islink(path):
+                continue
+            target = os.readlink(path)
+            if os.path.isabs(target):
+                continue
+            olddir = os.path.join(olddirectory, os.path.relpath(dirpath, directory))
+            oldtarget = os.path.normpath(os.path.join(olddir, target))
+            if oldtarget == olddirectory or oldtarget.startswith(olddirectory + os.sep):
+                continue
+            newtarget = os.path.relpath(oldtarget, dirpath)
+            if newtarget != target:
+                tmplink = '{}.{}.tmp'.format(path, os.getpid())
+                os.symlink(newtarget, tmplink)
+                os.rename(tmplink, path)
+                n += 1
+    return n
+
+
+def fix_sidecars(directory):
+    """
+    Replaces the absolute 'arrays' paths in the sidecars of parsed outputs
+    in directory, see qctools.read_sidecar, with the file names.
+    Returns the number of updated sidecars.
+    """
+    n = 0
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for name in filenames:
+            if not name.endswith('.parsed.json'):
+                continue
+            sidecar = os.path.join(dirpath, name)
+            try:
+                with open(sidecar) as f:
+                    d = json.load(f)
+                arrays = d['results'].get('arrays')
+            except (ValueError, KeyError, AttributeError, IOError):
+                continue
+            if not arrays or not os.path.isabs(arrays):
+                continue
+            d['results']['arrays'] = os.path.basename(arrays)
+            tmpfile = '{}.{}.tmp'.format(sidecar, os.getpid())
+            with open(tmpfile, 'w') as f:
+                json.dump(d, f, separators=(',', ':'))
+            shutil.copystat(sidecar, tmpfile)
+            os.rename(tmpfile, sidecar)
+            n += 1
+    return n
+
+
+def move_species(item):
+    """
+    Moves a species directory, item is a (database, oldpath, newpath)
+    tuple with paths relative to the database.
+    Returns (oldpath, newpath), with newpath None if the move failed.
+    """
+    database, oldpath, newpath = item
+    source = io.join_path(database, oldpath)
+    target = io.join_path(database, newpath)
+    try:
+        if os.path.exists(target):
+            raise OSError('{} exists'.format(target))
+        io.mkdir(os.path.dirname(target))
+        os.rename(source, target)
+        fix_links(target, source)
+        fix_sidecars(target)
+    except OSError as e:
+        logging.error('Cannot move {} to {}: {}'.format(source, target, e))
+        return oldpath, None
+    return oldpath, newpath
+
+
+def update_store(dbfile, moves):
+    """
+    Replaces the path prefixes of moved species in the SQLite results store
+    or manifest dbfile, see sqltools and manifesttools.
+    """
+    import sqlite3
+    from . import manifesttools as mf
+    connection = sqlite3.connect(dbfile, timeout=60)
+    table = 'results' if connection.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name='results'").fetchone() else 'files'
+    with connection:
+        for oldpath, newpath in moves:
+            old, new = oldpath.replace(os.sep, '/') + '/', newpath.replace(os.sep, '/') + '/'
+            connection.execute('UPDATE {} SET path = ? || substr(path, ?) WHERE path >= ? AND path < ?'.format(table),
+                               (new, len(old) + 1, old, old + mf.prefix_end))
+    connection.close()
+    return
+
+
+def update_paths(allresults, database, moves):
+    """
+    Replaces the run directories in 'path', and absolute 'arrays' paths, of
+    the moved species in allresults, {slabel: {qlabel: results}}.
+    moves is a list of (oldpath, newpath) relative to database.
+    Returns the number of updated results.
+    >>> allresults = {'CC': {'opt': {'path': '/db/C2H6/CC_m1/opt/gaussian', 'energy': -79.8}}}
+    >>> update_paths(allresults, '/db', [('C2H6/CC_m1', 'C2H6/e6/CC_m1')])
+    1
+    >>> allresults['CC']['opt']['path']
+    '/db/C2H6/e6/CC_m1/opt/gaussian'
+    """
+    root = os.path.abspath(database)
+    moved = dict(moves)
+    n = 0
+    for qresults in allresults.values():
+        if not isinstance(qresults, dict):
+            continue
+        for results in qresults.values():
+            if not isinstance(results, dict) or not results.get('path'):
+                continue
+            path = os.path.relpath(os.path.abspath(results['path']), root)
+            parts = path.split(os.sep)
+            for nparts in [3, 2]:
+                oldpath = os.sep.join(parts[:nparts])
+                if oldpath in moved:
+                    results['path'] = io.join_path(root, moved[oldpath], *parts[nparts:])
+                    if results.get('arrays') and os.path.isabs(results['arrays']):
+                        results['arrays'] = os.path.basename(results['arrays'])
+                    n += 1
+                    break
+    return n
+
+
+def update_results_file(filename, database, moves):
+    """
+    Rewrites the paths of moved species in a json results file, a qtc json
+    dump with 'all results', the merged.json of journaltools, or
+    {slabel: {qlabel: results}}, see update_paths.
+    Returns the number of updated results.
+    """
+    with open(filename) as f:
+        d = json.load(f)
+    if 'all results' in d:
+        allresults = d['all results']
+    elif 'offsets' in d and 'results' in d:
+        allresults = d['results']
+    else:
+        allresults = d
+    n = update_paths(allresults, database, moves)
+    if n:
+        tmpfile = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmpfile, 'w') as f:
+            json.dump(d, f, ensure_ascii=False, indent=2)
+        os.rename(tmpfile, filename)
+    logging.info('Updated {} paths in {}'.format(n, filename))
+    return n
+
+
+def migrate(database, layout='sharded', nproc=1, resultfiles=[]):
+    """
+    Sets the layout of a database and moves its species directories to
+    layout with nproc processes. The paths in the json results files
+    resultfiles are updated, see update_results_file.
+    Returns a dictionary with the numbers of species, moved and failed
+    moves, and the time in seconds.
+    >>> import tempfile
+    >>> db = tempfile.mkdtemp()
+    >>> rundir = io.join_path(db, 'C2H6', 'CC_m1', 'opt')
+    >>> io.mkdir(rundir)
+    >>> io.write_file('output', io.join_path(rundir, 'C2H6.out'))
+    >>> os.symlink('C2H6.out', io.join_path(rundir, 'C2H6.log'))
+    >>> io.write_file(json.dumps({'results': {'arrays': io.join_path(rundir, 'C2H6.npz')}}),
+    ...               io.join_path(rundir, 'C2H6.out.parsed.json'))
+    >>> resultfile = io.join_path(db, 'all.json')
+    >>> io.write_file(json.dumps({'CC': {'opt': {'path': rundir}}}), resultfile)
+    >>> report = migrate(db, 'sharded', resultfiles=[resultfile])
+    >>> report['moved'], io.get_layout(db)
+    (1, 'sharded')
+    >>> newdir = io.get_species_dir(db, 'C2H6', 'CC_m1')
+    >>> os.path.relpath(newdir, db)
+    'C2H6/e6/CC_m1'
+    >>> io.read_file(io.join_path(newdir, 'opt', 'C2H6.log'))
+    'output'
+    >>> json.load(open(io.join_path(newdir, 'opt', 'C2H6.out.parsed.json')))['results']['arrays'] == 'C2H6.npz'
+    True
+    >>> json.load(open(resultfile))['CC']['opt']['path'] == io.join_path(newdir, 'opt')
+    True
+    >>> io.rmrf(db)
+    """
+    from multiprocessing import Pool
+    from . import manifesttools as mf
+    from . import sqltools as sq
+    start = time.time()
+    io.set_layout(database, layout)
+    species = list(yield_species(database))
+    items = []
+    for formula, smilesname, path in species:
+        target = get_target(formula, smilesname, layout)
+        if path != target:
+            items.append((database, path, target))
+    if nproc > 1 and len(items) > 1:
+        pool = Pool(nproc)
+        results = pool.map(move_species, items, chunksize=max(1, len(items) // (4 * nproc)))
+        pool.close()
+        pool.join()
+    else:
+        results = [move_species(item) for item in items]
+    moves = [(oldpath, newpath) for oldpath, newpath in results if newpath]
+    for name in [sq.default_name, mf.default_name]:
+        dbfile = io.join_path(database, name)
+        if moves and io.check_file(dbfile):
+            update_store(dbfile, moves)
+    for resultfile in resultfiles:
+        if moves:
+            update_results_file(resultfile, database, moves)
+    report = {'species': len(species), 'moved': len(moves), 'failed': len(results) - len(moves),
+              'time': time.time() - start}
+    logging.info('Moved {moved} of {species} species in {time:.2f} s, {failed} failed'.format(**report))
+    return report
+
+
+def get_stats(database):
+    """
+    Returns a dictionary with the number of species, and the largest number
+    of entries in a formula or shard directory.
+    """
+    counts = {}
+    for formula, smilesname, path in yield_species(database):
+        parent = os.path.dirname(path)
+        counts[parent] = counts.get(parent, 0) + 1
+    return {'species': sum(counts.values()), 'directories': len(counts),
+            'largest': max(counts.values()) if counts else 0, 'layout': io.get_layout(database)}
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Migration of a qtc database between the flat and sharded layouts')
+    parser.add_argument('action', choices=['migrate', 'stats'],
+                        help='migrate: move species to LAYOUT, stats: species per directory')
+    parser.add_argument('database', type=str,
+                        help='Database directory')
+    parser.add_argument('-l', '--layout', type=str, default='sharded', choices=layouts,
+                        help='Target layout')
+    parser.add_argument('-n', '--nproc', type=int, default=1,
+                        help='Number of processes moving species')
+    parser.add_argument('-r', '--results', type=str, nargs='*', default=[],
+                        help='Json results files whose paths are updated, qtc json dumps or merged.json of journaltools')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    if args.action == 'migrate':
+        migrate(args.database, args.layout, args.nproc, args.results)
+    else:
+        for key, value in get_stats(args.database).items():
+            print('{:12s} {}'.format(key, value))
+    return
+
+
+if __name__ == "__main__":
+    if '--test' in sys.argv:
+        import doctest
+        doctest.testmod(verbose=True)
+    else:
+        main()
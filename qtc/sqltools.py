@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+"""
+SQLite results store.
+
+Small result files of a database tree (.ene, .xyz, .zpve, .hrm, .hofk, ...)
+are kept as rows of a single SQLite file instead of files scattered in
+database/formula/smilesname/qcdirectory/.
+A row is keyed by the path of the file relative to the database, and
+indexed by (slabel, qlabel, property), where slabel is the smilesname
+directory, qlabel the qcdirectory and property the file extension.
+
+The store is used by iotools.write_result, read_result and check_result
+after set_store is called, e.g. by qtc with --store.
+SQLite locking is not reliable on some network file systems, keep the store
+file on a local or a lock-supporting file system when many ranks write to it.
+
+Usage:
+   python -m qtc.sqltools import database            # migrate existing files
+   python -m qtc.sqltools export database -t newdir  # write the files back
+   python -m qtc.sqltools --test                     # run the doctests
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import time
+from . import iotools as io
+
+# Extensions of the result files kept in the store
+result_extensions = ['ene', 'xyz', 'zpve', 'anzpve', 'hrm', 'anhrm', 'phrm', 'panhrm',
+                     'hofk', 'hf0k', 'bac', 'ckin', 'c97', 'zmat', 'geo', 'rc', 'xmat']
+
+default_name = 'qtc_results.sqlite'
+
+# The active store, see set_store
+store = {'root': None, 'file': None, 'files': True}
+
+_connections = {}
+
+schema = """
+CREATE TABLE IF NOT EXISTS results (
+    path     TEXT PRIMARY KEY,
+    slabel   TEXT NOT NULL,
+    qlabel   TEXT NOT NULL,
+    property TEXT NOT NULL,
+    value    TEXT,
+    mtime    REAL
+);
+CREATE INDEX IF NOT EXISTS results_index ON results (slabel, qlabel, property);
+"""
+
+
+def get_connection(dbfile, tables=schema):
+    """
+    Returns a connection to the SQLite file dbfile, creating the tables if needed.
+    tables is the sql script creating the tables, the results table by default.
+    Connections are kept open and reused.
+    """
+    if dbfile not in _connections:
+        connection = sqlite3.connect(dbfile, timeout=60)
+        connection.executescript(tables)
+        _connections[dbfile] = connection
+    return _connections[dbfile]
+
+
+def set_store(database, dbfile=None, files=True):
+    """
+    Sets the results store for the database directory.
+    dbfile is the SQLite file, database/qtc_results.sqlite if not given.
+    If files is False, result files are no longer written to the tree.
+    """
+    root = os.path.abspath(database)
+    if not dbfile:
+        dbfile = io.join_path(root, default_name)
+    store['root'] = root
+    store['file'] = os.path.abspath(dbfile)
+    store['files'] = files
+    get_connection(store['file'])
+    logging.info('Results store: {}'.format(store['file']))
+    return store['file']
+
+
+def unset_store():
+    """
+    Stops using the results store.
+    """
+    store['root'] = None
+    store['file'] = None
+    store['files'] = True
+    return
+
+
+def get_key(filename, root=None):
+    """
+    Returns (path, slabel, qlabel, property) for a result file in the
+    database tree root, the active store root if not given.
+    Returns None if the file is not in the tree or is not a result file.
+    >>> get_key('/db/C2H6/CC_m1/opt/gaussian/C2H6.ene', '/db')
+    ('C2H6/CC_m1/opt/gaussian/C2H6.ene', 'CC_m1', 'opt/gaussian', 'ene')
+    """
+    root = root or store['root']
+    if root is None:
+        return None
+    path = os.path.relpath(os.path.abspath(filename), root)
+    if path.startswith('..'):
+        return None
+    prop = path.rsplit('.', 1)[-1]
+    if prop not in result_extensions:
+        return None
+    tokens = path.split(os.sep)
+    if len(tokens) > 2:
+        formula, slabel, tokens = io.split_species_path(path)
+        qlabel = '/'.join(tokens[:-1])
+    else:
+        slabel, qlabel = os.path.splitext(tokens[-1])[0], ''
+    return path.replace(os.sep, '/'), slabel, qlabel, prop
+
+
+def write_value(filename, value, append=False):
+    """
+    Stores the content of a result file in the active store.
+    Returns False if there is no store or filename is not a result file.
+    """
+    key = get_key(filename)
+    if key is None:
+        return False
+    connection = get_connection(store['file'])
+    with connection:
+        if append:
+            old = read_value(filename)
+            if old:
+                value = old + value
+        connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                           key + (value, time.time()))
+    return True
+
+
+def write_values(items):
+    """
+    Stores the contents of result files, given as (filename, value, append)
+    items, in the active store in a single transaction.
+    Returns the set of the stored filenames.
+    """
+    stored = set()
+    if store['file'] is None:
+        return stored
+    connection = get_connection(store['file'])
+    with connection:
+        for filename, value, append in items:
+            key = get_key(filename)
+            if key is None:
+                continue
+            if append:
+                row = connection.execute('SELECT value FROM results WHERE path = ?', (key[0],)).fetchone()
+                if row and row[0]:
+                    value = row[0] + value
+            connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                               key + (value, time.time()))
+            stored.add(filename)
+    return stored
+
+
+def read_value(filename):
+    """
+    Returns the content of a result file from the active store.
+    Returns None if it is not in the store.
+    """
+    key = get_key(filename)
+    if key is None:
+        return None
+    connection = get_connection(store['file'])
+    row = connection.execute('SELECT value FROM results WHERE path = ?', (key[0],)).fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+
+def find_values(directory, pattern='*'):
+    """
+    Returns the names of the result files in a directory of the active
+    store tree with names matching pattern. Files in subdirectories are not
+    included. Returns an empty list if there is no store or the directory
+    is not in its tree.
+    """
+    import fnmatch
+    if store['root'] is None:
+        return []
+    prefix = os.path.relpath(os.path.abspath(directory), store['root'])
+    if prefix.startswith('..'):
+        return []
+    prefix = '' if prefix == '.' else prefix.replace(os.sep, '/') + '/'
+    rows = get_connection(store['file']).execute(
+        'SELECT path FROM results WHERE path >= ? AND path < ?', (prefix, prefix + u'\uffff')).fetchall()
+    names = [row[0][len(prefix):] for row in rows]
+    return [name for name in names if '/' not in name and fnmatch.fnmatch(name, pattern)]
+
+
+def query(dbfile, slabel=None, qlabel=None, prop=None):
+    """
+    Returns a list of (path, slabel, qlabel, property, value) rows of the
+    store dbfile, selected by any of slabel, qlabel and property.
+    """
+    conditions = []
+    args = []
+    for column, val in [('slabel', slabel), ('qlabel', qlabel), ('property', prop)]:
+        if val is not None:
+            conditions.append('{} = ?'.format(column))
+            args.append(val)
+    sql = 'SELECT path, slabel, qlabel, property, value FROM results'
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    return get_connection(dbfile).execute(sql, args).fetchall()
+
+
+def import_tree(database, dbfile=None, maxsize=1048576):
+    """
+    Imports the result files, up to maxsize bytes, of a database tree into
+    the store dbfile, database/qtc_results.sqlite if not given.
+    Files are not removed. Returns the number of imported files.
+    """
+    root = os.path.abspath(database)
+    dbfile = dbfile or io.join_path(root, default_name)
+    rows = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            filename = os.path.join(dirpath, name)
+            key = get_key(filename, root)
+            if key is None or os.path.getsize(filename) > maxsize:
+                continue
+            try:
+                value = io.read_file(filename)
+            except UnicodeDecodeError:
+                continue
+            rows.append(key + (value, os.path.getmtime(filename)))
+    connection = get_connection(dbfile)
+    with connection:
+        connection.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)', rows)
+    logging.info('Imported {} files from {} to {}'.format(len(rows), root, dbfile))
+    return len(rows)
+
+
+def export_tree(dbfile, target):
+    """
+    Writes the results in the store dbfile as files in the target directory,
+    with the database tree layout. Returns the number of written files.
+    >>> import importlib, tempfile
+    >>> sq = importlib.import_module('qtc.sqltools')
+    >>> database = tempfile.mkdtemp()
+    >>> filename = io.join_path(database, 'C2H6', 'CC_m1', 'opt', 'C2H6.ene')
+    >>> dbfile = sq.set_store(database, files=False)
+    >>> io.write_result('-79.8', filename)
+    >>> io.write_result(' -79.9', filename, append=True)
+    >>> io.read_result(filename) == '-79.8 -79.9', io.check_file(filename)
+    (True, False)
+    >>> io.find_results(os.path.dirname(filename), '*.ene') == [filename]
+    True
+    >>> sq.unset_store()
+    >>> export_tree(dbfile, database)
+    1
+    >>> io.read_file(filename)
+    '-79.8 -79.9'
+    >>> io.rmrf(database)
+    """
+    rows = get_connection(dbfile).execute('SELECT path, value FROM results').fetchall()
+    for path, value in rows:
+        filename = io.join_path(target, path)
+        io.mkdir(os.path.dirname(filename))
+        io.write_file(value, filename)
+    logging.info('Exported {} files from {} to {}'.format(len(rows), dbfile, target))
+    return len(rows)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='SQLite results store for a qtc database')
+    parser.add_argument('action', choices=['import', 'export'],
+                        help='import: files of the database to the store, export: store to files')
+    parser.add_argument('database', type=str,
+                        help='Database directory')
+    parser.add_argument('-s', '--store', type=str, default='',
+                        help='SQLite file, default is database/{}'.format(default_name))
+    parser.add_argument('-t', '--target', type=str, default='',
+                        help='Directory for exported files, default is the database directory')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    dbfile = args.store or io.join_path(args.database, default_name)
+    if args.action == 'import':
+        import_tree(args.database, dbfile)
+    else:
+        export_tree(dbfile, args.target or args.database)
+    return
+
+
+if __name__ == "__main__":
+    if '--test' in sys.argv:
+        import doctest
+        doctest.testmod(verbose=True)
+    else:
+        main()
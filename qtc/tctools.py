@@ -844,8 +844,7 @@ def write_chemkin_polynomial(mol, parameters):
     rmgpoly = {}
     logging.debug(msg)
     if io.check_file('thermp.out'):
-        lines = io.read_file('thermp.out')
-        hof298 = pa.get_298(lines)
+        hof298 = pa.read_last_value(pa.get_298, 'thermp.out')
         logging.info('delHf(298) = {0} kcal/mol'.format(hof298))
     else:
         logging.error('Failed to create thermp.out')